@@ -0,0 +1,100 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+import json
+import time
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+from api.models import APIRequestLog
+from api.views import activities_query
+from topics.models import Organization
+from topics.organization_search_helpers import search_organizations_by_name
+from topics.serializers import FamilyTreeSerializer, OrganizationGraphSerializer, OrganizationTimelineSerializer
+from syracuse.cache_util import using_version, set_versionable_cache
+
+import logging
+logger = logging.getLogger(__name__)
+
+IGNORED_QUERY_PARAMS = ["page", "format", "no_cache"]
+
+
+def popular_requests(days=None, max_orgs=None, max_queries=None):
+    '''
+        Most requested orgs and activity searches (by industry, region or org) in successful API calls over the last `days` days.
+        Returns list of ("org_uri" or "org_name", val), list of query_params dicts - both most popular first
+    '''
+    days = days or settings.CACHE_WARM_LOG_DAYS
+    since = timezone.now() - timedelta(days=days)
+    logs = APIRequestLog.objects.filter(timestamp__gte=since, status_code=200,
+                                        path__endswith="/activities/").values_list("query_params", flat=True)
+    orgs = Counter()
+    queries = Counter()
+    for query_params in logs.iterator():
+        query_params = {k: v for k, v in (query_params or {}).items() if k not in IGNORED_QUERY_PARAMS}
+        if len(query_params) == 0:
+            continue
+        for field in ["org_uri", "org_name"]:
+            if isinstance(query_params.get(field), str):
+                orgs[(field, query_params[field])] += 1
+        queries[json.dumps(query_params, sort_keys=True)] += 1
+    top_orgs = [x for x, _ in orgs.most_common(max_orgs or settings.CACHE_WARM_MAX_ORGS)]
+    top_queries = [json.loads(x) for x, _ in queries.most_common(max_queries or settings.CACHE_WARM_MAX_QUERIES)]
+    return top_orgs, top_queries
+
+def warm_cache_from_request_logs(version, time_budget=None, workers=None):
+    '''
+        Pre-render the pages for the most requested orgs, industries and regions into version, which should not be
+        active yet. Stops starting new work once time_budget seconds have passed. Returns number of items warmed.
+    '''
+    time_budget = settings.CACHE_WARM_TIME_BUDGET if time_budget is None else time_budget
+    deadline = time.monotonic() + time_budget
+    top_orgs, top_queries = popular_requests()
+    logger.info(f"Warming {version} with {len(top_orgs)} orgs and {len(top_queries)} activity searches")
+    tasks = [(warm_org, x) for x in top_orgs] + [(warm_activities, x) for x in top_queries]
+    executor = ThreadPoolExecutor(max_workers=workers or settings.CACHE_WARM_WORKERS, thread_name_prefix="cache-warm")
+    futures = [executor.submit(run_warming_task, fn, arg, version, deadline) for fn, arg in tasks]
+    done, not_done = wait(futures, timeout=max(0, deadline - time.monotonic()))
+    executor.shutdown(wait=False, cancel_futures=True)
+    warmed = sum(1 for x in done if x.exception() is None and x.result() is True)
+    if len(not_done) > 0:
+        logger.warning(f"Cache warming ran out of time after {time_budget}s, {len(not_done)} of {len(tasks)} items not warmed")
+    logger.info(f"Warmed {warmed} items in {version}")
+    return warmed
+
+def run_warming_task(fn, arg, version, deadline):
+    if time.monotonic() > deadline:
+        return False
+    try:
+        with using_version(version):
+            fn(arg)
+        return True
+    except Exception:
+        logger.exception(f"Could not warm cache for {arg}")
+        return False
+    finally:
+        close_old_connections()
+
+def warm_org(field_and_val):
+    '''
+        Same serializer contexts as the default org pages in topics.views
+    '''
+    field, val = field_and_val
+    if field == "org_name":
+        uris = [x.uri for x, _ in search_organizations_by_name(val, combine_same_as_name_only=False, top_1_strict=True)]
+    else:
+        uris = [val]
+    for uri in uris:
+        o = Organization.self_or_ultimate_target_node(uri)
+        if o is None:
+            continue
+        context = {"combine_same_as_name_only": False, "source_str": "_all", "min_date_str": ""}
+        FamilyTreeSerializer(o, context={**context, "relationship_str": "buyer,vendor"}).data
+        OrganizationTimelineSerializer(o, context=context).data
+        OrganizationGraphSerializer(o, context={**context, "max_nodes": 100}).data
+
+def warm_activities(query_params):
+    cache_key, fn = activities_query(query_params)
+    if cache_key is None:
+        return
+    set_versionable_cache(cache_key, fn(), soft_timeout=3600, timeout=7200)
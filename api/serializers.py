@@ -72,7 +72,7 @@ class IndustryClusterSerializer(HyperlinkedNeomodelSerializer):
     single_rels = ["parentLeft", "parentRight", "childLeft", "childRight"]
     attribs_to_ignore = [
         "foundName", "name", "internalDocId", "internalId",
-        "internalMergedSameAsHighToUri", "documentSource", "sameAsHigh",
+        "internalMergedSameAsHighToUri", "internalDegree", "documentSource", "sameAsHigh",
         "orgsPrimary", "orgsSecondary", "peoplePrimary", "peopleSecondary"
     ]
 
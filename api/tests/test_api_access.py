@@ -15,6 +15,8 @@ from django.test import TestCase, RequestFactory
 from django.contrib.auth.models import User, AnonymousUser
 from api.middleware.api_usage import APIUsageMiddleware
 from api.models import APIRequestLog
+from api.cache_warming import popular_requests
+from api.views import query_param_list
 
 logger = getLogger(__name__)
 
@@ -261,4 +263,31 @@ class APIRequestLogQueryParamsTest(TestCase):
             if isinstance(region, str):
                 self.assertIn("eu", region)
             else:
-                self.assertIn("eu", region)
\ No newline at end of file
+                self.assertIn("eu", region)
+
+
+class CacheWarmingTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="warmer", password="pass")
+        logged = [("/api/v1/activities/", 200, {"org_name": "Foo Corp", "page": "2"}),
+                  ("/api/v1/activities/", 200, {"org_name": "Foo Corp"}),
+                  ("/api/v1/activities/", 200, {"industry_name": "energy", "location_id": ["US", "CA"]}),
+                  ("/api/v1/activities/", 200, {"org_uri": "https://1145.am/db/1/bar"}),
+                  ("/api/v1/activities/", 500, {"org_uri": "https://1145.am/db/2/failed"}),
+                  ("/api/v1/regions/", 200, {"org_name": "Not Activities"})]
+        for path, status_code, query_params in logged:
+            APIRequestLog.objects.create(user=self.user, path=path, method="GET", status_code=status_code,
+                                         duration=0.1, query_params=query_params)
+
+    def test_ranks_most_requested_orgs_and_searches(self):
+        orgs, queries = popular_requests(days=1)
+        self.assertEqual(orgs, [("org_name", "Foo Corp"), ("org_uri", "https://1145.am/db/1/bar")])
+        self.assertEqual(queries[0], {"org_name": "Foo Corp"})
+        self.assertIn({"industry_name": "energy", "location_id": ["US", "CA"]}, queries)
+        self.assertEqual(len(queries), 3)
+
+    def test_query_param_list_handles_logged_params(self):
+        params = {"location_id": "US", "industry_name": ["a", "b"]}
+        self.assertEqual(query_param_list(params, "location_id"), ["US"])
+        self.assertEqual(query_param_list(params, "industry_name"), ["a", "b"])
+        self.assertEqual(query_param_list(params, "industry_id", [None]), [None])
@@ -408,6 +408,15 @@ class EndToEndTests20240602(TestCase):
         assert set([x['label'] for x in items]) == {'Added Berlin', 'Added Brandenburg', 'Added Grüenheide'}
         assert len(org_display_details) == 1
 
+    def test_timeline_details_match_activity_serializer(self):
+        source_uri = "https://1145.am/db/1736082/Tesla"
+        o = Organization.self_or_ultimate_target_node(source_uri)
+        _, items, item_display_details, _ = get_timeline_data(o,True,Article.all_sources())
+        for item in items:
+            act = Resource.nodes.get(uri=item["id"])
+            assert item["start"] == act.oldestDatePublished.isoformat()
+            assert item_display_details[item["id"]] == act.serialize_no_none()
+
     def test_role_graph(self):
         source_uri = "https://1145.am/db/1824114/Square"
         o = Organization.self_or_ultimate_target_node(source_uri)
@@ -16,4 +16,5 @@ urlpatterns = [
     path("docs/", no_throttle_views.NoThrottleSpectacularSwaggerView.as_view(url_name="schema")),
     path('api/', include(router.urls)), 
     path('api-token/', views.APITokenView.as_view(), name='api-token'),
+    path('api/cache-metrics/', views.CacheMetricsView.as_view(), name='cache-metrics'),
 ]
@@ -4,12 +4,12 @@ from auth_extensions.anon_user_utils import IsAuthenticatedNotAnon
 from topics.models import IndustryCluster, GeoNamesLocation, Resource
 import api.serializers as serializers
 import logging 
-from topics.util import filter_unique_records_and_allowed_activity_types
 from rest_framework import status
 from topics.activity_helpers import (get_activities_by_industry_geo_and_date_range,
-                                     get_activities_by_org_with_fixed_or_expanding_date_range)
+                                     get_activities_by_org_with_fixed_or_expanding_date_range,
+                                     ActivityArticleResults)
 from rest_framework.viewsets import GenericViewSet, ReadOnlyModelViewSet
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.authentication import SessionAuthentication
 from syracuse.authentication import FlexibleTokenAuthentication
 from topics.industry_geo import geo_parent_children, geo_codes_for_region
@@ -18,6 +18,7 @@ from topics.organization_search_helpers import search_organizations_by_name
 from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
 from drf_spectacular.types import OpenApiTypes
 import re
+from django.conf import settings
 from api.models import APIRequestLog
 from django.utils.dateparse import parse_date
 from django.core.paginator import Paginator
@@ -26,12 +27,15 @@ from django.http import Http404
 from django.core.exceptions import ObjectDoesNotExist
 from neomodel import DoesNotExist
 from api.docstrings import activity_docstring_raw
-from syracuse.cache_util import get_versionable_cache, set_versionable_cache
+from syracuse.cache_util import (set_versionable_cache, register_key_family, digest_cache_key, get_cache_metrics,
+    cached_compute)
 from syracuse.date_util import min_and_max_date_based_on_days_ago
 from flags.state import flag_enabled
 
 logger = logging.getLogger(__name__)
 
+API_ACTIVITIES_KEYS = register_key_family("api_activities", "ActivitiesViewSet results by query params")
+
 class NeomodelViewSet(GenericViewSet):
     permission_classes = [IsAuthenticated]
     authentication_classes = [SessionAuthentication, FlexibleTokenAuthentication]
@@ -199,6 +203,86 @@ class GeoNamesViewSet(NeomodelViewSet):
         return super().retrieve(request, *args, **kwargs)
     
 
+def query_param_list(params, key, default=[]):
+    '''
+        params can be a QueryDict or a logged APIRequestLog.query_params dict, where single values are not in a list
+    '''
+    if hasattr(params, "getlist"):
+        return params.getlist(key, default)
+    val = params.get(key)
+    if val is None:
+        return default
+    return val if isinstance(val, list) else [val]
+
+def activities_query(params, request=None):
+    '''
+        Returns the cache key and compute function for an activities list request, or (None, None) if it has nothing to search for
+    '''
+    days_ago = int(params.get("days_ago","0"))
+    if days_ago < 1 or days_ago > settings.ACTIVITY_INDEX_DAYS:
+        days_ago = None
+    org_uri = params.get("org_uri",None)
+    org_name = params.get("org_name",None)
+    types_to_keep = query_param_list(params, "type")
+    locations = query_param_list(params, 'location_id')
+    industry_search_str = query_param_list(params, 'industry_name')
+    industry_ids = query_param_list(params, 'industry_id', [None])
+
+    if org_uri is None and org_name is None and len(locations) == 0 and len(industry_search_str) == 0 and industry_ids == [None]:
+        return None, None
+    
+    cache_key = digest_cache_key(API_ACTIVITIES_KEYS, org_uri, org_name, days_ago, set(types_to_keep), set(locations),
+                                 set(industry_search_str), set(industry_ids))
+    fn = lambda: compute_activities(org_uri, org_name, days_ago, types_to_keep, locations, industry_search_str, industry_ids,
+                                    request=request)
+    return cache_key, fn
+
+def compute_activities(org_uri, org_name, days_ago, types_to_keep, locations, industry_search_str, industry_ids, request=None):
+    results_list = []
+    if org_uri is not None:
+        logger.debug(f"Uri: {org_uri}")
+        activities, days_ago, min_date, max_date = get_activities_by_org_with_fixed_or_expanding_date_range([org_uri], days_ago,
+                                                                                                           combine_same_as_name_only=True,
+                                                                                                           limit=100)
+        results_list.append(activities)
+    elif org_name is not None:
+        orgs_and_counts = search_organizations_by_name(org_name, combine_same_as_name_only=False, top_1_strict=True, request=request)
+        uris = [x.uri for x,_ in orgs_and_counts]
+        logger.debug(f"Uris: {uris}")
+        activities, days_ago, min_date, max_date = get_activities_by_org_with_fixed_or_expanding_date_range(uris,days_ago,combine_same_as_name_only=True,limit=100)
+        results_list.append(activities)
+    else:
+        geo_codes = set()
+        if days_ago is None:
+            days_ago = 30
+        min_date, max_date = min_and_max_date_based_on_days_ago(days_ago)            
+        for loc in locations:
+            geo_codes.update(geo_codes_for_region(loc))    
+        if flag_enabled("FEATURE_TYPESENSE",request=request):
+            logger.info("Using FEATURE_TYPESENSE")
+            for search_str in industry_search_str:
+                acts = activities_by_industry_text_and_or_geo_typesense(search_str, geo_codes, min_date, max_date)
+                results_list.append(acts)
+        else:
+            if len(industry_search_str) > 0:
+                industry_ids = set()
+                for search_str in industry_search_str:
+                    inds = [x.topicId for x in IndustryCluster.by_name(search_str,limit=3,request=request)]
+                    industry_ids.update(inds)
+            if len(geo_codes) == 0:
+                geo_codes = [None]
+            logger.debug(f"Industry ids: {industry_ids}, geo: {geo_codes}, {min_date} - {max_date}")
+            for industry_id_str in industry_ids:
+                if industry_id_str is not None:
+                    industry_id = int(industry_id_str)
+                else:
+                    industry_id = industry_id_str
+                for geo_code in geo_codes:
+                    acts = get_activities_by_industry_geo_and_date_range(industry_id, geo_code, min_date, max_date)
+                    results_list.append(acts)
+    return ActivityArticleResults.combine(results_list).unique_and_allowed_activity_types(types_to_keep)
+
+
 @extend_schema(
         summary="Activities",
         description=activity_docstring_raw
@@ -206,73 +290,17 @@ class GeoNamesViewSet(NeomodelViewSet):
 class ActivitiesViewSet(NeomodelViewSet):
 
     def get_queryset(self):
-        days_ago = int(self.request.query_params.get("days_ago","0"))
-        if days_ago not in [7,30,90]:
-            days_ago = None
-        org_uri = self.request.query_params.get("org_uri",None)
-        org_name = self.request.query_params.get("org_name",None)
-        types_to_keep = self.request.query_params.getlist("type",[])
-        locations = self.request.query_params.getlist('location_id',[])
-        industry_search_str = self.request.query_params.getlist('industry_name',[])
-        industry_ids = self.request.query_params.getlist('industry_id',[None])
-
-        if org_uri is None and org_name is None and len(locations) == 0 and len(industry_search_str) == 0 and industry_ids == [None]:
+        cache_key, fn = activities_query(self.request.query_params, self.request)
+        if cache_key is None:
             return None 
-        
-        cache_key = f"{org_uri}_{org_name}_{days_ago}_{types_to_keep}_{locations}_{industry_search_str}_{industry_ids}"
-
         if self.request.query_params.get("no_cache"):
             logger.info("Bypassing cache")
-        else:
-            res = get_versionable_cache(cache_key)
-            if res:
-                return res
-
-        if org_uri is not None:
-            logger.debug(f"Uri: {org_uri}")
-            activities, days_ago, min_date, max_date = get_activities_by_org_with_fixed_or_expanding_date_range([org_uri], days_ago,
-                                                                                                               combine_same_as_name_only=True,
-                                                                                                               limit=100)
-        elif org_name is not None:
-            orgs_and_counts = search_organizations_by_name(org_name, combine_same_as_name_only=False, top_1_strict=True, request=self.request)
-            uris = [x.uri for x,_ in orgs_and_counts]
-            logger.debug(f"Uris: {uris}")
-            activities, days_ago, min_date, max_date = get_activities_by_org_with_fixed_or_expanding_date_range(uris,days_ago,combine_same_as_name_only=True,limit=100)
-        else:
-            geo_codes = set()
-            if days_ago is None:
-                days_ago = 30
-            min_date, max_date = min_and_max_date_based_on_days_ago(days_ago)            
-            for loc in locations:
-                geo_codes.update(geo_codes_for_region(loc))    
-            activities = []        
-            if flag_enabled("FEATURE_TYPESENSE",request=self.request):
-                logger.info("Using FEATURE_TYPESENSE")
-                for search_str in industry_search_str:
-                    acts = activities_by_industry_text_and_or_geo_typesense(search_str, geo_codes, min_date, max_date)
-                    activities.extend(acts)
-            else:
-                if len(industry_search_str) > 0:
-                    industry_ids = set()
-                    for search_str in industry_search_str:
-                        inds = [x.topicId for x in IndustryCluster.by_name(search_str,limit=3,request=self.request)]
-                        industry_ids.update(inds)
-                if len(geo_codes) == 0:
-                    geo_codes = [None]
-                logger.debug(f"Industry ids: {industry_ids}, geo: {geo_codes}, {min_date} - {max_date}")
-                for industry_id_str in industry_ids:
-                    if industry_id_str is not None:
-                        industry_id = int(industry_id_str)
-                    else:
-                        industry_id = industry_id_str
-                    for geo_code in geo_codes:
-                        acts = get_activities_by_industry_geo_and_date_range(industry_id, geo_code, min_date, max_date)
-                        activities.extend(acts)
-        activities = filter_unique_records_and_allowed_activity_types(activities, types_to_keep)
-        acts = sorted(activities, key = lambda x: x['date_published'], reverse=True)
-        set_versionable_cache(cache_key, acts, timeout=3600)
-        return acts
-    
+            acts = fn()
+            set_versionable_cache(cache_key, acts, soft_timeout=3600, timeout=7200)
+            return acts
+        # Only the (activity, article, date) tuples are cached, rows are hydrated per page
+        return cached_compute(cache_key, fn, soft_timeout=3600, timeout=7200)
+
     def get_serializer_context(self):
          return {
             "request": self.request,
@@ -283,7 +311,8 @@ class ActivitiesViewSet(NeomodelViewSet):
         parameters=[
             OpenApiParameter(
                 name='days_ago',
-                description=('Show activities up to this many days old. Optional, but if provided must be one of: 7, 30, or 90. '
+                description=('Show activities up to this many days old. '
+                             f'Optional, but if provided must be between 1 and {settings.ACTIVITY_INDEX_DAYS}. '
                              'If not provided then: \n'
                              ' - when searching by organization, start with 7 days and then search for older stories if there are insufficient found (will try to find at least 3 stories)\n '
                              ' - when searching by industry, default it to 30 days'
@@ -436,4 +465,16 @@ class APITokenView(APIView):
         token_key = request.user.auth_token.key
         return Response({'token': token_key}, status=status.HTTP_200_OK)
 
+
+class CacheMetricsView(APIView):
+    '''
+        Hits, misses, bytes read and deserialize time per cache key family, summed across processes
+    '''
+    authentication_classes = [SessionAuthentication, FlexibleTokenAuthentication]
+    permission_classes = [IsAdminUser]
+
+    @extend_schema(exclude=True)
+    def get(self, request):
+        return Response(get_cache_metrics(), status=status.HTTP_200_OK)
+
  
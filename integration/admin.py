@@ -1,3 +1,31 @@
 from django.contrib import admin
+from integration.models import DataImport, ImportRun, ImportCheckpoint, ImportPhaseReport
 
-# Register your models here.
+
+@admin.register(DataImport)
+class DataImportAdmin(admin.ModelAdmin):
+    list_display = ["import_ts", "run_at", "creations", "deletions"]
+
+
+class ImportPhaseReportInline(admin.TabularInline):
+    model = ImportPhaseReport
+    fields = ["name", "started_at", "wall_time", "cypher_count", "cypher_time",
+              "nodes_created", "nodes_deleted", "relationships_created", "relationships_deleted", "properties_set",
+              "node_delta", "relationship_delta", "peak_rss_mb", "failed"]
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+class ImportCheckpointInline(admin.TabularInline):
+    model = ImportCheckpoint
+    fields = ["phase", "key", "count", "completed_at"]
+    readonly_fields = fields
+    extra = 0
+    can_delete = False
+
+
+@admin.register(ImportRun)
+class ImportRunAdmin(admin.ModelAdmin):
+    list_display = ["pk", "started_at", "completed_at"]
+    inlines = [ImportPhaseReportInline, ImportCheckpointInline]
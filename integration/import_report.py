@@ -0,0 +1,86 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import resource
+import time
+from integration.models import ImportPhaseReport
+from integration.neo4j_utils import count_nodes, count_relationships, import_query_totals, IMPORT_QUERY_COUNTERS
+
+import logging
+logger = logging.getLogger(__name__)
+
+ACTIVE_RUN = {"run": None}
+
+
+@contextmanager
+def reporting_run(run):
+    '''
+        Phases recorded while this is active are saved against run
+    '''
+    ACTIVE_RUN["run"] = run
+    try:
+        yield run
+    finally:
+        ACTIVE_RUN["run"] = None
+
+@contextmanager
+def record_phase(name):
+    '''
+        Saves an ImportPhaseReport for the wrapped code if a run is being reported on, otherwise does nothing.
+        Query counts, times and the nodes, relationships and properties created, deleted or set come from the
+        queries run through neo4j_utils.import_cypher_query, from any thread.
+        Node and relationship deltas are net changes (apoc.meta.stats before and after) from any query, so a phase that
+        deletes and creates the same number of nodes shows 0. Don't nest phases, the inner one resets the peak RSS.
+    '''
+    run = ACTIVE_RUN["run"]
+    if run is None:
+        yield
+        return
+    started_at = datetime.now(tz=timezone.utc)
+    nodes_before = count_nodes()
+    rels_before = count_relationships()
+    peak_rss_is_per_phase = reset_peak_rss()
+    totals_before = import_query_totals()
+    t1 = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        wall_time = time.perf_counter() - t1
+        totals = import_query_totals()
+        report = ImportPhaseReport.objects.create(
+            run = run,
+            name = name,
+            started_at = started_at,
+            wall_time = wall_time,
+            cypher_count = totals["count"] - totals_before["count"],
+            cypher_time = totals["time"] - totals_before["time"],
+            **{x: totals[x] - totals_before[x] for x in IMPORT_QUERY_COUNTERS},
+            node_delta = count_nodes() - nodes_before,
+            relationship_delta = count_relationships() - rels_before,
+            peak_rss_mb = peak_rss_mb(),
+            peak_rss_is_per_phase = peak_rss_is_per_phase,
+            failed = failed,
+        )
+        logger.info(f"Phase report: {report}")
+
+def reset_peak_rss():
+    '''
+        Linux lets a process reset its high water mark RSS, returns False if that isn't possible here
+    '''
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for row in f:
+                if row.startswith("VmHWM:"):
+                    return int(row.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # Peak for the whole process, KB on Linux
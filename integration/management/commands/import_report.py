@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from integration.models import ImportRun
+
+
+class Command(BaseCommand):
+    help = 'Show how long each phase of an import_ttl run took and what it changed, compared with the previous run'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--run_id',
+            type=int,
+            help='ImportRun to show, defaults to the latest'
+        )
+
+    def handle(self, *args, **options):
+        runs = ImportRun.objects.order_by("-started_at")
+        if options.get('run_id') is not None:
+            runs = runs.filter(started_at__lte=ImportRun.objects.get(pk=options['run_id']).started_at)
+        runs = list(runs[:2])
+        if len(runs) == 0:
+            self.stdout.write("No import runs recorded")
+            return
+        run = runs[0]
+        previous = {x.name: x for x in runs[1].phase_reports.all()} if len(runs) > 1 else {}
+        self.stdout.write(f"Run {run.pk} started {run.started_at}, completed {run.completed_at or '-'}")
+        self.stdout.write(f"{'phase':<60} {'secs':>9} {'prev':>9} {'queries':>9} {'query s':>9} "
+                          f"{'nodes +':>9} {'nodes -':>9} {'rels +':>9} {'rels -':>9} {'props':>9} {'RSS MB':>8}")
+        for report in run.phase_reports.all():
+            prev = previous.get(report.name)
+            self.stdout.write(f"{report.name[:60]:<60} {report.wall_time:>9.1f} "
+                              f"{fmt(prev.wall_time if prev else None):>9} {report.cypher_count:>9} "
+                              f"{report.cypher_time:>9.1f} {report.nodes_created:>9} {report.nodes_deleted:>9} "
+                              f"{report.relationships_created:>9} {report.relationships_deleted:>9} {report.properties_set:>9} "
+                              f"{fmt(report.peak_rss_mb):>8}{' FAILED' if report.failed else ''}")
+
+
+def fmt(val):
+    return "-" if val is None else f"{val:.1f}"
@@ -1,33 +1,48 @@
 from django.core.management.base import BaseCommand
 import os
 import subprocess
-from integration.models import DataImport
+from integration.models import DataImport, ImportRun, ImportCheckpoint
 from datetime import datetime, timezone
 from integration.neo4j_utils import (
-    setup_db_if_necessary, get_node_name_from_rdf_row,
-    get_internal_doc_ids_from_rdf_row, count_nodes,
+    setup_db_if_necessary, extract_ttl_metadata, count_nodes,
     flag_doc_ids_for_adding_to_typesense,
-    flag_doc_ids_for_removal_from_typesense,
+    flag_doc_ids_for_removal_from_typesense, import_cypher_query,
 )
 import time
 import logging
-from neomodel import db
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from neo4j.exceptions import TransientError
 from trackeditems.management.commands.send_recent_activities_email import do_send_recent_activities_email
-from syracuse.settings import RDF_SLEEP_TIME, RDF_DUMP_DIR, RDF_ARCHIVE_DIR
+from syracuse.settings import (RDF_SLEEP_TIME, RDF_DUMP_DIR, RDF_ARCHIVE_DIR,
+    RDF_IMPORT_WORKERS, RDF_IMPORT_COMMIT_SIZE, RDF_IMPORT_MAX_RETRIES)
 from pathlib import Path
 from topics.cache_helpers import refresh_geo_data
+from api.cache_warming import warm_cache_from_request_logs
 from integration.rdf_post_processor import RDFPostProcessor
+from integration.import_report import reporting_run, record_phase
 from auth_extensions.anon_user_utils import create_anon_user
-from integration.neo4j_utils import delete_and_clean_up_nodes_by_doc_id 
+from integration.neo4j_utils import delete_and_clean_up_nodes_by_doc_ids
 
 logger = logging.getLogger(__name__)
 PIDFILE="/tmp/syracuse-import-ttl.pid"
+TTL_SCAN_EXECUTOR = ThreadPoolExecutor(max_workers=RDF_IMPORT_WORKERS, thread_name_prefix="ttl-scan") # reads each file while n10s imports it
 
 def is_running(pidfile):
-    if os.path.exists(pidfile):
-        return True
-    else:
+    if not os.path.exists(pidfile):
         return False
+    try:
+        with open(pidfile, encoding='utf-8') as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+    except ValueError:
+        return True # Can't tell, so assume it is
+    except ProcessLookupError:
+        logger.warning(f"Removing stale {pidfile}, process {pid} is no longer running")
+        cleanup(pidfile)
+        return False
+    except PermissionError:
+        pass # Process exists but belongs to another user
+    return True
 
 def is_allowed_to_start(pidfile):
     if is_running(pidfile):
@@ -60,71 +75,187 @@ def move_files(src_dir,target_dir):
     logger.info(res)
 
 def load_ttl_files(dir_name,RDF_SLEEP_TIME,
-                    raise_on_error=True):
+                    raise_on_error=True, seen_doc_ids=None,
+                    workers=RDF_IMPORT_WORKERS, verbose=False, run=None):
+    '''
+        workers: number of insertion files loaded at the same time
+        verbose: log node counts (apoc.meta.stats) before and after every file
+        run: ImportRun to checkpoint each file against. Files it has already loaded are skipped.
+    '''
+    export_name = os.path.basename(os.path.normpath(dir_name))
     delete_dir = f"{dir_name}/deletions"
     count_of_creations = 0
     count_of_deletions = 0
     if os.path.isdir(delete_dir):
-        delete_files = [x for x in os.listdir(delete_dir) if x.endswith(".ttl")]
-        logger.info(f"Found {len(delete_files)} ttl files to delete, currenty have {count_nodes()} nodes")
+        delete_files = sorted([x for x in os.listdir(delete_dir) if x.endswith(".ttl")])
+        logger.info(f"Found {len(delete_files)} ttl files to delete")
+        done = run.completed_checkpoints(ImportCheckpoint.DELETE_FILE) if run is not None else {}
         for filename in delete_files:
+            key = f"{export_name}/deletions/{filename}"
+            if key in done:
+                logger.info(f"Already deleted {key}, skipping")
+                count_of_deletions += done[key].count
+                continue
             deletions = load_deletion_file(f"{delete_dir}/{filename}")
             count_of_deletions += deletions
-    logger.info(f"After running deletion files there are {count_nodes()} nodes")
+            if run is not None:
+                run.mark_done(ImportCheckpoint.DELETE_FILE, key, count=deletions)
+    if verbose is True:
+        logger.info(f"After running deletion files there are {count_nodes()} nodes")
     all_files = sorted([x for x in os.listdir(dir_name) if x.endswith(".ttl")])
     logger.info(f"Found {len(all_files)} ttl files to process")
     if len(all_files) == 0:
         logger.info("No insertion files to load, quitting")
         return 0, count_of_deletions
-    for filename in all_files:
-        creations = load_file(f"{dir_name}/{filename}",RDF_SLEEP_TIME,raise_on_error)
-        count_of_creations += creations
-    logger.info(f"After running insertion files there are {count_nodes()} nodes")
+    filepaths = {f"{export_name}/{filename}": f"{dir_name}/{filename}" for filename in all_files}
+    count_of_creations = load_insertion_files(filepaths, RDF_SLEEP_TIME, raise_on_error,
+                                              seen_doc_ids, workers, verbose, run)
+    if verbose is True:
+        logger.info(f"After running insertion files there are {count_nodes()} nodes")
     return count_of_creations, count_of_deletions
 
+def load_insertion_files(filepaths, RDF_SLEEP_TIME, raise_on_error, seen_doc_ids, workers, verbose, run=None):
+    '''
+        filepaths: dict of checkpoint key -> path
+        n10s merges nodes on uri, so files only depend on each other if they share subjects: the last file
+        to write a node's properties wins. Files that share subjects are loaded one after another in sorted order,
+        as a single worker would, and only unrelated files are loaded on separate sessions in parallel.
+        Returns count of subjects across all files. Checkpoints are written from this thread as each file finishes.
+    '''
+    done = run.completed_checkpoints(ImportCheckpoint.LOAD_FILE) if run is not None else {}
+    count = 0
+    for key in sorted(filepaths.keys() & done.keys()):
+        logger.info(f"Already loaded {key}, skipping")
+        count += done[key].count
+        if seen_doc_ids is not None:
+            seen_doc_ids.update(done[key].doc_ids)
+    to_load = sorted(key for key in filepaths.keys() if key not in done)
+
+    def file_loaded(key, creations, doc_ids):
+        if seen_doc_ids is not None:
+            seen_doc_ids.update(doc_ids)
+        if run is not None:
+            run.mark_done(ImportCheckpoint.LOAD_FILE, key, count=creations, doc_ids=doc_ids)
+        return creations
+
+    if workers <= 1 or len(to_load) <= 1:
+        for key in to_load:
+            doc_ids = set()
+            count += file_loaded(key, load_file(filepaths[key], RDF_SLEEP_TIME, raise_on_error, doc_ids, verbose), doc_ids)
+        return count
+    metadata = dict(zip(to_load, TTL_SCAN_EXECUTOR.map(extract_ttl_metadata, [filepaths[key] for key in to_load])))
+    chains = chains_of_files_sharing_subjects({key: metadata[key].uris for key in to_load})
+    logger.info(f"Loading {len(to_load)} files in {len(chains)} independent chains with {workers} workers")
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ttl-import")
+
+    def submit_next(chain):
+        key = chain.pop(0)
+        doc_ids = set()
+        future = executor.submit(load_file, filepaths[key], RDF_SLEEP_TIME, raise_on_error, doc_ids, verbose, metadata[key])
+        running[future] = (key, doc_ids, chain)
+
+    try:
+        running = {}
+        for chain in chains:
+            submit_next(chain)
+        while len(running) > 0:
+            finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in finished:
+                key, doc_ids, chain = running.pop(future)
+                count += file_loaded(key, future.result(), doc_ids)
+                if len(chain) > 0:
+                    submit_next(chain)
+        return count
+    finally:
+        executor.shutdown(cancel_futures=True) # After a failure don't start any more files
+
+def chains_of_files_sharing_subjects(uris_by_key):
+    '''
+        Groups files that share any subject uri, directly or through other files.
+        Returns a list of groups, each a list of keys in sorted order.
+    '''
+    parent = {key: key for key in uris_by_key.keys()}
+
+    def find(key):
+        while parent[key] != key:
+            parent[key] = parent[parent[key]]
+            key = parent[key]
+        return key
+
+    first_key_for_uri = {}
+    for key in sorted(uris_by_key.keys()):
+        for uri in uris_by_key[key]:
+            other = first_key_for_uri.setdefault(uri, key)
+            root, other_root = find(key), find(other)
+            if root != other_root:
+                parent[max(root, other_root)] = min(root, other_root)
+    chains = {}
+    for key in sorted(uris_by_key.keys()):
+        chains.setdefault(find(key), []).append(key)
+    return list(chains.values())
+
 def load_deletion_file(filepath):
     filepath = os.path.abspath(filepath)
     cnt = count_nodes()
-    doc_ids = set()
-    with open(filepath) as f:
-        for row in f.readlines():
-            doc_id = get_internal_doc_ids_from_rdf_row(row)
-            if doc_id is None:
-                continue
-            doc_ids.add(doc_id)
-            delete_and_clean_up_nodes_by_doc_id(doc_id)
+    doc_ids = extract_ttl_metadata(filepath).doc_ids
+    delete_and_clean_up_nodes_by_doc_ids(doc_ids)
     flag_doc_ids_for_removal_from_typesense(doc_ids)
     cnt2 = count_nodes()
     logger.info(f"Before deleting {cnt} nodes. After delete {filepath} {cnt2} nodes")
     return cnt2 - cnt
 
-def load_file(filepath,RDF_SLEEP_TIME, raise_on_error=True):
-    cnt = count_nodes()
-    filepath = os.path.abspath(filepath)
+def is_deadlock(res):
+    return "deadlock" in str(res[4]).lower()
+
+def import_rdf_file(filepath, commit_size=RDF_IMPORT_COMMIT_SIZE, max_retries=RDF_IMPORT_MAX_RETRIES):
+    '''
+        Parallel loads can deadlock on shared nodes (industries, locations, orgs mentioned in several docs).
+        n10s merges on uri so re-running the whole file is safe.
+    '''
     command = f"""CALL n10s.rdf.import.fetch("file://{filepath}","Turtle",
-                {{ predicateExclusionList : [ "https://1145.am/db/geoNamesRDF" ] }} );"""
+                {{ predicateExclusionList : [ "https://1145.am/db/geoNamesRDF" ], commitSize: {commit_size} }} );"""
     logger.info(f"Loading: {command}")
-    results,_ = db.cypher_query(command)
-    res = results[0] # row like ['KO', 0, 5025, None, 'Unexpected character U+FFFC at index 57: https://1145.am/db/techcrunchcom_2011_12_02_doo-net-gets-￼6-8m-to-reinvent-office-paperwork-oh-yes-2_ [line 5121]', {'singleTx': False}]
+    for attempt in range(max_retries + 1):
+        try:
+            results,_ = import_cypher_query(command)
+        except TransientError as e:
+            if attempt == max_retries:
+                raise
+            res = [None, None, None, None, e]
+        else:
+            res = results[0] # row like ['KO', 0, 5025, None, 'Unexpected character U+FFFC at index 57: https://1145.am/db/techcrunchcom_2011_12_02_doo-net-gets-￼6-8m-to-reinvent-office-paperwork-oh-yes-2_ [line 5121]', {'singleTx': False}]
+            if res[0] == 'OK' or not is_deadlock(res) or attempt == max_retries:
+                return command, res
+        logger.warning(f"Deadlock loading {filepath} (attempt {attempt + 1}), retrying: {res[4]}")
+        time.sleep(2 ** attempt)
+
+def load_file(filepath,RDF_SLEEP_TIME, raise_on_error=True, seen_doc_ids=None, verbose=True, metadata=None):
+    '''
+        seen_doc_ids: if provided, the internalDocIds in this file are added to it
+        metadata: TtlMetadata for this file if it has already been scanned
+    '''
+    if verbose is True:
+        cnt = count_nodes()
+    filepath = os.path.abspath(filepath)
+    if metadata is None:
+        metadata_future = TTL_SCAN_EXECUTOR.submit(extract_ttl_metadata, filepath)
+    command, res = import_rdf_file(filepath)
     if res[0] != 'OK':
         logger.error(f"{command}: {res}")
         if raise_on_error is True:
             raise ValueError(f"{command} failed with {res}")
-    doc_ids = set()
-    uris = set()
-    with open(filepath) as f:
-        for row in f.readlines():
-            doc_id = get_internal_doc_ids_from_rdf_row(row)
-            uri = get_node_name_from_rdf_row(row)
-            if doc_id is not None:
-                doc_ids.add(doc_id)
-            if uri is not None:
-                uris.add(uri)
+    if metadata is None:
+        metadata = metadata_future.result()
+    doc_ids = metadata.doc_ids
+    logger.info(f"{filepath} has {len(doc_ids)} docs, {len(metadata.uris)} subjects: {dict(metadata.type_counts)}")
     flag_doc_ids_for_adding_to_typesense(doc_ids)
-    cnt2 = count_nodes()
+    if seen_doc_ids is not None:
+        seen_doc_ids.update(doc_ids)
     time.sleep(RDF_SLEEP_TIME)
-    logger.info(f"Before importing {cnt} nodes. After importing {filepath} {cnt2} nodes")
-    return len(uris)
+    if verbose is True:
+        cnt2 = count_nodes()
+        logger.info(f"Before importing {cnt} nodes. After importing {filepath} {cnt2} nodes")
+    return len(metadata.uris)
    
 
 class Command(BaseCommand):
@@ -160,6 +291,14 @@ class Command(BaseCommand):
                 default=False,
                 action="store_true",
                 help="Just run post-processing (excluding stats calculation)")
+        parser.add_argument("-w","--workers",
+                default=RDF_IMPORT_WORKERS,
+                type=int,
+                help=f"Number of ttl files to load in parallel. Defaults to {RDF_IMPORT_WORKERS}")
+        parser.add_argument("-F","--full_refresh",
+                default=False,
+                action="store_true",
+                help="Recalculate all industry/geo stats and node degrees rather than just those touched by the newly imported docs")
 
     def handle(self, *args, **options):
         do_import_ttl(**options)
@@ -169,10 +308,6 @@ def do_import_ttl(**options):
     pidfile = options.get("pidfile",PIDFILE)
     force = options.get("force",False)
     dump_dir = options.get("dirname",RDF_DUMP_DIR)
-    do_archiving = options.get("do_archiving",True)
-    send_notifications = options.get("send_notifications",False)
-    do_post_processing = options.get("do_post_processing",True)
-    raise_on_error = options.get("raise_on_error",True)
     R = RDFPostProcessor()
     if force:
         cleanup(pidfile)
@@ -186,38 +321,86 @@ def do_import_ttl(**options):
         cleanup(pidfile)
         return None
     export_dirs = new_exports_to_import(dump_dir)
-    if len(export_dirs) == 0:
+    run = ImportRun.unfinished()
+    if run is not None and len(run.export_names()) == 0:
+        # Crashed before loading a single file, so there is nothing of its own to post-process or refresh.
+        # Its exports are still waiting to be imported and the new run picks them up
+        logger.info(f"Closing import run {run.pk} started at {run.started_at}, it hadn't loaded any files")
+        run.mark_complete()
+        run = None
+    if run is None and len(export_dirs) == 0:
         logger.info("No new TTL files to import")
         cleanup(pidfile)
         return None
     setup_db_if_necessary()
-    total_creations = 0
-    total_deletions = 0
-    for export_dir in export_dirs:
-        count_of_creations, count_of_deletions = load_ttl_files(
-                                                    export_dir,RDF_SLEEP_TIME,
-                                                    raise_on_error=raise_on_error)
-        di = DataImport(
-            run_at = datetime.now(tz=timezone.utc),
-            import_ts = os.path.basename(export_dir),
-            deletions = count_of_deletions,
-            creations = count_of_creations,
-        )
-        total_creations += count_of_creations
-        total_deletions += count_of_deletions
-        di.save()
-        if do_archiving is True:
-            logger.info(f"Archiving files from {export_dir} to {RDF_ARCHIVE_DIR}")
-            move_files(export_dir,RDF_ARCHIVE_DIR)
-    logger.info(f"Loaded {total_creations} creations and {total_deletions} deletions from {len(export_dirs)} directories")
-    if do_post_processing is True:
-        R.run_all_in_order()
-        _ = refresh_geo_data()
-        R.run_typesense_update()
-    if send_notifications is True and total_creations > 0:
-        do_send_recent_activities_email()
-    else:
-        logger.info("No email sending this time")
+    if run is not None:
+        # Only finish the crashed run's own work, anything that arrived since gets a run of its own
+        logger.info(f"Resuming import run {run.pk} started at {run.started_at}")
+        run_export_names = run.export_names()
+        resumed_dirs = [x for x in export_dirs if os.path.basename(x) in run_export_names]
+        do_import_run(run, resumed_dirs, R, **options)
+        export_dirs = [x for x in export_dirs if x not in resumed_dirs]
+    if len(export_dirs) > 0:
+        run = ImportRun.objects.create(started_at=datetime.now(tz=timezone.utc))
+        do_import_run(run, export_dirs, R, **options)
     logger.info("re-set cache")
     create_anon_user()
     cleanup(pidfile)
+
+def do_import_run(run, export_dirs, R, **options):
+    '''
+        Loads export_dirs and does everything after it for this run, skipping whatever run already has checkpoints for
+    '''
+    do_archiving = options.get("do_archiving",True)
+    send_notifications = options.get("send_notifications",False)
+    do_post_processing = options.get("do_post_processing",True)
+    raise_on_error = options.get("raise_on_error",True)
+    full_refresh = options.get("full_refresh",False)
+    workers = options.get("workers",RDF_IMPORT_WORKERS)
+    verbose = options.get("verbosity",1) > 1
+    with reporting_run(run):
+        for export_dir in export_dirs:
+            with record_phase(f"load {os.path.basename(export_dir)}"):
+                count_of_creations, count_of_deletions = load_ttl_files(
+                                                            export_dir,RDF_SLEEP_TIME,
+                                                            raise_on_error=raise_on_error,
+                                                            workers=workers, verbose=verbose,
+                                                            run=run)
+            di = DataImport(
+                run_at = datetime.now(tz=timezone.utc),
+                import_ts = os.path.basename(export_dir),
+                deletions = count_of_deletions,
+                creations = count_of_creations,
+            )
+            di.save()
+            if do_archiving is True:
+                logger.info(f"Archiving files from {export_dir} to {RDF_ARCHIVE_DIR}")
+                move_files(export_dir,RDF_ARCHIVE_DIR)
+        # Totals across the whole run, including export dirs loaded before a restart
+        total_creations = run.total_count(ImportCheckpoint.LOAD_FILE)
+        total_deletions = run.total_count(ImportCheckpoint.DELETE_FILE)
+        imported_doc_ids = run.loaded_doc_ids()
+        logger.info(f"Run {run.pk} loaded {total_creations} creations and {total_deletions} deletions")
+        if do_post_processing is True:
+            R.doc_ids = None if full_refresh is True else imported_doc_ids
+            R.run_all_in_order(completed_phases=run.completed_checkpoints(ImportCheckpoint.POST_PROCESSING),
+                               on_phase_complete=lambda name: run.mark_done(ImportCheckpoint.POST_PROCESSING, name))
+            if not run.is_done(ImportCheckpoint.REFRESH_GEO_DATA):
+                if full_refresh is True or total_deletions != 0:
+                    _ = refresh_geo_data(background_purge=True, before_activate=warm_cache_from_request_logs)
+                else:
+                    _ = refresh_geo_data(doc_ids=imported_doc_ids, background_purge=True,
+                                         before_activate=warm_cache_from_request_logs)
+                run.mark_done(ImportCheckpoint.REFRESH_GEO_DATA)
+            if not run.is_done(ImportCheckpoint.TYPESENSE_UPDATE):
+                with record_phase("typesense update"):
+                    R.run_typesense_update()
+                run.mark_done(ImportCheckpoint.TYPESENSE_UPDATE)
+        if run.is_done(ImportCheckpoint.NOTIFICATIONS):
+            logger.info("Notifications already sent for this run")
+        elif send_notifications is True and total_creations > 0:
+            do_send_recent_activities_email()
+            run.mark_done(ImportCheckpoint.NOTIFICATIONS)
+        else:
+            logger.info("No email sending this time")
+    run.mark_complete()
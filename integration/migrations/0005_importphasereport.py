@@ -0,0 +1,34 @@
+# Generated by Django 4.2.7 on 2026-10-17 11:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('integration', '0004_importrun_importcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportPhaseReport',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField()),
+                ('started_at', models.DateTimeField()),
+                ('wall_time', models.FloatField()),
+                ('cypher_count', models.IntegerField()),
+                ('cypher_time', models.FloatField()),
+                ('node_delta', models.IntegerField()),
+                ('relationship_delta', models.IntegerField()),
+                ('peak_rss_mb', models.FloatField(blank=True, null=True)),
+                ('peak_rss_is_per_phase', models.BooleanField(default=True)),
+                ('failed', models.BooleanField(default=False)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='phase_reports', to='integration.importrun')),
+            ],
+            options={
+                'ordering': ['started_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.7 on 2026-10-17 20:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('integration', '0005_importphasereport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importphasereport',
+            name='nodes_created',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='importphasereport',
+            name='nodes_deleted',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='importphasereport',
+            name='properties_set',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='importphasereport',
+            name='relationships_created',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='importphasereport',
+            name='relationships_deleted',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -30,3 +30,110 @@ class DataImport(models.Model):
         fmt = "%Y%m%d%H%M%S"
         d = datetime.strptime(str(ts),fmt)
         return d.astimezone(timezone.utc)
+
+
+class ImportRun(models.Model):
+    '''
+        One import_ttl run from loading the export dirs through to notifications. A run that crashed is left
+        with completed_at unset and the next run resumes it, skipping whatever it has checkpoints for.
+    '''
+
+    started_at = models.DateTimeField()
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-started_at']
+
+    @staticmethod
+    def unfinished():
+        return ImportRun.objects.filter(completed_at__isnull=True).order_by("-started_at").first()
+
+    def completed_checkpoints(self, phase):
+        return {x.key: x for x in self.checkpoints.filter(phase=phase)}
+
+    def is_done(self, phase, key=""):
+        return self.checkpoints.filter(phase=phase, key=key).exists()
+
+    def mark_done(self, phase, key="", count=0, doc_ids=None):
+        return ImportCheckpoint.objects.create(run=self, phase=phase, key=key, count=count,
+                                               doc_ids=sorted(doc_ids or []),
+                                               completed_at=datetime.now(tz=timezone.utc))
+
+    def mark_complete(self):
+        self.completed_at = datetime.now(tz=timezone.utc)
+        self.save()
+
+    def export_names(self):
+        '''
+            Export dirs this run has loaded at least one file from, checkpoint keys start with the dir name
+        '''
+        checkpoints = self.checkpoints.filter(phase__in=[ImportCheckpoint.DELETE_FILE, ImportCheckpoint.LOAD_FILE])
+        return set(x.key.split("/")[0] for x in checkpoints)
+
+    def loaded_doc_ids(self):
+        doc_ids = set()
+        for checkpoint in self.checkpoints.filter(phase=ImportCheckpoint.LOAD_FILE):
+            doc_ids.update(checkpoint.doc_ids)
+        return doc_ids
+
+    def total_count(self, phase):
+        return sum(x.count for x in self.checkpoints.filter(phase=phase))
+
+
+class ImportCheckpoint(models.Model):
+    '''
+        A unit of work an ImportRun has finished: a ttl file (key is export dir/file name),
+        a post-processing phase (key is the phase name) or one of the later steps.
+    '''
+    DELETE_FILE = "delete_file"
+    LOAD_FILE = "load_file"
+    POST_PROCESSING = "post_processing"
+    REFRESH_GEO_DATA = "refresh_geo_data"
+    TYPESENSE_UPDATE = "typesense_update"
+    NOTIFICATIONS = "notifications"
+
+    run = models.ForeignKey(ImportRun, on_delete=models.CASCADE, related_name="checkpoints")
+    phase = models.TextField()
+    key = models.TextField(default="")
+    count = models.IntegerField(default=0) # creations or deletions from a ttl file
+    doc_ids = models.JSONField(default=list) # internalDocIds loaded from a ttl file
+    completed_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint("run", "phase", "key", name="unique_run_phase_key")
+        ]
+        ordering = ['completed_at']
+
+
+class ImportPhaseReport(models.Model):
+    '''
+        Timings and graph changes for one phase of an ImportRun, see integration.import_report
+    '''
+
+    run = models.ForeignKey(ImportRun, on_delete=models.CASCADE, related_name="phase_reports")
+    name = models.TextField()
+    started_at = models.DateTimeField()
+    wall_time = models.FloatField() # seconds
+    cypher_count = models.IntegerField() # queries run through neo4j_utils.import_cypher_query
+    cypher_time = models.FloatField() # seconds spent in those queries, summed across threads
+    nodes_created = models.IntegerField(default=0) # From the driver's result summaries of those queries
+    nodes_deleted = models.IntegerField(default=0)
+    relationships_created = models.IntegerField(default=0)
+    relationships_deleted = models.IntegerField(default=0)
+    properties_set = models.IntegerField(default=0)
+    node_delta = models.IntegerField() # Net change in apoc.meta.stats, includes changes made by any other query
+    relationship_delta = models.IntegerField()
+    peak_rss_mb = models.FloatField(null=True, blank=True)
+    peak_rss_is_per_phase = models.BooleanField(default=True) # False if only the process-wide peak was available
+    failed = models.BooleanField(default=False)
+
+    class Meta:
+        ordering = ['started_at']
+
+    def __str__(self):
+        return (f"{self.name}: {self.wall_time:.1f}s, {self.cypher_count} queries in {self.cypher_time:.1f}s, "
+                f"nodes +{self.nodes_created}/-{self.nodes_deleted} (net {self.node_delta:+}), "
+                f"relationships +{self.relationships_created}/-{self.relationships_deleted} (net {self.relationship_delta:+}), "
+                f"{self.properties_set} properties set, peak RSS {self.peak_rss_mb or 0:.0f}MB"
+                f"{' (failed)' if self.failed else ''}")
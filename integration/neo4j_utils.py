@@ -1,17 +1,65 @@
 import logging
+from django.conf import settings
 from neomodel import db
 import re
+import threading
 import time
 from topics.models import Resource
 from collections import defaultdict
 
 logger = logging.getLogger(__name__)
 
+IMPORT_QUERY_COUNTERS = ["nodes_created", "nodes_deleted", "relationships_created", "relationships_deleted", "properties_set"]
+IMPORT_QUERY_STATS = {"count": 0, "time": 0.0, **{x: 0 for x in IMPORT_QUERY_COUNTERS}}
+IMPORT_QUERY_STATS_LOCK = threading.Lock()
+CONNECT_LOCK = threading.Lock()
+
+def import_cypher_query(query, params=None):
+    '''
+        As db.cypher_query (without resolve_objects) for the queries that make up an import. Their time and the
+        changes counted in the driver's result summary are added to import_query_totals, for integration.import_report.
+        Each query runs in its own auto-commit session on the default database (NEOMODEL_NEO4J_BOLT_URL doesn't name one),
+        so this must not be used inside db.transaction: the query would neither see nor roll back with the transaction's changes.
+    '''
+    ensure_driver()
+    t1 = time.perf_counter()
+    counters = None
+    try:
+        with db.driver.session() as session:
+            result = session.run(query, params or {})
+            rows = [list(record.values()) for record in result]
+            meta = result.keys()
+            counters = result.consume().counters
+        return rows, meta
+    finally:
+        elapsed = time.perf_counter() - t1
+        with IMPORT_QUERY_STATS_LOCK:
+            IMPORT_QUERY_STATS["count"] += 1
+            IMPORT_QUERY_STATS["time"] += elapsed
+            if counters is not None:
+                for counter in IMPORT_QUERY_COUNTERS:
+                    IMPORT_QUERY_STATS[counter] += getattr(counters, counter)
+
+def ensure_driver():
+    '''
+        db.cypher_query connects on first use, but import_cypher_query goes to the driver directly
+    '''
+    if db.driver is not None:
+        return
+    with CONNECT_LOCK:
+        if db.driver is None:
+            db.set_connection(settings.NEOMODEL_NEO4J_BOLT_URL)
+
+def import_query_totals():
+    with IMPORT_QUERY_STATS_LOCK:
+        return dict(IMPORT_QUERY_STATS)
+
 def setup_db_if_necessary():
     db.cypher_query("CREATE CONSTRAINT n10s_unique_uri IF NOT EXISTS FOR (r:Resource) REQUIRE r.uri IS UNIQUE;")
     db.cypher_query("CREATE INDEX node_internal_doc_id_index IF NOT EXISTS FOR (n:Resource) on (n.internalDocId)")
     db.cypher_query("CREATE INDEX resource_internal_id IF NOT EXISTS FOR (n:Resource) on (n.internalId)")
     db.cypher_query("CREATE INDEX node_merged_same_as_high_to_uri IF NOT EXISTS FOR (n:Resource) on (n.internalMergedSameAsHighToUri)")
+    db.cypher_query("CREATE INDEX resource_internal_degree IF NOT EXISTS FOR (n:Resource) on (n.internalDegree)")
     db.cypher_query("CREATE INDEX component_id IF NOT EXISTS FOR (n: Organization) on (n.componentId)")
     db.cypher_query("CREATE FULLTEXT INDEX resource_names IF NOT EXISTS FOR (r:Resource) ON EACH [r.name]")
     db.cypher_query("CREATE FULLTEXT INDEX organization_clean_name IF NOT EXISTS FOR (r:Organization) ON EACH [r.internalCleanName]")
@@ -60,74 +108,192 @@ def do_n10s_config(overwrite=False):
 def rerun_all_redundant_same_as():
     apoc_query_unset_flag = '''CALL apoc.periodic.iterate("MATCH (n1:Resource) WHERE n1.deletedRedundantSameAsAt IS NOT NULL RETURN *","REMOVE n1.deletedRedundantSameAsAt",{batchSize: 1000, parallel: true})'''
     logger.info("Unsetting all deletedRedundantSameAsAt flags")
-    db.cypher_query(apoc_query_unset_flag)
+    import_cypher_query(apoc_query_unset_flag)
     apoc_del_redundant_same_as()
 
 def apoc_del_redundant_same_as():
     ts = time.time()
     output_same_as_stats("Before apoc_del_redundant_same_as")
     apoc_query_high = f'CALL apoc.periodic.iterate("MATCH (n1:Resource)-[r1:sameAsHigh]->(n2:Resource)-[r2:sameAsHigh]->(n1) where elementId(n1) < elementId(n2) AND n1.deletedRedundantSameAsAt IS NULL AND n2.deletedRedundantSameAsAt IS NULL RETURN *","DELETE r2",{{}})'
-    db.cypher_query(apoc_query_high)
+    import_cypher_query(apoc_query_high)
     apoc_query_set_flag = f'''CALL apoc.periodic.iterate("MATCH (n1:Resource) WHERE n1.deletedRedundantSameAsAt IS NULL RETURN *","SET n1.deletedRedundantSameAsAt = {ts}",{{batchSize: 1000, parallel: true}})'''
-    db.cypher_query(apoc_query_set_flag)
+    import_cypher_query(apoc_query_set_flag)
     output_same_as_stats("After apoc_del_redundant_same_as")
 
 def delete_all_not_needed_resources():
     query = """MATCH (n: Resource) WHERE n.uri CONTAINS 'https://1145.am/db/'
             AND SIZE(LABELS(n)) = 1
             CALL {WITH n DETACH DELETE n} IN TRANSACTIONS OF 10000 ROWS;"""
-    db.cypher_query(query)
+    import_cypher_query(query)
 
 def output_same_as_stats(msg):
     high = "MATCH (n1)-[r:sameAsHigh]-(n2)"
     same_as_high_count,_ = db.cypher_query(high + " RETURN COUNT(r)")
     logger.info(f"{msg} sameAsHigh: {same_as_high_count[0][0]}")
 
+INTERNAL_DOC_ID_PATTERN = re.compile(r"^[ \t]+ns1:internalDocId\s(\d+)", re.MULTILINE)
+SUBJECT_PATTERN = re.compile(r"^<(https://\S.+)> a ([^;\n]+)", re.MULTILINE)
+TTL_READ_CHUNK_SIZE = 4 * 1024 * 1024
+
 def get_internal_doc_ids_from_rdf_row(row):
-    res = re.findall(r"^\s+ns1:internalDocId\s(\d+)", row)
-    if len(res) > 0:
-        return int(res[0])
+    res = INTERNAL_DOC_ID_PATTERN.search(row)
+    if res is not None:
+        return int(res.group(1))
     else:
         return None
 
 def get_node_name_from_rdf_row(row):
-    res = re.findall(r"^<(https://\S.+)> a", row)
-    if len(res) > 0:
-        return res[0]
+    res = SUBJECT_PATTERN.search(row)
+    if res is not None:
+        return res.group(1)
     else:
         return None
 
+class TtlMetadata:
+
+    def __init__(self):
+        self.doc_ids = set()
+        self.uris = set()
+        self.type_counts = defaultdict(int)
+
+    def scan(self, text):
+        self.doc_ids.update(int(x) for x in INTERNAL_DOC_ID_PATTERN.findall(text))
+        for uri, types in SUBJECT_PATTERN.findall(text):
+            self.uris.add(uri)
+            for node_type in types.split(","):
+                self.type_counts[node_type.strip().split(":")[-1]] += 1
+
+def extract_ttl_metadata(filepath, chunk_size=TTL_READ_CHUNK_SIZE):
+    '''
+        Reads the file once, a chunk at a time, so big dumps don't need to fit in memory.
+        Each chunk is cut at its last newline so no line is split between chunks.
+    '''
+    metadata = TtlMetadata()
+    remainder = ""
+    with open(filepath, encoding="utf-8") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if chunk == "":
+                break
+            text = remainder + chunk
+            last_newline = text.rfind("\n")
+            if last_newline < 0:
+                remainder = text
+                continue
+            metadata.scan(text[:last_newline + 1])
+            remainder = text[last_newline + 1:]
+    metadata.scan(remainder)
+    return metadata
+
 def delete_and_clean_up_nodes_by_doc_id(doc_id):
-    nodes_to_delete = Resource.nodes.filter(internalDocId=doc_id)
-    nodes_to_delete = dependency_sort(nodes_to_delete)
-    for node in nodes_to_delete:
-        node.delete_node_and_related()
-
-def dependency_sort(orgs):
-    """Process items in waves: first no deps, then their dependents, etc."""
-    remaining = list(orgs)
-    sorted_result = []
-    processed_uris = set()
-    all_my_uris = {t.uri for t in orgs}
-    
-    while remaining:
-        # Find items whose dependencies are already processed, have no deps, 
-        # OR depend on external URIs (not in our tuple set)
-        ready = [t for t in remaining if 
-                 t.internalMergedSameAsHighToUri is None or 
-                 t.internalMergedSameAsHighToUri in processed_uris or
-                 t.internalMergedSameAsHighToUri not in all_my_uris]  # External dependency
-        
-        if not ready:
-            # Circular dependency
-            sorted_result.extend(remaining)
-            break
-        
-        sorted_result.extend(ready)
-        processed_uris.update(t.uri for t in ready)
-        remaining = [t for t in remaining if t not in ready]
-    
-    return sorted_result[::-1]
+    delete_and_clean_up_nodes_by_doc_ids([doc_id])
+
+def delete_and_clean_up_nodes_by_doc_ids(doc_ids, batch_size=1000):
+    '''
+        Set-based equivalent of delete_node_and_related for every node in these docs: a handful of
+        batched queries however many nodes there are, rather than several queries per node and merge hop.
+        Nodes that were merged into a deleted node are unmerged and their docs flagged for re-adding to Typesense.
+    '''
+    doc_ids = list(doc_ids)
+    vals, _ = import_cypher_query("""MATCH (n: Resource) WHERE n.internalDocId IN $doc_ids
+                                 RETURN n.uri, n.internalMergedSameAsHighToUri""", {"doc_ids": doc_ids})
+    if len(vals) == 0:
+        return
+    to_delete = set(uri for uri, _ in vals)
+    merged_into = get_merge_chains({uri: merged_into for uri, merged_into in vals})
+    merged_uris = [uri for uri, merged_into in vals if merged_into is not None]
+    decrements = weight_decrements(to_delete, merged_into, merged_uris, batch_size)
+    apply_weight_decrements(decrements, batch_size)
+    neighbour_uris = neighbours_of(to_delete, batch_size) | set(x for key in decrements.keys() for x in (key[0], key[2]))
+    unmerged_doc_ids = unmerge_nodes_merged_into(to_delete, batch_size) - set(doc_ids)
+    flag_doc_ids_for_adding_to_typesense(unmerged_doc_ids)
+    for batch in batched(list(to_delete), batch_size):
+        import_cypher_query("UNWIND $uris AS uri MATCH (n: Resource {uri: uri}) DETACH DELETE n", {"uris": batch})
+    update_node_degrees_for_uris(neighbour_uris - to_delete, batch_size)
+    logger.info(f"Deleted {len(to_delete)} nodes from {len(doc_ids)} docs, unmerged nodes from {len(unmerged_doc_ids)} other docs")
+
+def update_node_degrees_for_uris(uris, batch_size=1000):
+    query = """UNWIND $uris AS uri
+               MATCH (n: Resource {uri: uri})
+               WITH n, apoc.node.degree(n) AS degree
+               WHERE n.internalDegree IS NULL OR n.internalDegree <> degree
+               SET n.internalDegree = degree"""
+    for batch in batched(list(uris), batch_size):
+        import_cypher_query(query, {"uris": batch})
+
+def batched(vals, batch_size):
+    for idx in range(0, len(vals), batch_size):
+        yield vals[idx:idx + batch_size]
+
+def neighbours_of(uris, batch_size):
+    neighbour_uris = set()
+    for batch in batched(list(uris), batch_size):
+        vals, _ = import_cypher_query("""MATCH (n: Resource)--(m: Resource) WHERE n.uri IN $uris
+                                     RETURN DISTINCT m.uri""", {"uris": batch})
+        neighbour_uris.update(x[0] for x in vals)
+    return neighbour_uris
+
+def get_merge_chains(merged_into):
+    '''
+        Extends uri -> internalMergedSameAsHighToUri with the rest of each merge chain, one query per hop
+    '''
+    to_fetch = set(x for x in merged_into.values() if x is not None) - merged_into.keys()
+    while len(to_fetch) > 0:
+        vals, _ = import_cypher_query("""MATCH (n: Resource) WHERE n.uri IN $uris
+                                     RETURN n.uri, n.internalMergedSameAsHighToUri""", {"uris": list(to_fetch)})
+        found = dict(vals)
+        for uri in to_fetch:
+            merged_into[uri] = found.get(uri)
+        to_fetch = set(x for x in found.values() if x is not None) - merged_into.keys()
+    return merged_into
+
+def weight_decrements(to_delete, merged_into, merged_uris, batch_size):
+    '''
+        Weight each deleted merged node contributed to the relationships of the nodes further up its merge chain.
+        Stops at the first ancestor that is also being deleted: that ancestor's weights already include this node's.
+    '''
+    decrements = defaultdict(int)
+    query = """MATCH (n: Resource)-[rel]-(other: Resource) WHERE n.uri IN $uris
+               AND NOT type(rel) IN ['sameAsHigh', 'sameAsNameOnly']
+               RETURN n.uri, type(rel), rel.weight, other.uri"""
+    for batch in batched(merged_uris, batch_size):
+        vals, _ = import_cypher_query(query, {"uris": batch})
+        for uri, rel_type, weight, other_uri in vals:
+            if other_uri in to_delete or weight is None:
+                continue
+            seen = set([uri])
+            node_uri = merged_into.get(uri)
+            while node_uri is not None and node_uri not in to_delete and node_uri not in seen:
+                seen.add(node_uri)
+                decrements[(node_uri, rel_type, other_uri)] += weight
+                node_uri = merged_into.get(node_uri)
+    return decrements
+
+def apply_weight_decrements(decrements, batch_size):
+    query = """UNWIND $rows AS row
+               MATCH (n: Resource {uri: row[0]})-[rel]-(other: Resource {uri: row[2]})
+               WHERE type(rel) = row[1]
+               WITH row, rel, rel.weight - row[3] AS new_weight
+               FOREACH (_ IN CASE WHEN new_weight <= 0 THEN [1] ELSE [] END | DELETE rel)
+               FOREACH (_ IN CASE WHEN new_weight > 0 THEN [1] ELSE [] END | SET rel.weight = new_weight)
+               WITH row, new_weight WHERE new_weight < 0
+               RETURN row, new_weight"""
+    rows = [[uri, rel_type, other_uri, weight] for (uri, rel_type, other_uri), weight in decrements.items()]
+    for batch in batched(rows, batch_size):
+        vals, _ = import_cypher_query(query, {"rows": batch})
+        for row, new_weight in vals:
+            logger.warning(f"new weight is {new_weight} for {row}")
+
+def unmerge_nodes_merged_into(uris, batch_size):
+    query = """UNWIND $uris AS uri
+               MATCH (m: Resource {internalMergedSameAsHighToUri: uri})
+               SET m.internalMergedSameAsHighToUri = NULL
+               RETURN m.uri, m.internalDocId"""
+    doc_ids = set()
+    for batch in batched(list(uris), batch_size):
+        vals, _ = import_cypher_query(query, {"uris": batch})
+        doc_ids.update(doc_id for uri, doc_id in vals if uri not in uris and doc_id is not None)
+    return doc_ids
 
 
 def count_relationships():
@@ -232,7 +398,7 @@ def flag_doc_ids_for_adding_to_typesense(doc_ids):
             MERGE (:TmpDocIdForLoadToTypesense {internalDocId: docid})
         } IN TRANSACTIONS OF 1000 ROWS
     """
-    _ = db.cypher_query(query, {'doc_ids':list(doc_ids)})
+    _ = import_cypher_query(query, {'doc_ids':list(doc_ids)})
 
 def flag_doc_ids_for_removal_from_typesense(doc_ids):
     query = """UNWIND $doc_ids AS docid
@@ -241,4 +407,4 @@ def flag_doc_ids_for_removal_from_typesense(doc_ids):
             MERGE (:TmpDocIdForDeleteFromTypesense {internalDocId: docid})
         } IN TRANSACTIONS OF 1000 ROWS
     """
-    _ = db.cypher_query(query, {'doc_ids':list(doc_ids)})
+    _ = import_cypher_query(query, {'doc_ids':list(doc_ids)})
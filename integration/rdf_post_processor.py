@@ -3,18 +3,29 @@ from topics.models.models_extras import add_dynamic_classes_for_multiple_labels
 from neomodel import db
 import logging
 from integration.neo4j_utils import (count_relationships, apoc_del_redundant_same_as, get_all_activities_to_merge,
-        rerun_all_redundant_same_as
+        rerun_all_redundant_same_as, get_merge_chains, update_node_degrees_for_uris, import_cypher_query
 )
 from integration.embedding_utils import create_new_embeddings
 import time
+from collections import defaultdict
 from typing import Tuple, Union
 from topics.services.typesense_service import add_by_internal_doc_ids, delete_by_internal_doc_ids
 from django.conf import settings
+from topics.merge_targets import build_merge_targets, save_merge_targets
+from syracuse.cache_util import get_active_version
+from integration.import_report import record_phase
 
 logger = logging.getLogger(__name__)
 
 class RDFPostProcessor(object):
 
+    def __init__(self, doc_ids=None):
+        '''
+            doc_ids: internalDocIds loaded by this import, so that phases which can work incrementally only
+                     touch the nodes they affect. None means process the whole graph.
+        '''
+        self.doc_ids = doc_ids
+
     GCC_CREATE_SAME_AS="""CALL gds.graph.project(
         'sameAsGraph',
         'Organization',
@@ -37,29 +48,42 @@ class RDFPostProcessor(object):
         RETURN *
     """
 
-    def run_all_in_order(self):
-        write_log_header("Creating multi-inheritance classes")
-        add_dynamic_classes_for_multiple_labels(ignore_cache=True)
-        write_log_header("del_redundant_same_as")
-        apoc_del_redundant_same_as()
-        write_log_header("delete_self_relationships")
-        self.delete_self_relationships()
-        write_log_header("add_document_extract_to_relationship")
-        self.add_document_extract_to_relationship()
-        write_log_header("Set default weighting to 1")
-        self.add_weighting_to_relationship()
-        write_log_header("Creating multi-inheritance classes")
-        add_dynamic_classes_for_multiple_labels(ignore_cache=True)
-        write_log_header("merge_equivalent_activities")
-        self.merge_equivalent_activities()
-        write_log_header("merge_same_as_high_connections")
-        self.merge_same_as_high_connections()
-        write_log_header("redundant same_as")
-        rerun_all_redundant_same_as()
-        write_log_header("adding embeddings")
-        create_new_embeddings()
-        write_log_header("adding unique resource ids")
-        add_resource_ids()
+    def phases(self):
+        '''
+            (name, fn, checkpointed). Phases that only set up in-process state are not checkpointed,
+            they have to run again in a resumed process.
+        '''
+        return [
+            ("Creating multi-inheritance classes", lambda: add_dynamic_classes_for_multiple_labels(ignore_cache=True), False),
+            ("del_redundant_same_as", apoc_del_redundant_same_as, True),
+            ("delete_self_relationships", self.delete_self_relationships, True),
+            ("add_document_extract_to_relationship", self.add_document_extract_to_relationship, True),
+            ("Set default weighting to 1", self.add_weighting_to_relationship, True),
+            ("Re-creating multi-inheritance classes", lambda: add_dynamic_classes_for_multiple_labels(ignore_cache=True), False),
+            ("merge_equivalent_activities", self.merge_equivalent_activities, True),
+            ("merge_same_as_high_connections", self.merge_same_as_high_connections, True),
+            ("redundant same_as", rerun_all_redundant_same_as, True),
+            ("updating merge targets", update_merge_targets, True),
+            ("adding embeddings", create_new_embeddings, True),
+            ("adding unique resource ids", add_resource_ids, True),
+            ("updating node degrees", lambda: update_node_degrees(self.doc_ids), True),
+            ("updating same as name only neighbours", update_same_as_name_only_neighbours, True),
+        ]
+
+    def run_all_in_order(self, completed_phases=(), on_phase_complete=None):
+        '''
+            completed_phases: names of checkpointed phases to skip, e.g. when resuming a crashed import
+            on_phase_complete: called with the phase name after each checkpointed phase finishes
+        '''
+        for name, fn, checkpointed in self.phases():
+            if checkpointed is True and name in completed_phases:
+                write_log_header(f"{name} (already done, skipping)")
+                continue
+            write_log_header(name)
+            with record_phase(f"post_processing: {name}"):
+                fn()
+            if checkpointed is True and on_phase_complete is not None:
+                on_phase_complete(name)
 
     def run_typesense_update(self):
         # Has to run after geonames data is updated
@@ -95,16 +119,16 @@ class RDFPostProcessor(object):
             }}
             IN TRANSACTIONS OF 10000 ROWS;
             """
-        db.cypher_query(query)
+        import_cypher_query(query)
 
     def delete_self_relationships(self):
-        res, _ = db.cypher_query(self.QUERY_SELF_RELATIONSHIP)
+        res, _ = import_cypher_query(self.QUERY_SELF_RELATIONSHIP)
         logger.info(f"Deleted {len(res)} self-relationships")
 
     def merge_same_as_high_connections(self):
-        _ = db.cypher_query("CALL gds.graph.drop('sameAsGraph', false)") # just in case it's still there
-        _ = db.cypher_query(self.GCC_CREATE_SAME_AS)
-        _ = db.cypher_query(self.GCC_WRITE_SAME_AS_COMPONENTS)
+        _ = import_cypher_query("CALL gds.graph.drop('sameAsGraph', false)") # just in case it's still there
+        _ = import_cypher_query(self.GCC_CREATE_SAME_AS)
+        _ = import_cypher_query(self.GCC_WRITE_SAME_AS_COMPONENTS)
         component_id_query = """
             MATCH (n:Resource&Organization) 
             WHERE n.componentId IS NOT NULL
@@ -112,12 +136,12 @@ class RDFPostProcessor(object):
             WITH n.componentId AS componentId, COUNT(n) AS orgCount
             WHERE orgCount >= 2
             RETURN componentId"""
-        components, _ = db.cypher_query(component_id_query)
+        components, _ = import_cypher_query(component_id_query)
         logger.info(f"Found {len(components)} components for merging")
         for row in components:
             component = row[0]
             self.merge_component(component)
-        _ = db.cypher_query("CALL gds.graph.drop('sameAsGraph')")
+        _ = import_cypher_query("CALL gds.graph.drop('sameAsGraph')")
 
     def merge_component(self, component_id):
         source_nodes, target_node = get_nodes_for_component(component_id)
@@ -163,7 +187,7 @@ class RDFPostProcessor(object):
             }
             IN TRANSACTIONS OF 10000 ROWS;
             """
-        db.cypher_query(query)
+        import_cypher_query(query)
 
     def add_weighting_to_relationship(self):
         logger.info("Adding weighting to relationship")
@@ -175,7 +199,7 @@ class RDFPostProcessor(object):
             "SET rel.weight = 1",
             {batchSize:1000, parallel:true, retries: 5})
         """
-        db.cypher_query(apoc_query)
+        import_cypher_query(apoc_query)
 
     def add_new_nodes_to_typesense(self):
         cnt = 0
@@ -209,7 +233,7 @@ class RDFPostProcessor(object):
     
 def add_batch_of_new_nodes_to_typesense(limit=1000):
     query = f"MATCH (n: TmpDocIdForLoadToTypesense) WITH n LIMIT {limit} WITH n, n.internalDocId AS internalDocId DELETE n RETURN internalDocId"
-    rows, _ = db.cypher_query(query)
+    rows, _ = import_cypher_query(query)
     doc_ids = [x[0] for x in rows]
     if len(doc_ids) == 0:
         return None
@@ -222,7 +246,7 @@ def add_batch_of_new_nodes_to_typesense(limit=1000):
         
 def delete_batch_of_nodes_from_typesense(limit=1000):
     query = f"MATCH (n: TmpDocIdForDeleteFromTypesense) WITH n LIMIT {limit} WITH n, n.internalDocId AS internalDocId DELETE n RETURN internalDocId"
-    rows, _ = db.cypher_query(query)
+    rows, _ = import_cypher_query(query)
     doc_ids = [x[0] for x in rows]
     if len(doc_ids) == 0:
         return None
@@ -264,17 +288,87 @@ def add_resource_ids():
     query = "MATCH (n: Resource) WHERE n.internalId IS NULL RETURN n"
     action = "SET n.internalId = ID(n)"
     apoc_query = f'CALL apoc.periodic.iterate("{query}","{action}",{{batchSize:1000, parallel:true, retries: 5}})'
-    db.cypher_query(apoc_query)
+    import_cypher_query(apoc_query)
     # Now see if there are any duplicates
     logger.info("Set initial ids, checking for duplicates")
     update_duplicated_resource_ids()
 
+def update_node_degrees(doc_ids=None):
+    '''
+    Store each node's degree as internalDegree so sorting and org lists don't need a query per node.
+    Only writes nodes whose degree has changed since the last run.
+    doc_ids: only update the nodes from these docs, their neighbours and the nodes they are merged into.
+             Neighbours of deleted nodes are updated when they are deleted (delete_and_clean_up_nodes_by_doc_ids).
+    '''
+    if doc_ids is not None:
+        update_node_degrees_for_uris(uris_touched_by_doc_ids(doc_ids))
+        return
+    query = "MATCH (n: Resource) WITH n, apoc.node.degree(n) AS degree WHERE n.internalDegree IS NULL OR n.internalDegree <> degree RETURN n, degree"
+    action = "SET n.internalDegree = degree"
+    apoc_query = f'CALL apoc.periodic.iterate("{query}","{action}",{{batchSize:1000, parallel:true, retries: 5}})'
+    import_cypher_query(apoc_query)
+
+def uris_touched_by_doc_ids(doc_ids):
+    query = """MATCH (n: Resource) WHERE n.internalDocId IN $doc_ids
+               OPTIONAL MATCH (n)--(m: Resource)
+               RETURN n.uri, n.internalMergedSameAsHighToUri, collect(DISTINCT m.uri)"""
+    vals, _ = import_cypher_query(query, {"doc_ids": list(doc_ids)})
+    uris = set()
+    for uri, _, neighbour_uris in vals:
+        uris.add(uri)
+        uris.update(neighbour_uris)
+    merged_into = get_merge_chains({uri: merged_into for uri, merged_into, _ in vals}) # Targets gain merged nodes' relationships
+    uris.update(x for x in merged_into.values() if x is not None)
+    return uris
+
+def update_merge_targets():
+    '''
+    Replace the live version's merge target map so that reads pick up the merges just made without going to Neo4j.
+    refresh_geo_data builds the map again for the version it is preparing.
+    '''
+    save_merge_targets(build_merge_targets(), get_active_version())
+
+def update_same_as_name_only_neighbours(batch_size=1000):
+    '''
+    Store internalSameAsNameOnlyUris on each unmerged org so that get_same_as_name_onlies is one lookup by uri.
+    Only writes orgs whose neighbours have changed.
+    '''
+    query = """MATCH (o: Resource&Organization)
+               RETURN o.uri, coalesce(o.internalCleanName, []) + coalesce(o.internalCleanShortName, []),
+                   o.internalSameAsNameOnlyUris"""
+    vals, _ = import_cypher_query(query)
+    neighbours = same_as_name_only_neighbours([(uri, names) for uri, names, _ in vals], build_merge_targets().resolve)
+    changes = [[uri, neighbours.get(uri)] for uri, _, stored in vals if neighbours.get(uri) != stored]
+    logger.info(f"Updating same as name only neighbours for {len(changes)} of {len(vals)} orgs")
+    for idx in range(0, len(changes), batch_size):
+        import_cypher_query("""UNWIND $rows AS row
+                           MATCH (o: Resource {uri: row[0]})
+                           SET o.internalSameAsNameOnlyUris = row[1]""", {"rows": changes[idx:idx + batch_size]})
+
+def same_as_name_only_neighbours(uris_and_names, resolve) -> dict:
+    '''
+    Orgs sharing a clean name with each org, after moving each merged org's names to its merge target (via resolve).
+    One hop only, as get_by_internal_clean_name: A sharing a name with B and B another name with C doesn't link A and C.
+    Returns dict of target uri -> sorted list of the other target uris
+    '''
+    owners_by_name = defaultdict(set)
+    names_by_target = defaultdict(set)
+    for uri, names in uris_and_names:
+        target = resolve(uri)
+        if target is None or len(names) == 0:
+            continue
+        names_by_target[target].update(names)
+        for name in names:
+            owners_by_name[name].add(target)
+    return {target: sorted(set().union(*[owners_by_name[name] for name in names]) - {target})
+            for target, names in names_by_target.items()}
+
 def update_duplicated_resource_ids():
     dup_query = "MATCH (n:Resource) WHERE n.internalId IS NOT NULL WITH n.internalId AS internalId, count(*) AS count WHERE count > 1 RETURN internalId, count"
     dups, _ = db.cypher_query(dup_query,resolve_objects=True)
     if (len(dups) == 0):
         return # No real duplicates
-    max_id,_ = db.cypher_query("MATCH (n: Resource) WHERE n.internalId IS NOT NULL RETURN MAX(n.internalId)")
+    max_id,_ = import_cypher_query("MATCH (n: Resource) WHERE n.internalId IS NOT NULL RETURN MAX(n.internalId)")
     current_max_id = max_id[0][0]
     if current_max_id is None:
         current_max_id = 0
@@ -283,12 +377,12 @@ def update_duplicated_resource_ids():
         if dup_id is None:
             continue # catch-all for non-dups
         query = f"MATCH (n: Resource) WHERE n.internalId = {dup_id} RETURN n.uri ORDER BY n.internalDocId, n.uri "
-        vals, _ = db.cypher_query(query)
+        vals, _ = import_cypher_query(query)
         for row in vals[1:]:
             current_max_id += 1
             uri = row[0]
             query = f"MATCH (n: Resource {{uri:'{uri}'}}) SET n.internalId = {current_max_id}"
-            db.cypher_query(query)
+            import_cypher_query(query)
 
 def recursively_merge_nodes(source_node, target_node, live_mode, field_to_update="internalMergedSameAsHighToUri"):
     if target_node is None:
@@ -318,7 +412,7 @@ def recursively_re_merge_node_via_same_as(source_node, live_mode=False, run_as_r
 def weights_for_relationships(node_uri):
     query = f"""MATCH (n: Resource)-[r]-(o: Resource) WHERE n.uri ='{node_uri}' 
                 RETURN o.uri, r.weight"""
-    vals, _ = db.cypher_query(query)
+    vals, _ = import_cypher_query(query)
     source_weights = {x:y for x,y in vals}
     return source_weights
 
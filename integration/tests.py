@@ -2,22 +2,30 @@ from django.test import TestCase
 from neomodel import db
 import os
 from datetime import datetime, timezone
-from integration.models import DataImport
+from integration.models import DataImport, ImportRun, ImportCheckpoint
 from integration.management.commands.import_ttl import ( do_import_ttl,
-    load_deletion_file, load_file,
+    load_deletion_file, load_file, load_ttl_files, import_rdf_file,
+    is_running, chains_of_files_sharing_subjects,
 )
+from neo4j.exceptions import TransientError
+from unittest.mock import patch
+from integration.import_report import reporting_run, record_phase
 from topics.models import Organization, Resource, AboutUs, IndustrySectorUpdate
 from topics.services.typesense_service import TypesenseService
 from integration.neo4j_utils import (
-    delete_all_not_needed_resources,
+    delete_all_not_needed_resources, import_cypher_query,
     apoc_del_redundant_same_as,
     delete_and_clean_up_nodes_by_doc_id,
+    delete_and_clean_up_nodes_by_doc_ids,
+    extract_ttl_metadata, get_internal_doc_ids_from_rdf_row, get_node_name_from_rdf_row,
 )
 from integration.rdf_post_processor import (RDFPostProcessor, 
     update_duplicated_resource_ids, recursively_re_merge_node_via_same_as,
-    add_to_typesense_by_doc_ids, delete_from_typesense_by_doc_ids
+    add_to_typesense_by_doc_ids, delete_from_typesense_by_doc_ids, same_as_name_only_neighbours, update_merge_targets,
+    update_node_degrees,
 )                
-from syracuse.cache_util import nuke_cache
+from syracuse.cache_util import nuke_cache, get_active_version
+from topics.merge_targets import build_merge_targets, save_merge_targets, resolve_many, find_ultimate_target
 from topics.models.models_extras import add_dynamic_classes_for_multiple_labels
 import json
 from api.tests.test_with_dump_data import reset_typesense
@@ -44,6 +52,7 @@ def count_relevant_nodes():
 def clean_db():
     db.cypher_query("MATCH (n) CALL {WITH n DETACH DELETE n} IN TRANSACTIONS OF 10000 ROWS;")
     DataImport.objects.all().delete()
+    ImportRun.objects.all().delete()
 
 def clean_db_and_load_files(dirname,do_post_processing=False):
     clean_db()
@@ -60,6 +69,149 @@ class TurtleLoadingTestCase(TestCase):
         assert len(DataImport.objects.all()) == 2
         assert DataImport.latest_import() == 20231224180800
 
+    def test_parallel_load_matches_sequential_load(self):
+        dirname = "integration/test_dump/dump-1/20231216081557"
+        clean_db()
+        sequential_creations, _ = load_ttl_files(dirname, 0, workers=1)
+        sequential_nodes = count_relevant_nodes()
+        clean_db()
+        parallel_creations, _ = load_ttl_files(dirname, 0, workers=4)
+        assert parallel_creations == sequential_creations
+        assert count_relevant_nodes() == sequential_nodes
+
+    def test_files_sharing_subjects_are_chained_in_sorted_order(self):
+        uris_by_key = {"d.ttl": {"u4"}, "b.ttl": {"u2", "u3"}, "a.ttl": {"u1", "u2"},
+                       "e.ttl": {"u5"}, "c.ttl": {"u3"}, "f.ttl": {"u4", "u6"}}
+        chains = chains_of_files_sharing_subjects(uris_by_key)
+        assert chains == [["a.ttl", "b.ttl", "c.ttl"], ["d.ttl", "f.ttl"], ["e.ttl"]], f"Got {chains}"
+
+    @patch("integration.management.commands.import_ttl.time.sleep")
+    @patch("integration.management.commands.import_ttl.import_cypher_query")
+    def test_retries_import_after_deadlock(self, mock_cypher_query, mock_sleep):
+        mock_cypher_query.side_effect = [
+            TransientError("Neo.TransientError.Transaction.DeadlockDetected"),
+            ([['KO', 0, 10, None, "ForsetiClient can't acquire lock: DeadlockDetected", {}]], None),
+            ([['OK', 100, 100, None, '', {}]], None),
+        ]
+        _, res = import_rdf_file("/tmp/some_file.ttl", max_retries=2)
+        assert res[0] == 'OK'
+        assert mock_cypher_query.call_count == 3
+
+    def test_resumes_run_skipping_checkpointed_files_and_phases(self):
+        clean_db()
+        dirname = "integration/test_dump/dump-1/20231216081557"
+        run = ImportRun.objects.create(started_at=datetime.now(tz=timezone.utc))
+        run.mark_done(ImportCheckpoint.LOAD_FILE, "20231216081557/industry_topics.ttl", count=1450, doc_ids=[])
+        creations, _ = load_ttl_files(dirname, 0, workers=1, run=run)
+        assert creations > 1450
+        loaded = run.completed_checkpoints(ImportCheckpoint.LOAD_FILE)
+        assert set(loaded.keys()) == set(f"20231216081557/{x}" for x in os.listdir(dirname) if x.endswith(".ttl"))
+        assert run.loaded_doc_ids() == set(loaded["20231216081557/full_dump_0658.ttl"].doc_ids) | set(loaded["20231216081557/full_dump_0000.ttl"].doc_ids) | set(loaded["20231216081557/full_dump_0683.ttl"].doc_ids)
+        vals, _ = db.cypher_query("MATCH (n: IndustryCluster) RETURN COUNT(n)")
+        assert vals[0][0] == 0 # Already checkpointed so not loaded again
+
+        R = RDFPostProcessor()
+        done_phases = [name for name, _, checkpointed in R.phases() if checkpointed is True]
+        newly_done = []
+        R.run_all_in_order(completed_phases=done_phases, on_phase_complete=newly_done.append)
+        assert newly_done == []
+        assert ImportRun.unfinished() == run
+        run.mark_complete()
+        assert ImportRun.unfinished() is None
+
+    def test_records_phase_report(self):
+        clean_db()
+        run = ImportRun.objects.create(started_at=datetime.now(tz=timezone.utc))
+        with reporting_run(run):
+            with record_phase("create nodes"):
+                import_cypher_query("CREATE (:Resource {uri:'https://1145.am/db/1/a'})-[:foo]->(:Resource {uri:'https://1145.am/db/1/b'})")
+                db.cypher_query("MATCH (n: Resource) RETURN COUNT(n)") # Not an import query, so not counted
+            with record_phase("update nodes"):
+                import_cypher_query("MATCH (n: Resource) WHERE n.uri STARTS WITH 'https://1145.am/db/1/' SET n.foo = 'bar'")
+        with record_phase("not in a run"):
+            import_cypher_query("MATCH (n: Resource) RETURN COUNT(n)")
+        report, update_report = run.phase_reports.all()
+        assert report.name == "create nodes"
+        assert report.cypher_count == 1
+        assert report.nodes_created == 2
+        assert report.relationships_created == 1
+        assert report.properties_set == 2
+        assert report.nodes_deleted == 0 and report.relationships_deleted == 0
+        assert report.node_delta == 2
+        assert report.relationship_delta == 1
+        assert update_report.properties_set == 2
+        assert update_report.node_delta == 0 and update_report.nodes_created == 0
+        assert report.wall_time >= report.cypher_time > 0
+        assert report.peak_rss_mb > 0
+        assert report.failed is False
+
+    @patch("integration.management.commands.import_ttl.refresh_geo_data")
+    def test_new_export_after_crash_gets_its_own_run(self, mock_refresh_geo_data):
+        clean_db()
+        crashed = ImportRun.objects.create(started_at=datetime.now(tz=timezone.utc))
+        load_ttl_files("integration/test_dump/dump-3/20231216081557", 0, workers=1, run=crashed)
+        DataImport.objects.create(run_at=datetime.now(tz=timezone.utc), import_ts="20231216081557",
+                                  creations=1, deletions=0)
+        R = RDFPostProcessor()
+        checkpointed_phases = [name for name, _, checkpointed in R.phases() if checkpointed is True]
+        for name in checkpointed_phases[:3]: # Crashed part way through post-processing
+            crashed.mark_done(ImportCheckpoint.POST_PROCESSING, name)
+        # 20231224180800 arrived before the restart
+        do_import_ttl(dirname="integration/test_dump/dump-3", force=True, do_archiving=False)
+        crashed.refresh_from_db()
+        assert crashed.completed_at is not None
+        assert set(crashed.completed_checkpoints(ImportCheckpoint.POST_PROCESSING).keys()) == set(checkpointed_phases)
+        assert crashed.export_names() == {"20231216081557"}
+        new_run = ImportRun.objects.exclude(pk=crashed.pk).get()
+        assert new_run.completed_at is not None
+        assert new_run.export_names() == {"20231224180800"}
+        # New data gets every post-processing phase, not just the ones the crashed run hadn't reached
+        assert set(new_run.completed_checkpoints(ImportCheckpoint.POST_PROCESSING).keys()) == set(checkpointed_phases)
+        assert mock_refresh_geo_data.call_count == 2
+        assert set(mock_refresh_geo_data.call_args[1]["doc_ids"]) == new_run.loaded_doc_ids()
+
+    @patch("integration.management.commands.import_ttl.refresh_geo_data")
+    def test_run_that_crashed_before_loading_any_file_is_closed(self, mock_refresh_geo_data):
+        clean_db()
+        crashed = ImportRun.objects.create(started_at=datetime.now(tz=timezone.utc))
+        do_import_ttl(dirname="integration/test_dump/dump-3", force=True, do_archiving=False)
+        crashed.refresh_from_db()
+        assert crashed.completed_at is not None
+        assert crashed.checkpoints.count() == 0 # Not post-processed or refreshed
+        new_run = ImportRun.objects.exclude(pk=crashed.pk).get()
+        assert new_run.export_names() == {"20231216081557", "20231224180800"}
+        assert mock_refresh_geo_data.call_count == 1
+
+    def test_ignores_stale_pidfile(self):
+        pidfile = "/tmp/syracuse-import-ttl-test.pid"
+        with open(pidfile, "w", encoding='utf-8') as f:
+            f.write("999999999") # No such process
+        assert is_running(pidfile) is False
+        assert os.path.exists(pidfile) is False
+        with open(pidfile, "w", encoding='utf-8') as f:
+            f.write(str(os.getpid()))
+        assert is_running(pidfile) is True
+        os.remove(pidfile)
+
+    def test_extracts_ttl_metadata_in_chunks(self):
+        filepath = "integration/test_dump/dump-1/20231216081557/full_dump_0658.ttl"
+        doc_ids = set()
+        uris = set()
+        with open(filepath) as f:
+            for row in f.readlines():
+                doc_id = get_internal_doc_ids_from_rdf_row(row)
+                uri = get_node_name_from_rdf_row(row)
+                if doc_id is not None:
+                    doc_ids.add(doc_id)
+                if uri is not None:
+                    uris.add(uri)
+        metadata = extract_ttl_metadata(filepath, chunk_size=1000) # small chunks so lines are split between reads
+        assert len(doc_ids) > 0
+        assert metadata.doc_ids == doc_ids
+        assert metadata.uris == uris
+        assert metadata.type_counts["Organization"] == 43
+        assert sum(metadata.type_counts.values()) >= len(uris)
+
     def test_handles_duplicate_internal_ids(self):
         clean_db_and_load_files("integration/test_dump/dump-1")
         RDFPostProcessor().run_all_in_order()
@@ -238,6 +390,15 @@ class DeleteMergedOrgsWithMergedActivitiesTestCase(TestCase):
         assert node_a.marketing.relationship(p_act).weight == 1 # Node B contributed 1 of this weight and has been deleted
         assert node_a.marketing.relationship(m_act) is None # Node b was deleted so should be removed from downstream
 
+    def test_bulk_deletes_merged_org_and_activities_together(self):
+        delete_and_clean_up_nodes_by_doc_ids([101, 200])
+        node_a = Resource.nodes.get_or_none(uri="https://1145.am/db/100/a")
+        p_act = Resource.nodes.get_or_none(uri="https://1145.am/db/202/p")
+        assert Resource.nodes.get_or_none(uri="https://1145.am/db/101/b") is None
+        assert Resource.nodes.get_or_none(uri="https://1145.am/db/200/m") is None
+        assert node_a.marketing.relationship(p_act).weight == 1 # Node B contributed 1 of this weight and has been deleted
+        assert len(node_a.marketing) == 1
+
 
 class MergeSameAsHighTestCase(TestCase):
 
@@ -318,6 +479,87 @@ class MergeSameAsHighTestCase(TestCase):
         assert o.uri == "https://1145.am/db/100/a"
         assert o.best_name == 'Name A'
 
+    def test_merge_targets_match_merge_pointers(self):
+        merge_targets = build_merge_targets()
+        merged = Resource.nodes.filter(internalMergedSameAsHighToUri__isnull=False)
+        assert len(merged) > 0
+        for node in merged:
+            target = Resource.self_or_ultimate_target_node(node.internalMergedSameAsHighToUri)
+            expected = None if target is None else target.uri
+            assert merge_targets.resolve(node.uri) == expected, f"{node.uri} expected {expected} got {merge_targets.resolve(node.uri)}"
+        save_merge_targets(merge_targets, get_active_version())
+        assert resolve_many(["https://1145.am/db/105/f", "https://1145.am/db/100/a"]) == {
+            "https://1145.am/db/105/f": "https://1145.am/db/100/a", "https://1145.am/db/100/a": "https://1145.am/db/100/a"}
+        o = Organization.self_or_ultimate_target_node("https://1145.am/db/105/f")
+        assert o.uri == "https://1145.am/db/100/a"
+
+    def test_post_processing_updates_merge_targets(self):
+        save_merge_targets(build_merge_targets(), get_active_version())
+        db.cypher_query("""CREATE (:Resource:Organization {uri:'https://1145.am/db/998/y', internalDocId: 998}),
+                                  (:Resource:Organization {uri:'https://1145.am/db/999/z', internalDocId: 999,
+                                                           internalMergedSameAsHighToUri: 'https://1145.am/db/998/y'})""")
+        db.cypher_query("""MATCH (h: Resource {uri:'https://1145.am/db/107/h'})
+                           SET h.internalMergedSameAsHighToUri = 'https://1145.am/db/999/z'""")
+        uris = ["https://1145.am/db/110/k", "https://1145.am/db/107/h", "https://1145.am/db/100/a"]
+        try:
+            assert resolve_many(uris)["https://1145.am/db/110/k"] == "https://1145.am/db/107/h" # Map only, no queries
+            update_merge_targets() # As post-processing does after merging
+            assert resolve_many(uris) == {
+                "https://1145.am/db/110/k": "https://1145.am/db/998/y",
+                "https://1145.am/db/107/h": "https://1145.am/db/998/y",
+                "https://1145.am/db/100/a": "https://1145.am/db/100/a"}
+        finally:
+            db.cypher_query("MATCH (h: Resource {uri:'https://1145.am/db/107/h'}) REMOVE h.internalMergedSameAsHighToUri")
+            db.cypher_query("MATCH (n: Resource) WHERE n.internalDocId IN [998, 999] DETACH DELETE n")
+            update_merge_targets()
+
+    def test_finds_ultimate_target_with_missing_targets_and_cycles(self):
+        parent = {"a": "b", "b": "c", "c": "d", "x": "gone", "y": "x", "p": "q", "q": "p"}
+        ultimate = {}
+        for uri in parent.keys():
+            find_ultimate_target(uri, parent, {"gone"}, ultimate)
+        assert ultimate["a"] == "d"
+        assert ultimate["b"] == "d"
+        assert ultimate["x"] is None
+        assert ultimate["y"] is None
+        assert ultimate["p"] in ["p", "q"]
+        assert ultimate["q"] == ultimate["p"]
+
+    def test_finds_orgs_sharing_clean_names(self):
+        rows = [("d", ["x"]), ("b", ["x", "y"]), ("a", ["z"]), ("c", ["y"]), ("m", ["z", "q"]), ("e", []), ("n", ["w"]),
+                ("f", ["q"])]
+        merge_targets = {"m": "a", "n": None}
+        neighbours = same_as_name_only_neighbours(rows, lambda uri: merge_targets.get(uri, uri))
+        assert neighbours == {"b": ["c", "d"], "c": ["b"], "d": ["b"], "a": ["f"], "f": ["a"]}, f"Got {neighbours}"
+
+    def test_same_as_name_only_is_one_hop(self):
+        rows = [("A", ["acme"]), ("B", ["acme", "acme corp"]), ("C", ["acme corp"])] # A~B on clean name, B~C on short name
+        neighbours = same_as_name_only_neighbours(rows, lambda uri: uri)
+        assert neighbours == {"A": ["B"], "B": ["A", "C"], "C": ["B"]}, f"Got {neighbours}"
+
+    def test_stores_node_degree(self):
+        vals, _ = db.cypher_query("MATCH (n: Resource) WHERE n.internalDegree IS NULL OR n.internalDegree <> apoc.node.degree(n) RETURN n.uri")
+        assert len(vals) == 0, f"Got {vals}"
+        a = Organization.self_or_ultimate_target_node("https://1145.am/db/100/a")
+        degree, _ = db.cypher_query("MATCH (n: Resource {uri:'https://1145.am/db/100/a'}) RETURN apoc.node.degree(n)")
+        assert a.connection_count == degree[0][0]
+
+    def test_updates_node_degrees_incrementally(self):
+        degree_query = "MATCH (n: Resource {uri: $uri}) RETURN n.internalDegree, apoc.node.degree(n)"
+        db.cypher_query("""MATCH (a: Resource {uri:'https://1145.am/db/100/a'}), (k: Resource {uri:'https://1145.am/db/110/k'})
+                           CREATE (a)-[:buyer]->(:Resource:CorporateFinanceActivity {uri:'https://1145.am/db/999/z', internalDocId: 999})
+                           SET k.internalDegree = -1""") # k isn't touched by doc 999, so stays as it is
+        update_node_degrees([999])
+        for uri in ["https://1145.am/db/100/a", "https://1145.am/db/999/z"]:
+            stored, actual = db.cypher_query(degree_query, {"uri": uri})[0][0]
+            assert stored == actual, f"{uri}: {stored} != {actual}"
+        stored, _ = db.cypher_query(degree_query, {"uri": "https://1145.am/db/110/k"})[0][0]
+        assert stored == -1
+        delete_and_clean_up_nodes_by_doc_ids([999])
+        stored, actual = db.cypher_query(degree_query, {"uri": "https://1145.am/db/100/a"})[0][0]
+        assert stored == actual
+        db.cypher_query("MATCH (k: Resource {uri:'https://1145.am/db/110/k'}) SET k.internalDegree = apoc.node.degree(k)")
+
     def test_merges_connections1(self):
         a = Organization.self_or_ultimate_target_node("https://1145.am/db/101/b") # Actually a
         assert a.uri == "https://1145.am/db/100/a"
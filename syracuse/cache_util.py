@@ -1,5 +1,19 @@
 from django.core.cache import cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.conf import settings
 import hashlib
+import json
+from datetime import date, datetime
+import os
+import pickle
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from django.db import close_old_connections
 import redis
 from django_redis import get_redis_connection
 
@@ -7,33 +21,570 @@ import logging
 logger = logging.getLogger(__name__)
 
 ACTIVE_VERSION_KEY = "versionable:active_version"
+ACTIVE_VERSION_CHANNEL = "versionable:active_version_changed"
 
 VERSIONS = ["castor","pollux"]
+CACHE_KEY_FAMILIES = {} # family -> description, see register_key_family
+PURGE_PENDING_KEY = "versionable:purge_pending"
+PURGE_LOCK_KEY = "versionable:purge_lock"
+METRICS_KEY_PREFIX = "versionable:metrics:"
+METRICS_FIELDS = ["hits", "local_hits", "misses", "bytes", "deserialize_us", "sets"]
+# Families for keys that pre-date digest_cache_key. Anything else is counted as "other" to keep the number of metrics bounded
+UNDIGESTED_KEY_FAMILIES = sorted(["available_source_names", "activity_stats_last_updated", "cc_adm1code_to_adm1name_",
+                                  "cc_adm1name_to_adm1code_", "country_to_admin1_", "geo_parent_children", "geodata_",
+                                  "geonames_locations_", "industry_leaf_keywords", "industry_list_", "merge_targets", "multi_labels_resources",
+                                  "org_by_industry_text_", "org_by_industry_text_geo_", "org_name_", "orgs_acts_cube",
+                                  "orgs_ind_text_", "random_org_list", "recents_", "sano_", "sources_with_more_than_",
+                                  "sum_weights_", "top_about_us_", "top_ind_names_", "us_states_to_national_regions_and_back"],
+                                 key=len, reverse=True)
+UNDIGESTED_KEY_PATTERNS = [(re.compile(r"_activity_mixin_"), "*_activity_mixin_"),
+                           (re.compile(r"_related_articles$"), "*_related_articles"),
+                           (re.compile(r"_orgs$"), "*_orgs")]
+
+
+def is_immutable(val):
+    if isinstance(val, (tuple, frozenset)):
+        return all(is_immutable(x) for x in val)
+    return isinstance(val, (str, bytes, int, float, bool, date, datetime))
+
+
+class LocalCache:
+    '''
+        Per-process LRU with a TTL, in front of Redis for keys of the active version, bounded by number of items
+        and by the total pickled size of the values. Values bigger than max_value_bytes are left in Redis.
+        Immutable values are shared; anything else is kept pickled and unpickled on each get, so a caller
+        mutating what it got back can't change it for other callers.
+    '''
+
+    def __init__(self, max_items, ttl, max_bytes=None, max_value_bytes=None):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_value_bytes = max_value_bytes
+        self.items = OrderedDict() # key -> (expires_at, size, val, is_pickled)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            expires_at, _, val, is_pickled = item
+            if expires_at < time.monotonic():
+                self.evict(key)
+                return None
+            self.items.move_to_end(key)
+        return pickle.loads(val) if is_pickled else val
+
+    def set(self, key, val, ttl=None):
+        if self.max_items <= 0 or val is None:
+            return
+        raw = pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+        if self.max_value_bytes is not None and len(raw) > self.max_value_bytes:
+            self.delete(key) # Don't leave a previous value behind
+            return
+        is_pickled = not is_immutable(val)
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self.lock:
+            self.evict(key)
+            self.items[key] = (time.monotonic() + ttl, len(raw), raw if is_pickled else val, is_pickled)
+            self.total_bytes += len(raw)
+            while len(self.items) > self.max_items or (self.max_bytes is not None and self.total_bytes > self.max_bytes):
+                self.evict(next(iter(self.items)))
+
+    def evict(self, key):
+        '''
+            Caller must hold the lock
+        '''
+        item = self.items.pop(key, None)
+        if item is not None:
+            self.total_bytes -= item[1]
+
+    def delete(self, key):
+        with self.lock:
+            self.evict(key)
+
+    def delete_prefix(self, prefix):
+        with self.lock:
+            for key in [k for k in self.items.keys() if k.startswith(prefix)]:
+                self.evict(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.total_bytes = 0
+
+
+class CacheMetrics:
+    '''
+        Per-process counters of hits, misses, bytes and deserialize time per key family, added to Redis hashes
+        every CACHE_METRICS_FLUSH_INTERVAL seconds so that all processes' numbers can be read together
+    '''
+
+    def __init__(self, flush_interval):
+        self.flush_interval = flush_interval
+        self.counts = defaultdict(lambda: defaultdict(int))
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+
+    def record(self, family, **counts):
+        with self.lock:
+            for field, val in counts.items():
+                self.counts[family][field] += val
+        if time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            counts = self.counts
+            self.counts = defaultdict(lambda: defaultdict(int))
+            self.last_flush = time.monotonic()
+        if len(counts) == 0:
+            return
+        try:
+            pipe = get_redis_connection("default").pipeline(transaction=False)
+            for family, fields in counts.items():
+                for field, val in fields.items():
+                    pipe.hincrby(f"{METRICS_KEY_PREFIX}{family}", field, val)
+            pipe.execute()
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Could not save cache metrics: {e}")
+
+    def clear(self):
+        with self.lock:
+            self.counts = defaultdict(lambda: defaultdict(int))
+
+
+LOCAL_CACHE = LocalCache(settings.LOCAL_CACHE_MAX_ITEMS, settings.LOCAL_CACHE_TTL, settings.LOCAL_CACHE_MAX_BYTES,
+                         settings.LOCAL_CACHE_MAX_VALUE_BYTES)
+CACHE_METRICS = CacheMetrics(settings.CACHE_METRICS_FLUSH_INTERVAL)
+REFRESH_EXECUTOR = ThreadPoolExecutor(max_workers=settings.CACHE_REFRESH_WORKERS, thread_name_prefix="cache-refresh")
+local_active_version = {"version": None, "expires_at": 0.0}
+version_override = threading.local()
+listener = {"pid": None, "lock": threading.Lock()}
+HOSTNAME = socket.gethostname()
 
 def get_active_version():
-    return cache.get(ACTIVE_VERSION_KEY, VERSIONS[0])
+    start_active_version_listener()
+    if local_active_version["version"] is not None and local_active_version["expires_at"] > time.monotonic():
+        return local_active_version["version"]
+    version = cache.get(ACTIVE_VERSION_KEY, VERSIONS[0])
+    if version != local_active_version["version"]:
+        LOCAL_CACHE.clear()
+    local_active_version["version"] = version
+    local_active_version["expires_at"] = time.monotonic() + settings.LOCAL_CACHE_VERSION_TTL
+    return version
+
+def default_version():
+    '''
+        Version used when none is passed: the active version, unless overridden for this thread by using_version
+    '''
+    return getattr(version_override, "version", None) or get_active_version()
+
+@contextmanager
+def using_version(version):
+    '''
+        Makes version the default for this thread, e.g. to pre-render pages into the inactive version before it goes live
+    '''
+    assert version in VERSIONS, f"Expected version {version} to be one of {VERSIONS}"
+    previous = getattr(version_override, "version", None)
+    version_override.version = version
+    try:
+        yield version
+    finally:
+        version_override.version = previous
+
+def forget_active_version(message=None):
+    local_active_version["version"] = None
+    LOCAL_CACHE.clear()
+
+def process_id():
+    return f"{HOSTNAME}:{os.getpid()}"
+
+def on_active_version_message(message):
+    '''
+        Messages are either the new active version, or an invalidation published by publish_invalidation
+    '''
+    data = message["data"]
+    data = data.decode() if isinstance(data, bytes) else data
+    if not data.startswith("{"):
+        forget_active_version()
+        return
+    invalidation = json.loads(data)
+    if invalidation["sender"] == process_id():
+        return
+    for key in invalidation["keys"]:
+        LOCAL_CACHE.delete(key)
+    if invalidation["prefix"] is not None:
+        LOCAL_CACHE.delete_prefix(invalidation["prefix"])
+
+def start_active_version_listener():
+    '''
+        One pub/sub listener per process (so it is restarted after a fork), clearing the local tier
+        whenever another process changes the active version, and dropping keys that another process
+        has written or deleted in the active version.
+    '''
+    if listener["pid"] == os.getpid():
+        return
+    with listener["lock"]:
+        if listener["pid"] == os.getpid():
+            return
+        listener["pid"] = os.getpid()
+        try:
+            pubsub = get_redis_connection("default").pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{ACTIVE_VERSION_CHANNEL: on_active_version_message})
+            pubsub.run_in_thread(sleep_time=1, daemon=True)
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Could not subscribe to {ACTIVE_VERSION_CHANNEL}, relying on LOCAL_CACHE_VERSION_TTL: {e}")
+
+def publish_active_version_changed(version):
+    try:
+        get_redis_connection("default").publish(ACTIVE_VERSION_CHANNEL, version)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Could not publish to {ACTIVE_VERSION_CHANNEL}: {e}")
+
+def publish_invalidation(keys=[], prefix=None):
+    '''
+        Tells the other processes to drop keys, and any key starting with prefix, from their local tier.
+        Only needed for the active version, as the local tier doesn't hold any other.
+    '''
+    message = json.dumps({"sender": process_id(), "keys": list(keys), "prefix": prefix})
+    try:
+        get_redis_connection("default").publish(ACTIVE_VERSION_CHANNEL, message)
+    except redis.exceptions.RedisError as e:
+        logger.warning(f"Could not publish invalidation to {ACTIVE_VERSION_CHANNEL}, relying on LOCAL_CACHE_TTL: {e}")
 
-def set_active_version(version):
+def set_active_version(version, background_purge=False):
     cache.set(ACTIVE_VERSION_KEY, version)
-    delete_previous_version()
+    forget_active_version()
+    publish_active_version_changed(version)
+    return delete_previous_version(background_purge)
 
 def get_inactive_version():
     return  VERSIONS[1] if get_active_version() == VERSIONS[0] else VERSIONS[0]
 
-def set_versionable_cache(cache_key, val, version=None, **kwargs):
+def set_versionable_cache(cache_key, val, version=None, soft_timeout=None, **kwargs):
+    '''
+        soft_timeout: seconds after which cached_compute treats the value as stale, returning it but recomputing it in
+        the background. Use with a longer timeout (the hard TTL) so the stale value is still there to serve.
+    '''
     if version is None:
-        version = get_active_version()
+        version = default_version()
     assert version in VERSIONS, f"Expected version {version} to be one of {VERSIONS}"
     key = cache_friendly(f"{version}_{cache_key}")
+    if soft_timeout is not None:
+        val = SoftExpiringValue(val, soft_timeout)
     cache.set(key, val, **kwargs)
+    record_cache_metrics(cache_key, sets=1)
+    if version == get_active_version():
+        LOCAL_CACHE.set(key, val, kwargs.get("timeout"))
+        publish_invalidation([key])
     return key
 
 def get_versionable_cache(cache_key, version=None):
+    return unwrap_soft_expiring(get_versionable_cache_entry(cache_key, version))
+
+def get_versionable_cache_entry(cache_key, version=None):
+    '''
+        As get_versionable_cache, but values set with a soft_timeout are returned as SoftExpiringValue
+    '''
     if version is None:
-        version = get_active_version()
+        version = default_version()
     assert version in VERSIONS, f"Expected version {version} to be one of {VERSIONS}"
     key = cache_friendly(f"{version}_{cache_key}")
-    return cache.get(key)
+    is_active = version == get_active_version() # Only the active version is immutable
+    if is_active:
+        val = LOCAL_CACHE.get(key)
+        if isinstance(val, SoftExpiringValue) and val.is_stale():
+            LOCAL_CACHE.delete(key) # Redis may already have the refreshed value
+        elif val is not None:
+            record_cache_metrics(cache_key, local_hits=1)
+            return val
+    val = get_and_measure(key, cache_key)
+    if is_active:
+        LOCAL_CACHE.set(key, val)
+    return val
+
+
+class SoftExpiringValue:
+    '''
+        Stored instead of the value itself when set_versionable_cache is given a soft_timeout
+    '''
+
+    def __init__(self, val, soft_timeout):
+        self.val = val
+        self.fresh_until = time.time() + soft_timeout
+
+    def is_stale(self):
+        return time.time() > self.fresh_until
+
+
+def get_and_measure(key, cache_key):
+    '''
+        As cache.get, but reads the raw bytes so that their size and the time taken to unpickle them can be recorded
+    '''
+    if settings.CACHE_METRICS_ENABLED is False:
+        return cache.get(key)
+    raw = cache.client.get_client(write=False).get(cache.client.make_key(key))
+    if raw is None:
+        record_cache_metrics(cache_key, misses=1)
+        return None
+    start = time.perf_counter()
+    val = cache.client.decode(raw)
+    record_cache_metrics(cache_key, hits=1, bytes=len(raw), deserialize_us=int((time.perf_counter() - start) * 1_000_000))
+    return val
+
+def key_family(cache_key):
+    '''
+        Metrics family of an unversioned cache key: the digest_cache_key family, else one of UNDIGESTED_KEY_FAMILIES
+    '''
+    family = cache_key.split(":", 1)[0]
+    if family in CACHE_KEY_FAMILIES:
+        return family
+    for prefix in UNDIGESTED_KEY_FAMILIES:
+        if cache_key.startswith(prefix):
+            return prefix
+    for pattern, family in UNDIGESTED_KEY_PATTERNS:
+        if pattern.search(cache_key):
+            return family
+    return "other"
+
+def record_cache_metrics(cache_key, **counts):
+    if settings.CACHE_METRICS_ENABLED is True:
+        CACHE_METRICS.record(key_family(cache_key), **counts)
+
+def get_cache_metrics():
+    '''
+        Returns dict of family -> counts summed across all processes (this process's unflushed counts included),
+        with hit_rate, avg_bytes and avg_deserialize_ms derived from them
+    '''
+    CACHE_METRICS.flush()
+    redis_client = get_redis_connection("default")
+    metrics = {}
+    for key in redis_client.scan_iter(match=f"{METRICS_KEY_PREFIX}*"):
+        key = key.decode() if isinstance(key, bytes) else key
+        vals = {k.decode() if isinstance(k, bytes) else k: int(v) for k, v in redis_client.hgetall(key).items()}
+        counts = {field: vals.get(field, 0) for field in METRICS_FIELDS}
+        lookups = counts["hits"] + counts["local_hits"] + counts["misses"]
+        counts["hit_rate"] = (counts["hits"] + counts["local_hits"]) / lookups if lookups > 0 else None
+        counts["avg_bytes"] = counts["bytes"] / counts["hits"] if counts["hits"] > 0 else None
+        counts["avg_deserialize_ms"] = counts["deserialize_us"] / counts["hits"] / 1000 if counts["hits"] > 0 else None
+        metrics[key[len(METRICS_KEY_PREFIX):]] = counts
+    return metrics
+
+def reset_cache_metrics():
+    CACHE_METRICS.clear()
+    delete_keys_pattern_pipeline(f"{METRICS_KEY_PREFIX}*")
+
+def unwrap_soft_expiring(val):
+    return val.val if isinstance(val, SoftExpiringValue) else val
+
+def compute_lock(cache_key, version, lock_timeout=None):
+    # Not thread local so that a background refresh can release a lock taken by the request thread
+    return get_redis_connection("default").lock(f"versionable:lock:{cache_friendly(f'{version}_{cache_key}')}",
+                                                timeout=lock_timeout or settings.CACHE_COMPUTE_LOCK_TIMEOUT,
+                                                thread_local=False)
+
+def release_compute_lock(lock, cache_key):
+    try:
+        lock.release()
+    except redis.exceptions.LockError:
+        logger.warning(f"Lock for {cache_key} expired before it was computed, consider a longer lock_timeout")
+
+def cached_compute(cache_key, fn, version=None, lock_timeout=None, wait_timeout=None, **kwargs):
+    '''
+        Returns the cached value of cache_key, or computes it with fn() and caches it (kwargs as for set_versionable_cache).
+        Single flight: only the process holding a short Redis lock on the key computes it. The others poll for the
+        value for up to wait_timeout seconds, then compute it themselves rather than fail.
+        If the value was cached with a soft_timeout and is stale, it is returned straight away and recomputed in the background.
+    '''
+    if version is None:
+        version = default_version()
+    entry = get_versionable_cache_entry(cache_key, version)
+    if entry is not None:
+        if isinstance(entry, SoftExpiringValue) and entry.is_stale():
+            refresh_in_background(cache_key, fn, version, lock_timeout, **kwargs)
+        return unwrap_soft_expiring(entry)
+    wait_timeout = settings.CACHE_COMPUTE_WAIT_TIMEOUT if wait_timeout is None else wait_timeout
+    lock = compute_lock(cache_key, version, lock_timeout)
+    if lock.acquire(blocking=False) is False:
+        logger.debug(f"Waiting for another process to compute {cache_key}")
+        give_up_at = time.monotonic() + wait_timeout
+        while time.monotonic() < give_up_at:
+            time.sleep(0.1)
+            res = get_versionable_cache(cache_key, version)
+            if res is not None:
+                return res
+            if lock.locked() is False and lock.acquire(blocking=False) is True:
+                break # Previous holder finished without caching anything (or failed), so compute it here
+        else:
+            logger.warning(f"Timed out waiting for {cache_key}, computing it here")
+            return compute_and_cache(cache_key, fn, version, **kwargs)
+    try:
+        res = get_versionable_cache(cache_key, version) # May have been set while acquiring the lock
+        if res is not None:
+            return res
+        return compute_and_cache(cache_key, fn, version, **kwargs)
+    finally:
+        release_compute_lock(lock, cache_key)
+
+def refresh_in_background(cache_key, fn, version, lock_timeout=None, **kwargs):
+    lock = compute_lock(cache_key, version, lock_timeout)
+    if lock.acquire(blocking=False) is False:
+        return None # Already being refreshed
+    logger.debug(f"Refreshing stale {cache_key} in the background")
+    def refresh():
+        try:
+            compute_and_cache(cache_key, fn, version, **kwargs)
+        except Exception:
+            logger.exception(f"Background refresh of {cache_key} failed")
+        finally:
+            release_compute_lock(lock, cache_key)
+            close_old_connections()
+    return REFRESH_EXECUTOR.submit(refresh)
+
+def compute_and_cache(cache_key, fn, version, **kwargs):
+    res = fn()
+    if res is not None:
+        set_versionable_cache(cache_key, res, version, **kwargs)
+    return res
+
+def get_many_versionable_cache(cache_keys, version=None, unwrap=True):
+    '''
+        Returns dict of cache_key -> val for the cache_keys that were found, in one MGET
+        unwrap: if False, values set with a soft_timeout are returned as SoftExpiringValue
+    '''
+    if version is None:
+        version = default_version()
+    assert version in VERSIONS, f"Expected version {version} to be one of {VERSIONS}"
+    is_active = version == get_active_version()
+    keys = {cache_friendly(f"{version}_{cache_key}"): cache_key for cache_key in cache_keys}
+    res = {}
+    if is_active:
+        for key, cache_key in keys.items():
+            val = LOCAL_CACHE.get(key)
+            if val is not None and not (isinstance(val, SoftExpiringValue) and val.is_stale()):
+                res[cache_key] = val
+                record_cache_metrics(cache_key, local_hits=1)
+    to_fetch = [key for key, cache_key in keys.items() if cache_key not in res]
+    if len(to_fetch) > 0:
+        found = cache.get_many(to_fetch)
+        for key in to_fetch:
+            val = found.get(key)
+            if val is None:
+                record_cache_metrics(keys[key], misses=1)
+                continue
+            res[keys[key]] = val
+            record_cache_metrics(keys[key], hits=1)
+            if is_active:
+                LOCAL_CACHE.set(key, val)
+    if unwrap is False:
+        return res
+    return {k: unwrap_soft_expiring(v) for k, v in res.items()}
+
+def set_many_versionable_cache(vals, version=None, timeout=DEFAULT_TIMEOUT, timeouts={}, soft_timeout=None):
+    '''
+        vals: dict of cache_key -> val, written in a single pipeline per distinct timeout
+        timeouts: optional dict of cache_key -> timeout, overriding timeout for those keys
+        soft_timeout: as for set_versionable_cache
+    '''
+    if version is None:
+        version = default_version()
+    assert version in VERSIONS, f"Expected version {version} to be one of {VERSIONS}"
+    is_active = version == get_active_version()
+    by_timeout = defaultdict(dict)
+    for cache_key, val in vals.items():
+        if soft_timeout is not None:
+            val = SoftExpiringValue(val, soft_timeout)
+        by_timeout[timeouts.get(cache_key, timeout)][cache_friendly(f"{version}_{cache_key}")] = val
+        record_cache_metrics(cache_key, sets=1)
+    for key_timeout, data in by_timeout.items():
+        cache.set_many(data, timeout=key_timeout)
+        if is_active:
+            local_ttl = None if key_timeout is DEFAULT_TIMEOUT else key_timeout
+            for key, val in data.items():
+                LOCAL_CACHE.set(key, val, local_ttl)
+            publish_invalidation(data.keys())
+    return len(vals)
+
+def copy_versionable_cache(key_prefix, from_version, to_version, batch_size=1000):
+    '''
+        Copy all keys starting with key_prefix from one version to the other, each keeping its remaining TTL.
+        Returns number of keys copied
+    '''
+    assert from_version in VERSIONS and to_version in VERSIONS, f"Expected {from_version} and {to_version} to be in {VERSIONS}"
+    cnt = 0
+    batch = []
+    for key in cache.iter_keys(f"{from_version}_{key_prefix}*", itersize=batch_size):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            cnt += copy_keys_to_version(batch, from_version, to_version)
+            batch = []
+    cnt += copy_keys_to_version(batch, from_version, to_version)
+    return cnt
+
+def copy_keys_to_version(keys, from_version, to_version):
+    '''
+        Copies the raw values, so nothing is unpickled. Keys that have expired since they were listed are skipped
+    '''
+    client = cache.client.get_client(write=True)
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        raw_key = cache.client.make_key(key)
+        pipe.get(raw_key)
+        pipe.pttl(raw_key) # -1 if it has no expiry, -2 if it has gone
+    res = pipe.execute()
+    cnt = 0
+    pipe = client.pipeline(transaction=False)
+    for key, raw, ttl_ms in zip(keys, res[::2], res[1::2]):
+        if raw is None or ttl_ms == -2:
+            continue
+        new_key = cache.client.make_key(f"{to_version}{key[len(from_version):]}")
+        pipe.set(new_key, raw, px=ttl_ms if ttl_ms > 0 else None)
+        cnt += 1
+    pipe.execute()
+    return cnt
+
+def register_key_family(family, description=""):
+    '''
+        Families are prefixes of digest_cache_key keys, so they can be listed and deleted together
+    '''
+    assert ":" not in family, f"{family} must not contain ':'"
+    CACHE_KEY_FAMILIES[family] = description
+    return family
+
+def digest_cache_key(family, *args, **kwargs):
+    '''
+        Fixed length key for any combination of str, int, float, bool, None, date/datetime, list/tuple, set and dict args.
+        Sets are sorted, so the caller doesn't have to.
+    '''
+    assert family in CACHE_KEY_FAMILIES, f"Unregistered cache key family {family}"
+    canonical = json.dumps(canonical_key_part([args, kwargs]), sort_keys=True, separators=(",",":"))
+    return f"{family}:{cacheable_hash(canonical)[:32]}"
+
+def canonical_key_part(val):
+    if isinstance(val, (set, frozenset)):
+        parts = [canonical_key_part(x) for x in val]
+        return sorted(parts, key=lambda x: json.dumps(x, sort_keys=True))
+    if isinstance(val, (list, tuple)):
+        return [canonical_key_part(x) for x in val]
+    if isinstance(val, dict):
+        return {str(k): canonical_key_part(v) for k, v in val.items()}
+    if isinstance(val, (date, datetime)):
+        return val.isoformat()
+    if val is None or isinstance(val, (str, int, float, bool)):
+        return val
+    return str(val)
+
+def delete_key_family(family, version=None):
+    if version is None:
+        version = default_version()
+    assert family in CACHE_KEY_FAMILIES, f"Unregistered cache key family {family}"
+    delete_keys_pattern_pipeline(f"*{version}_{family}:*")
+    if version == get_active_version():
+        LOCAL_CACHE.delete_prefix(f"{version}_{family}:")
+        publish_invalidation(prefix=f"{version}_{family}:")
 
 def cache_friendly(key):
     cleaned = key + ""
@@ -46,12 +597,59 @@ def cacheable_hash(input_string):
     hash_object.update(input_string.encode('utf-8'))
     return hash_object.hexdigest()
 
-def delete_previous_version():
-    cache.delete_pattern(f"{get_inactive_version()}_*")
+def delete_previous_version(background=False):
+    '''
+        If background, returns the purge thread, otherwise the number of keys deleted
+    '''
+    cache.set(PURGE_PENDING_KEY, {"version": get_inactive_version(), "cursor": 0, "deleted": 0})
+    if background is False:
+        return purge_pending_version()
+    # Daemon so that it doesn't keep the process alive: the cursor is saved under PURGE_PENDING_KEY after each batch,
+    # so an interrupted purge is picked up by the next call to purge_pending_version
+    thread = threading.Thread(target=purge_pending_version, name="cache-purge", daemon=True,
+                              kwargs={"sleep_time": settings.CACHE_PURGE_SLEEP_TIME})
+    thread.start()
+    return thread
+
+def purge_pending_version(batch_size=None, sleep_time=0):
+    '''
+        SCAN + UNLINK the version recorded in PURGE_PENDING_KEY one batch at a time. The cursor is saved after
+        each batch, under a lock, so any process can resume an interrupted purge and concurrent purges share the work.
+        Stops if the pending purge is cleared or its version has become active again. Returns number of keys deleted.
+    '''
+    batch_size = batch_size or settings.CACHE_PURGE_BATCH_SIZE
+    redis_client = get_redis_connection("default")
+    deleted = 0
+    batches = 0
+    while True:
+        with redis_client.lock(PURGE_LOCK_KEY, timeout=60):
+            pending = cache.get(PURGE_PENDING_KEY)
+            if pending is None:
+                return deleted
+            if pending["version"] == cache.get(ACTIVE_VERSION_KEY, VERSIONS[0]):
+                logger.warning(f"{pending['version']} is active again, abandoning purge")
+                cache.delete(PURGE_PENDING_KEY)
+                return deleted
+            pattern = cache.client.make_pattern(f"{pending['version']}_*")
+            cursor, cnt = unlink_keys_batch(redis_client, pattern, pending["cursor"], batch_size)
+            deleted += cnt
+            pending["cursor"] = cursor
+            pending["deleted"] += cnt
+            if cursor == 0:
+                cache.delete(PURGE_PENDING_KEY)
+                logger.info(f"Purged {pending['deleted']} keys of {pending['version']}")
+                return deleted
+            cache.set(PURGE_PENDING_KEY, pending)
+        batches += 1
+        if batches % 100 == 0:
+            logger.info(f"Purging {pending['version']}: {pending['deleted']} keys deleted so far")
+        time.sleep(sleep_time)
 
 def nuke_cache():
     r = redis.Redis()
     r.flushdb()
+    forget_active_version()
+    publish_active_version_changed("")
 
 
 def count_keys(pattern: str, cache_alias: str = "default", chunk_size: int = 1000) -> int:
@@ -87,11 +685,16 @@ def delete_keys_pattern_pipeline(pattern: str, cache_alias: str = "default", bat
     redis_client = get_redis_connection(cache_alias)
     cursor = 0
     while True:
-        cursor, keys = redis_client.scan(cursor=cursor, match=pattern, count=batch_size)
-        if keys:
-            pipe = redis_client.pipeline()
-            for key in keys:
-                pipe.delete(key)
-            pipe.execute()
+        cursor, _ = unlink_keys_batch(redis_client, pattern, cursor, batch_size)
         if cursor == 0:
-            break
\ No newline at end of file
+            break
+
+def unlink_keys_batch(redis_client, pattern, cursor, batch_size):
+    '''
+        One SCAN step, with the matching keys freed in the background by Redis (UNLINK rather than DEL).
+        Returns next cursor, number of keys unlinked
+    '''
+    cursor, keys = redis_client.scan(cursor=cursor, match=pattern, count=batch_size)
+    if len(keys) == 0:
+        return cursor, 0
+    return cursor, redis_client.unlink(*keys)
\ No newline at end of file
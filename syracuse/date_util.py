@@ -1,3 +1,4 @@
+from django.conf import settings
 from syracuse.cache_util import get_versionable_cache
 from datetime import date, datetime, time, timezone, timedelta
 
@@ -8,8 +9,9 @@ def min_and_max_date_based_on_days_ago(days_ago):
     if days_ago is None:
         days_ago = 90
     days_ago = int(days_ago)
-    if days_ago not in [7,30]:
+    if days_ago <= 0:
         days_ago = 90
+    days_ago = min(days_ago, settings.ACTIVITY_INDEX_DAYS) # Nothing older is indexed
     return min_and_max_date({}, days_diff=days_ago)
 
 def min_date_from_date(max_date=None, days_diff=90, cache_version=None):
@@ -244,12 +244,34 @@ CACHES = {
     }
 }
 
+# Per-process tier in front of the versionable cache
+LOCAL_CACHE_MAX_ITEMS=int(os.environ.get("LOCAL_CACHE_MAX_ITEMS","10000")) # 0 to disable
+LOCAL_CACHE_MAX_BYTES=int(os.environ.get("LOCAL_CACHE_MAX_BYTES",str(64*1024*1024))) # Total pickled size of the values held by each process
+LOCAL_CACHE_MAX_VALUE_BYTES=int(os.environ.get("LOCAL_CACHE_MAX_VALUE_BYTES",str(1024*1024))) # Bigger values are always read from Redis
+LOCAL_CACHE_TTL=int(os.environ.get("LOCAL_CACHE_TTL","300"))
+LOCAL_CACHE_VERSION_TTL=int(os.environ.get("LOCAL_CACHE_VERSION_TTL","60")) # Fallback if pub/sub message is missed
+CACHE_PURGE_BATCH_SIZE=int(os.environ.get("CACHE_PURGE_BATCH_SIZE","1000"))
+CACHE_PURGE_SLEEP_TIME=float(os.environ.get("CACHE_PURGE_SLEEP_TIME","0.05")) # Between batches when purging in the background
+CACHE_COMPUTE_LOCK_TIMEOUT=int(os.environ.get("CACHE_COMPUTE_LOCK_TIMEOUT","120")) # Max time one process can hold a cached_compute lock
+CACHE_COMPUTE_WAIT_TIMEOUT=int(os.environ.get("CACHE_COMPUTE_WAIT_TIMEOUT","30")) # How long others wait for it before computing it themselves
+CACHE_REFRESH_WORKERS=int(os.environ.get("CACHE_REFRESH_WORKERS","2")) # Threads per process recomputing stale values
+CACHE_METRICS_ENABLED=os.environ.get("CACHE_METRICS_ENABLED","True").lower() in ('t', 'true', '1', 'yes', 'on')
+CACHE_METRICS_FLUSH_INTERVAL=int(os.environ.get("CACHE_METRICS_FLUSH_INTERVAL","10")) # Seconds between each process saving its counts to Redis
+CACHE_WARM_WORKERS=int(os.environ.get("CACHE_WARM_WORKERS","4"))
+CACHE_WARM_TIME_BUDGET=int(os.environ.get("CACHE_WARM_TIME_BUDGET","600")) # Seconds, after which the new cache version goes live anyway
+CACHE_WARM_LOG_DAYS=int(os.environ.get("CACHE_WARM_LOG_DAYS","7")) # How far back to look in APIRequestLog for popular requests
+CACHE_WARM_MAX_ORGS=int(os.environ.get("CACHE_WARM_MAX_ORGS","200"))
+CACHE_WARM_MAX_QUERIES=int(os.environ.get("CACHE_WARM_MAX_QUERIES","200"))
+
 ACCOUNT_FORMS = {'login': 'auth_extensions.allauth.AnonAwareLoginForm'}
 
 # TTL integration
 RDF_SLEEP_TIME=int(os.environ.get("RDF_SLEEP_TIME","0"))
 RDF_DUMP_DIR=os.environ.get("RDF_DUMP_DIR","tmp/dump")
 RDF_ARCHIVE_DIR=os.environ.get("RDF_ARCHIVE_DIR","tmp/archive")
+RDF_IMPORT_WORKERS=int(os.environ.get("RDF_IMPORT_WORKERS","1")) # Files loaded concurrently, each on its own Neo4j session. Size to Neo4j, not this host
+RDF_IMPORT_COMMIT_SIZE=int(os.environ.get("RDF_IMPORT_COMMIT_SIZE","25000")) # n10s commitSize, triples per transaction
+RDF_IMPORT_MAX_RETRIES=int(os.environ.get("RDF_IMPORT_MAX_RETRIES","5")) # Retries of a file that hit a deadlock with another worker
 
 USE_GOOGLE_ANALYTICS=os.environ.get("USE_GOOGLE_ANALYTICS","False").lower() in ('t', 'true', '1', 'yes', 'on')
 
@@ -257,6 +279,7 @@ EMBEDDINGS_MODEL=os.environ.get("EMBEDDINGS_MODEL")
 CREATE_NEW_EMBEDDINGS=os.environ.get("CREATE_NEW_EMBEDDINGS","False").lower() in ('t', 'true', '1', 'yes', 'on') # If false then won't create embeddings for new nodes
 GEO_LOCATION_MIN_WEIGHT_PROPORTION=float(os.environ.get("GEO_LOCATION_MIN_WEIGHT_PROPORTION","0.2"))
 INDUSTRY_CLUSTER_MIN_WEIGHT_PROPORTION=float(os.environ.get("INDUSTRY_CLUSTER_MIN_WEIGHT_PROPORTION","0.2"))
+ACTIVITY_INDEX_DAYS=int(os.environ.get("ACTIVITY_INDEX_DAYS","365")) # How far back industry/geo activities can be queried
 
 API_BASE_URL = os.environ.get("API_BASE_URL", "http://localhost:8000")
 SPECTACULAR_SETTINGS = {
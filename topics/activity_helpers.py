@@ -1,45 +1,50 @@
 from neomodel import db
 import logging
-from topics.models import IndustryCluster, Article, ActivityMixin, Resource
+from collections.abc import Sequence
+from topics.models import (IndustryCluster, Article, ActivityMixin, Resource, Organization,
+                           Person, Role, Site, Product, geo_names_as_str, BULKY_PROPERTIES, inflate_summary,
+                           node_class_for_labels)
 from topics.industry_geo.region_hierarchies import COUNTRY_CODE_TO_NAME
 from topics.industry_geo.orgs_by_industry_geo import get_org_activities
 from topics.neo4j_utils import date_to_cypher_friendly, neo4j_date_converter, clean_str
 from topics.industry_geo import geo_to_country_admin1
 from topics.organization_search_helpers import get_same_as_name_onlies
-from topics.util import ALL_ACTIVITY_LIST, ORG_ACTIVITY_LIST
-from syracuse.cache_util import get_versionable_cache, set_versionable_cache
+from topics.util import ALL_ACTIVITY_LIST, ORG_ACTIVITY_LIST, is_allowed_activity_type
+from syracuse.cache_util import get_versionable_cache, set_versionable_cache, register_key_family, digest_cache_key
 from syracuse.date_util import date_minus, latest_cache_date, min_and_max_date_based_on_days_ago
 
 logger = logging.getLogger(__name__)
 
+ACTIVITIES_BY_ORG_URIS_KEYS = register_key_family("activities_by_org_uris", "activity/article/date rows for a set of orgs")
+ACTIVITIES_BY_SOURCE_KEYS = register_key_family("activities_by_source", "activity/article/date rows for a source organization")
+
 def get_activities_by_country_and_date_range(geo_code,min_date,max_date,cache_version=None,limit=20):
     country_code, admin1_code = geo_to_country_admin1(geo_code)
     activity_article_uris = get_org_activities(min_date,max_date,None,country_code,admin1_code,cache_version)
-    return activity_articles_to_api_results(activity_article_uris,limit)
+    return ActivityArticleResults(activity_article_uris,limit)
 
 def get_activities_by_source_and_date_range(source_name, min_date, max_date, cache_version=None, limit=20):
     activity_article_uris = activities_by_source(source_name, min_date, max_date, cache_version, limit)
-    return activity_articles_to_api_results(activity_article_uris,limit)
+    return ActivityArticleResults(activity_article_uris,limit)
 
 def get_activities_by_industry_and_date_range(industry, min_date, max_date, cache_version=None, limit=20):
     if isinstance(industry, IndustryCluster):
         industry = industry.topicId
     activity_article_uris = get_org_activities(min_date,max_date,industry,None,None, cache_version)
-    return activity_articles_to_api_results(activity_article_uris,limit)
+    return ActivityArticleResults(activity_article_uris,limit)
 
 def get_activities_by_industry_geo_and_date_range(industry, geo_code, min_date, max_date, cache_version=None, limit=None):
     if isinstance(industry, IndustryCluster):
         industry = industry.topicId
     country_code, admin1_code = geo_to_country_admin1(geo_code)
     activity_article_uris = get_org_activities(min_date,max_date,industry,country_code, admin1_code, cache_version)
-    return activity_articles_to_api_results(activity_article_uris,limit)
+    return ActivityArticleResults(activity_article_uris,limit)
 
 def get_activities_by_industry_country_admin1_and_date_range(industry, country_code, admin1_code, min_date, max_date, cache_version=None,limit=None):
     if isinstance(industry, IndustryCluster):
         industry = industry.topicId
     activity_article_uris = get_org_activities(min_date,max_date,industry,country_code, admin1_code, cache_version)
-    results = activity_articles_to_api_results(activity_article_uris,limit)
-    return results
+    return ActivityArticleResults(activity_article_uris,limit)
 
 def activities_by_industry(industry, min_date, max_date, cache_version=None, limit=None):
     if isinstance(industry, IndustryCluster):
@@ -82,9 +87,7 @@ def get_activities_by_org_uris_and_date_range(uri_list,min_date,max_date,cache_v
     logger.debug(f"get_activities_by_org_uris_and_date_range: org uris {len(uri_list)} {min_date} {max_date}, combine_same_as_name_only {combine_same_as_name_only} limit {limit}")
     activity_article_uris = activities_by_org_uris_incl_same_as(uri_list,min_date,max_date,cache_version,
                                                                 combine_same_as_name_only=combine_same_as_name_only,limit=limit)
-    res = activity_articles_to_api_results(activity_article_uris)
-    logger.debug(f"activity articles prepared")
-    return res
+    return ActivityArticleResults(activity_article_uris)
 
 def activities_by_org_uris_incl_same_as(uri_list,min_date,max_date,cache_version=None,combine_same_as_name_only=True,limit=None):
     uris_to_check = set(uri_list)
@@ -104,7 +107,7 @@ def activities_by_org_uris_incl_same_as(uri_list,min_date,max_date,cache_version
 def activities_by_org_uris(org_uris, min_date, max_date, cache_version=None, limit=None):
     logger.debug(f"activities_by_org_uris {len(org_uris)} org_uris, {min_date} - {max_date}")
     org_uris = sorted(org_uris)
-    cache_key = f"activities_{org_uris}_{min_date}_{max_date}_{limit}"
+    cache_key = digest_cache_key(ACTIVITIES_BY_ORG_URIS_KEYS, set(org_uris), min_date, max_date, limit)
     res = get_versionable_cache(cache_key, cache_version)
     if res is not None:
         logger.debug(f"activities_by_org_uris {cache_key} cache hit")
@@ -131,7 +134,7 @@ def activities_by_org_uris(org_uris, min_date, max_date, cache_version=None, lim
     return query_and_cache(query, cache_key, cache_version)
 
 def activities_by_source(source_name, min_date, max_date, cache_version=None, limit=None):
-    cache_key = f"activities_{source_name}_{min_date}_{max_date}_{limit}"
+    cache_key = digest_cache_key(ACTIVITIES_BY_SOURCE_KEYS, source_name, min_date, max_date, limit)
     res = get_versionable_cache(cache_key, cache_version)
     if res is not None:
         return res
@@ -183,39 +186,311 @@ def industry_sector_update_to_api_results(uri):
     return api_row
 
 
+# Mirrors the all_actors property of each activity class: (relationship type, is outgoing from activity) -> (role, target class)
+ACTOR_RELATIONSHIPS = {
+    "CorporateFinanceActivity": {
+        ("vendor", True): ("vendor", Organization),
+        ("investor", False): ("investor", Organization),
+        ("buyer", False): ("buyer", Organization),
+        ("protagonist", False): ("protagonist", Organization),
+        ("participant", False): ("participant", Organization),
+        ("target", True): ("target", Organization),
+    },
+    "PartnershipActivity": {
+        ("providedBy", True): ("provided_by", Organization),
+        ("partnership", False): ("partnership", Organization),
+        ("awarded", False): ("awarded", Organization),
+    },
+    "RoleActivity": {
+        ("role", True): ("role", Role),
+        ("roleActivity", False): ("person", Person),
+    },
+    "LocationActivity": {
+        ("locationAdded", False): ("location_added_by", Organization),
+        ("locationRemoved", False): ("location_removed_by", Organization),
+        ("location", True): ("location", Site),
+    },
+    "ProductActivity": {
+        ("product", True): ("product", Product),
+        ("productActivity", False): ("organization", Organization),
+    },
+    "AnalystRatingActivity": {("hasAnalystRatingActivity", False): ("organization", Organization)},
+    "EquityActionsActivity": {("hasEquityActionsActivity", False): ("organization", Organization)},
+    "FinancialReportingActivity": {("hasFinancialReportingActivity", False): ("organization", Organization)},
+    "FinancialsActivity": {("hasFinancialsActivity", False): ("organization", Organization)},
+    "IncidentActivity": {("hasIncidentActivity", False): ("organization", Organization)},
+    "MarketingActivity": {("hasMarketingActivity", False): ("organization", Organization)},
+    "OperationsActivity": {("hasOperationsActivity", False): ("organization", Organization)},
+    "RecognitionActivity": {("hasRecognitionActivity", False): ("organization", Organization)},
+    "RegulatoryActivity": {("hasRegulatoryActivity", False): ("organization", Organization)},
+}
+ACTOR_RELATIONSHIP_TYPES = sorted({rel_type for rels in ACTOR_RELATIONSHIPS.values() for rel_type, _ in rels})
+
+
+def actor_relationships_for(activity):
+    for klass in activity.__class__.__mro__:
+        rels = ACTOR_RELATIONSHIPS.get(klass.__name__)
+        if rels is not None:
+            return rels
+    return {}
+
+
+def hydrate_activity_articles(activity_article_uris):
+    '''
+        Loads everything needed for the API rows in one query rather than a dozen or so per row.
+        Returns dict of index into activity_article_uris -> (activity, article, document_extract, document_url,
+        locations, actors_by_role). Rows whose activity or article no longer exists are logged and left out.
+    '''
+    if len(activity_article_uris) == 0:
+        return {}
+    rows = [[x[0], x[1]] for x in activity_article_uris]
+    query = """
+        UNWIND range(0, size($rows) - 1) AS idx
+        WITH idx, $rows[idx] AS row
+        MATCH (act: Resource {uri: row[0]})
+        MATCH (art: Resource {uri: row[1]})
+        CALL {
+            WITH act, art
+            OPTIONAL MATCH (act)-[ds:documentSource]->(art)
+            OPTIONAL MATCH (art)-[:url]-(url: Resource)
+            RETURN head(collect(ds.documentExtract)) AS document_extract, head(collect(url.uri)) AS document_url
+        }
+        CALL {
+            WITH act
+            MATCH (act)-[:whereHighGeoNamesLocation]->(loc: Resource&GeoNamesLocation)
+            RETURN collect(DISTINCT loc) AS locations
+        }
+        CALL {
+            WITH act
+            MATCH (act)-[r]-(other: Resource)
+            WHERE type(r) IN $actor_rel_types
+            RETURN collect([type(r), startNode(r) = act,
+                            [elementId(other), labels(other), apoc.map.removeKeys(properties(other), $bulky_properties)]]) AS actor_rels
+        }
+        CALL {
+            WITH act
+            MATCH (act)-[:role]-(: Role)--(o: Organization)
+            RETURN collect(DISTINCT [elementId(o), labels(o), apoc.map.removeKeys(properties(o), $bulky_properties)]) AS role_orgs
+        }
+        RETURN idx, act, art, document_extract, document_url, locations, actor_rels, role_orgs
+        ORDER BY idx
+    """
+    vals, _ = db.cypher_query(query, {"rows": rows, "actor_rel_types": ACTOR_RELATIONSHIP_TYPES,
+                                      "bulky_properties": BULKY_PROPERTIES}, resolve_objects=True)
+    if len(vals) != len(rows):
+        missing = set(range(len(rows))) - {x[0] for x in vals}
+        logger.warning(f"Couldn't find activity/article for {[rows[x] for x in sorted(missing)]}, skipping them")
+
+    raw_actors = []
+    all_actor_nodes = []
+    for _, act, _, _, _, _, actor_rels, role_orgs in vals:
+        rels = actor_relationships_for(act)
+        actors = {}
+        for rel_type, is_outgoing, other in actor_rels:
+            other = inflate_summary(*other)
+            role, klass = rels.get((rel_type, is_outgoing), (None, None))
+            if role is None or not isinstance(other, klass):
+                continue
+            actors.setdefault(role, []).append(other)
+        if len(role_orgs) > 0:
+            actors["organization"] = [inflate_summary(*x) for x in role_orgs]
+        raw_actors.append(actors)
+        for nodes in actors.values():
+            all_actor_nodes.extend(nodes)
+
+    targets = Resource.self_or_ultimate_target_node_map(all_actor_nodes)
+
+    results = {}
+    for (idx, act, art, document_extract, document_url, locations, _, _), actors in zip(vals, raw_actors):
+        art.prefetched_document_url = document_url
+        actors_by_role = {}
+        for role, nodes in actors.items():
+            resolved = {targets[x.uri] for x in nodes} - {None}
+            if len(resolved) > 0:
+                actors_by_role[role] = resolved
+        results[idx] = (act, art, document_extract, document_url, locations, actors_by_role)
+    return results
+
+
 def activity_articles_to_api_results(activity_article_uris, limit=None):
-    api_results = []
     by_date = sorted(activity_article_uris,key=lambda x: x[2], reverse=True)
     if limit is not None:
         by_date = by_date[:limit]
-    for activity_uri, article_uri, date_published in activity_article_uris:
-        activity = Resource.nodes.get_or_none(uri=activity_uri)
-        article = Resource.nodes.get_or_none(uri=article_uri)
+    api_results = activity_articles_to_api_results_by_idx(by_date)
+    return [api_results[idx] for idx in range(len(by_date)) if idx in api_results]
+
+
+def activity_articles_to_api_results_by_idx(activity_article_uris):
+    '''
+        Dict of index into activity_article_uris -> API row, missing any rows that couldn't be found
+    '''
+    api_results = {}
+    hydrated = hydrate_activity_articles(activity_article_uris)
+    for idx, (activity, article, document_extract, document_url, locations, actors) in hydrated.items():
+        date_published = activity_article_uris[idx][2]
         assert isinstance(article, Article), f"{article} should be an Article"
         assert isinstance(activity, ActivityMixin), f"{activity} should be an Activity"
         api_row = {}
         api_row["source_organization"] = article.sourceOrganization
         api_row["date_published"] = date_published
         api_row["headline"] = article.headline
-        api_row["document_extract"] = activity.documentSource.relationship(article).documentExtract
-        api_row["document_url"] = article.documentURL
+        api_row["document_extract"] = document_extract
+        api_row["document_url"] = document_url
         api_row["archive_org_page_url"] = article.archiveOrgPageURL
         api_row["archive_org_list_url"] = article.archiveOrgListURL
         api_row["activity_uri"] = activity.uri
-        api_row["activity_locations"] = activity.whereHighGeoNamesLocation.all()
-        api_row["activity_location_as_string"] = activity.whereHighGeoName_as_str
+        api_row["activity_locations"] = locations
+        api_row["activity_location_as_string"] = geo_names_as_str(locations)
         api_row["activity_class"] = activity.__class__.__name__
         api_row["activity_types"] = activity.activityType
         api_row["activity_longest_type"] = activity.longest_activityType
         api_row["activity_statuses"] = activity.status
         api_row["activity_status_as_string"] = activity.status_as_string
         api_row["source_is_core"] = article.is_core
-        actors = {}
-        for actor_role, actor_list in activity.all_actors.items():
-            if actor_list is not None and actor_list != []:
-                if actors.get(actor_role) is None:
-                    actors[actor_role] = set()
-                actors[actor_role].update(actor_list)
         api_row["actors"] = actors
-        api_results.append(api_row)
-    return api_results
\ No newline at end of file
+        api_results[idx] = api_row
+    return api_results
+
+
+def activity_class_names(activity_uris):
+    '''
+        Class names as they would be after inflating the nodes, without having to inflate them
+    '''
+    if len(activity_uris) == 0:
+        return {}
+    vals, _ = db.cypher_query("MATCH (n: Resource) WHERE n.uri IN $uris RETURN n.uri, labels(n)",
+                              {"uris": list(activity_uris)})
+    res = {}
+    for uri, labels in vals:
+        cls = node_class_for_labels(labels)
+        res[uri] = "" if cls is None else cls.__name__
+    return res
+
+
+def existing_activity_article_rows(rows):
+    '''
+        rows without the (activity_uri, article_uri, date_published) tuples whose activity or article no longer exists,
+        in one query. Rows that are already dicts are kept.
+    '''
+    to_check = [[x[0], x[1]] for x in rows if not isinstance(x, dict)]
+    if len(to_check) == 0:
+        return list(rows)
+    query = """UNWIND range(0, size($rows) - 1) AS idx
+               WITH idx, $rows[idx] AS row
+               WHERE EXISTS { MATCH (:Resource {uri: row[0]}) } AND EXISTS { MATCH (:Resource {uri: row[1]}) }
+               RETURN idx"""
+    vals, _ = db.cypher_query(query, {"rows": to_check})
+    found = {x[0] for x in vals}
+    if len(found) < len(to_check):
+        logger.warning(f"Couldn't find activity/article for {len(to_check) - len(found)} rows, leaving them out")
+    res = []
+    idx = 0
+    for row in rows:
+        if isinstance(row, dict):
+            res.append(row)
+            continue
+        if idx in found:
+            res.append(row)
+        idx += 1
+    return res
+
+
+def activity_row_uri(row):
+    if isinstance(row, dict):
+        return row.get("activity_uri", row.get("industry_sector_update_uri"))
+    return row[0]
+
+
+def activity_row_date(row):
+    if isinstance(row, dict):
+        return row["date_published"]
+    return row[2]
+
+
+class ActivityArticleResults(Sequence):
+    '''
+        Activity API rows sorted newest first. Holds the (activity_uri, article_uri, date_published) tuples
+        and only hydrates them via activity_articles_to_api_results_by_idx when accessed, so showing one page of a
+        long list only costs one page's worth of hydration. Rows that are already dicts (e.g. industry sector
+        updates) are passed through as-is.
+        Rows whose activity or article doesn't exist are left out up front, so len() matches what indexing returns.
+        rows_exist: set if rows have already been checked, e.g. they come from another ActivityArticleResults
+    '''
+    batch_size = 100
+
+    def __init__(self, rows=[], limit=None, rows_exist=False):
+        if rows_exist is False:
+            rows = existing_activity_article_rows(rows)
+        self.rows = sorted(rows, key=activity_row_date, reverse=True)
+        if limit is not None:
+            self.rows = self.rows[:limit]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.hydrate(self.rows[idx])
+        res = self.hydrate([self.rows[idx]])
+        return res[0] if len(res) > 0 else None # Deleted since these results were built
+
+    def __iter__(self):
+        for start in range(0, len(self.rows), self.batch_size):
+            yield from self[start:start + self.batch_size]
+
+    def __repr__(self):
+        return f"<ActivityArticleResults: {len(self.rows)} rows>"
+
+    def __eq__(self, other):
+        if not isinstance(other, ActivityArticleResults):
+            return NotImplemented
+        return self.rows == other.rows
+
+    __hash__ = None
+
+    @staticmethod
+    def hydrate(rows):
+        to_hydrate = [x for x in rows if not isinstance(x, dict)]
+        hydrated = activity_articles_to_api_results_by_idx(to_hydrate)
+        results = []
+        idx = 0
+        for row in rows:
+            if isinstance(row, dict):
+                results.append(row)
+                continue
+            if idx in hydrated:
+                results.append(hydrated[idx])
+            idx += 1
+        return results
+
+    @classmethod
+    def combine(cls, results_list):
+        rows = []
+        to_check = []
+        for results in results_list:
+            if isinstance(results, ActivityArticleResults):
+                rows.extend(results.rows)
+            else:
+                to_check.extend(results)
+        return cls(rows + existing_activity_article_rows(to_check), rows_exist=True)
+
+    def unique_and_allowed_activity_types(self, activity_types_to_keep=[]):
+        '''
+            Lazy equivalent of topics.util.filter_unique_records_and_allowed_activity_types
+        '''
+        if len(activity_types_to_keep) > 0:
+            class_names = activity_class_names([x[0] for x in self.rows if not isinstance(x, dict)])
+        rows_to_keep = []
+        seen_uris = set()
+        for row in self.rows:
+            uri = activity_row_uri(row)
+            assert uri is not None, f"Couldn't find URI for {row}"
+            if uri in seen_uris:
+                continue
+            seen_uris.add(uri)
+            if len(activity_types_to_keep) > 0:
+                activity_class = row["activity_class"] if isinstance(row, dict) else class_names.get(uri, "")
+                if not is_allowed_activity_type(activity_class, activity_types_to_keep):
+                    continue
+            rows_to_keep.append(row)
+        return ActivityArticleResults(rows_to_keep, rows_exist=True)
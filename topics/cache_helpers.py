@@ -1,32 +1,69 @@
 from datetime import datetime, date
 from .stats_helpers import get_stats
-from topics.industry_geo.geoname_mappings import prepare_country_mapping
+from topics.industry_geo.geoname_mappings import (prepare_country_mapping, copy_country_mapping,
+    get_geoname_ids_without_country_admin1)
 from topics.industry_geo.geo_rdf_post_processor import update_geonames_locations_with_country_admin1
-from topics.industry_geo.orgs_by_industry_geo import do_all_precalculations
-from syracuse.cache_util import get_inactive_version, set_active_version, set_versionable_cache, nuke_cache
+from topics.industry_geo.orgs_by_industry_geo import do_all_precalculations, do_incremental_precalculations
+from syracuse.cache_util import (get_active_version, get_inactive_version, set_active_version,
+    set_versionable_cache, nuke_cache, purge_pending_version)
 from syracuse.date_util import min_and_max_date
+from topics.merge_targets import build_merge_targets, save_merge_targets
+from integration.import_report import record_phase
 
 import logging
 logger = logging.getLogger(__name__)
 
 
 def refresh_geo_data(max_date = date.today(),fill_blanks=True,
-                     with_reset=False):
+                     with_reset=False, doc_ids=None, background_purge=False, before_activate=None):
+    '''
+        doc_ids: if set, only recalculate the industry/geo stats for orgs in these docs and copy the rest forward
+                 from the active version. Falls back to a full refresh if there is nothing to copy from.
+        background_purge: delete the previous version's keys in a background thread rather than before returning
+        before_activate: optional fn called with the new version once it is populated but before it goes live,
+                         e.g. api.cache_warming.warm_cache_from_request_logs
+    '''
     t1 = datetime.now()
     _, max_date = min_and_max_date({"max_date":max_date})
     logger.info(f"Resetting cache as at {max_date}")
     if with_reset is True:
         nuke_cache()
+    purge_pending_version() # Finish any interrupted purge before writing to the inactive version
     to_be_version = get_inactive_version()
-    prepare_country_mapping(to_be_version) 
-    update_geonames_locations_with_country_admin1(to_be_version) 
-    do_all_precalculations(to_be_version, max_date, fill_blanks=fill_blanks)
+    with record_phase("refresh_geo_data: merge targets"):
+        save_merge_targets(build_merge_targets(), to_be_version)
+    incremental = False
+    if doc_ids is not None:
+        with record_phase("refresh_geo_data: incremental precalculations"):
+            incremental = incremental_refresh(to_be_version, doc_ids, max_date, fill_blanks)
+    if not incremental:
+        with record_phase("refresh_geo_data: full precalculations"):
+            prepare_country_mapping(to_be_version) 
+            update_geonames_locations_with_country_admin1(to_be_version) 
+            do_all_precalculations(to_be_version, max_date, fill_blanks=fill_blanks)
     if fill_blanks is True:
-        get_stats(max_date,to_be_version)
+        with record_phase("refresh_geo_data: stats"):
+            get_stats(max_date,to_be_version)
     set_versionable_cache("activity_stats_last_updated", max_date, to_be_version)
-    set_active_version(to_be_version)
+    if before_activate is not None:
+        with record_phase("refresh_geo_data: before activate"):
+            before_activate(to_be_version)
+    with record_phase("refresh_geo_data: activate"):
+        set_active_version(to_be_version, background_purge=background_purge)
     t2 = datetime.now()
     logger.info(f"Refreshed geo data in {t2 - t1}")
     return max_date
 
-
+def incremental_refresh(to_be_version, doc_ids, max_date, fill_blanks):
+    current_version = get_active_version()
+    try:
+        copy_country_mapping(current_version, to_be_version)
+        new_geoname_ids = get_geoname_ids_without_country_admin1()
+        if len(new_geoname_ids) > 0:
+            prepare_country_mapping(to_be_version, geoname_ids=new_geoname_ids)
+        update_geonames_locations_with_country_admin1(to_be_version)
+        do_incremental_precalculations(to_be_version, doc_ids, current_version, max_date, fill_blanks=fill_blanks)
+    except ValueError as e:
+        logger.warning(f"Incremental refresh failed ({e}), doing full refresh")
+        return False
+    return True
@@ -1,7 +1,6 @@
 from typing import Union, List
-from .models import Article, Organization
+from .models import Article, Organization, summary_columns, summary_cypher_query
 from .constants import BEGINNING_OF_TIME
-from neomodel import db
 import logging
 from .graph_utils import keep_or_switch_node
 from .neo4j_utils import date_to_cypher_friendly
@@ -29,10 +28,10 @@ def do_get_parent_orgs_query(uri_or_uris: Union[str,List], parent_rels = "buyer|
         AND t.internalMergedSameAsHighToUri IS NULL
         AND a.sourceOrganization in {source_names}
         AND a.datePublished >= datetime('{date_to_cypher_friendly(min_date)}')
-        RETURN b, t, c, a, TYPE(x), d.documentExtract
+        RETURN {summary_columns("b")}, {summary_columns("t")}, c, a, TYPE(x), d.documentExtract
         ORDER BY a.datePublished DESCENDING
     """
-    results, _ = db.cypher_query(query, resolve_objects=True)
+    results = summary_cypher_query(query, nodes_per_row=2, resolve_objects=True)
     logger.debug(query)
     return results
 
@@ -52,11 +51,11 @@ def do_get_child_orgs_query(uri_or_uris: Union[str,List], relationships = "buyer
         AND b.internalMergedSameAsHighToUri IS NULL
         AND a.sourceOrganization in {source_names}
         AND a.datePublished >= datetime('{date_to_cypher_friendly(min_date)}')
-        RETURN b, t, c, a, TYPE(x), d.documentExtract
+        RETURN {summary_columns("b")}, {summary_columns("t")}, c, a, TYPE(x), d.documentExtract
         ORDER BY a.datePublished DESCENDING
     """
     logger.debug(query)
-    results, _ = db.cypher_query(query, resolve_objects=True)
+    results = summary_cypher_query(query, nodes_per_row=2, resolve_objects=True)
     return results
 
 def get_child_orgs(uri, combine_same_as_name_only=True, relationships="buyer|vendor|investor",
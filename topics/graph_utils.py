@@ -1,6 +1,9 @@
 from topics.models import (Organization, Person, ActivityMixin,
     Resource, Role, Article, IndustryCluster, GeoNamesLocation, Site,
-    Product)
+    Product, summary_columns, summary_cypher_query)
+from neomodel import RelationshipTo, RelationshipFrom
+from collections import defaultdict
+from topics.industry_geo.industry_geo_cypher import INDUSTRY_CLUSTER_MIN_WEIGHT_PROPORTION, GEO_LOCATION_MIN_WEIGHT_PROPORTION
 import logging
 from .constants import BEGINNING_OF_TIME
 from .organization_search_helpers import get_same_as_name_onlies
@@ -71,42 +74,258 @@ def node_color_shape(node):
 def graph_centered_on(start_node, **kwargs):
     root_node = Resource.self_or_ultimate_target_node(start_node)
     root_uri = root_node.uri
-    node_data = [ resource_to_node_data(root_node) ] # Nodes for graph
-    node_details = {root_uri:root_node.serialize_no_none()} # Node info to show on click
-    edge_data = [] # Edges for graph
-    edge_details = {} # Edge info to show on click
     combine_same_as_name_only = kwargs.get("combine_same_as_name_only",True)
     source_names = kwargs.get("source_names",Article.core_sources())
     min_date = kwargs.get("min_date",BEGINNING_OF_TIME)
     max_nodes = kwargs.get("max_nodes",50)
-    uris_to_ignore = set()
-    nodes_found_so_far = set()
+    center_node_same_as_name_onlies = []
 
     if combine_same_as_name_only is True:
         center_node_same_as_name_onlies = get_same_as_name_onlies(root_node)
-        uris_to_ignore = set([x.uri for x in center_node_same_as_name_onlies])
-
-    for rel_data in root_node.all_directional_relationships(source_names=source_names,min_date=min_date):
-        build_out_graph_entries(rel_data, node_data, node_details, edge_data, edge_details, 
-                                uris_to_ignore, nodes_found_so_far, combine_same_as_name_only, 
-                                source_names, min_date, max_nodes)
-        if len(node_data) > max_nodes:
-            logger.warning(f"got {len(node_data)} nodes - more than {max_nodes} - bailing")
+    neighbourhood = Neighbourhood([root_uri] + [x.uri for x in center_node_same_as_name_onlies], source_names, min_date)
+    graph = SubgraphBuilder(root_node, neighbourhood, set([x.uri for x in center_node_same_as_name_onlies]),
+                            combine_same_as_name_only, max_nodes)
+
+    for rel_data in neighbourhood.directional_relationships(root_node):
+        graph.build_out_graph_entries(rel_data)
+        if graph.too_many_nodes():
             return None
 
-    if combine_same_as_name_only is True:
-        for org in center_node_same_as_name_onlies:
-            for rel_data in org.all_directional_relationships(override_from_uri=root_uri,source_names=source_names,min_date=min_date):
-                rel_data["other_node"] = keep_or_switch_node(rel_data["other_node"],nodes_found_so_far, combine_same_as_name_only)
-                if rel_data["other_node"] not in center_node_same_as_name_onlies:
-                    build_out_graph_entries(rel_data, node_data, node_details, edge_data, edge_details, 
-                                            uris_to_ignore, nodes_found_so_far, combine_same_as_name_only, 
-                                            source_names, min_date, max_nodes)
-                    if len(node_data) > max_nodes:
-                        logger.warning(f"got {len(node_data)} nodes - more than {max_nodes} - bailing")
-                        return None
-
-    return node_data, edge_data, node_details, edge_details
+    for org in center_node_same_as_name_onlies:
+        for rel_data in neighbourhood.directional_relationships(org, override_from_uri=root_uri):
+            rel_data["other_node"] = keep_or_switch_node(rel_data["other_node"], graph.nodes_found_so_far, combine_same_as_name_only)
+            if rel_data["other_node"] not in center_node_same_as_name_onlies:
+                graph.build_out_graph_entries(rel_data)
+                if graph.too_many_nodes():
+                    return None
+
+    return graph.node_data, graph.edge_data, graph.node_details, graph.edge_details
+
+
+TERMINAL_NODE_LABELS = ["Organization", "IndustryCluster", "GeoNamesLocation", "Article"] # Shown in the graph but not expanded further
+TERMINAL_NODE_CLASSES = (Organization, IndustryCluster, GeoNamesLocation, Article)
+# Paths are followed at most this many relationships from a root uri (or from a merge target that a path
+# was redirected to). Nodes further out are not fetched, even if graph_centered_on hasn't reached max_nodes.
+GRAPH_MAX_HOPS = 5
+
+def node_visibility_columns(var):
+    '''
+        Cypher equivalent of has_permitted_document_source and is_recent_enough for node var
+    '''
+    return f"""
+        {var}:IndustryCluster OR {var}.sourceOrganization IN $source_names
+            OR size([({var})-[:documentSource]->(a: Article) WHERE a.sourceOrganization IN $source_names | a]) > 0,
+        $min_date IS NULL OR {var}:IndustryCluster OR ({var}:Article AND date({var}.datePublished) >= $min_date)
+            OR (NOT {var}:Article AND size([({var})-[:documentSource]->(a: Article) WHERE date(a.datePublished) >= $min_date | a]) > 0)"""
+
+NEIGHBOURHOOD_QUERY = f"""
+    MATCH (root: Resource) WHERE root.uri IN $root_uris
+    MATCH p = (root)-[rels*1..{GRAPH_MAX_HOPS}]-(: Resource)
+    WHERE all(x IN nodes(p)[1..-1] WHERE x.internalMergedSameAsHighToUri IS NULL
+              AND x.internalMergedActivityWithSimilarRelationshipsToUri IS NULL
+              AND none(label IN labels(x) WHERE label IN {TERMINAL_NODE_LABELS}))
+    AND none(r IN rels WHERE type(r) = 'sameAsHigh')
+    UNWIND rels AS rel
+    WITH DISTINCT rel
+    WITH startNode(rel) AS s, endNode(rel) AS e, rel
+    WITH s, collect([elementId(rel), type(rel), e.uri, rel.documentExtract, rel.weight]) AS out_edges, collect(e) AS ends
+    WITH apoc.map.fromPairs(collect([elementId(s), out_edges])) AS out_edges_by_node,
+         apoc.coll.toSet(collect(s) + apoc.coll.flatten(collect(ends))) AS nodes
+    UNWIND nodes AS n
+    OPTIONAL MATCH (t: Resource {{uri: n.internalMergedSameAsHighToUri}})
+    RETURN {summary_columns("n")}, {summary_columns("t")},
+        coalesce(out_edges_by_node[elementId(n)], []),
+        {node_visibility_columns("n")},
+        {node_visibility_columns("t")}
+"""
+
+
+class Neighbourhood:
+    '''
+        The nodes and relationships that graph_centered_on can reach from the root uris, fetched in one query,
+        with merge targets resolved and the source name and date filters already applied.
+        Merge targets that no path reached are expanded by a follow-up query from those targets, as
+        all_directional_relationships would have done.
+        Replaces calling all_directional_relationships (and related_articles) on every node in the graph.
+    '''
+
+    def __init__(self, root_uris, source_names, min_date):
+        if isinstance(source_names, str):
+            source_names = source_names.split(",")
+        self.min_date = min_date
+        self.source_names = source_names
+        self.nodes = {}
+        self.edges = defaultdict(list) # uri -> [(rel type, direction, other uri, document extract, weight)]
+        self.targets = {} # uri -> merge target node
+        self.visible = {} # uri -> passes source name and date filters
+        self.rel_ids = set()
+        queried = set()
+        to_query = list(root_uris)
+        while len(to_query) > 0:
+            self.add_neighbourhood(to_query)
+            queried.update(to_query)
+            to_query = sorted(set(t.uri for t in self.targets.values()
+                                  if t.uri not in self.nodes and t.uri not in queried
+                                  and not isinstance(t, TERMINAL_NODE_CLASSES)))
+
+    def add_neighbourhood(self, root_uris):
+        vals = summary_cypher_query(NEIGHBOURHOOD_QUERY, {"root_uris": root_uris, "source_names": list(self.source_names),
+                                                          "min_date": self.min_date}, nodes_per_row=2)
+        for n, t, out_edges, n_permitted, n_recent, t_permitted, t_recent in vals:
+            self.nodes[n.uri] = n
+            self.visible[n.uri] = n_permitted is True and n_recent is True
+            for rel_id, rel_type, other_uri, document_extract, weight in out_edges:
+                if rel_id in self.rel_ids:
+                    continue
+                self.rel_ids.add(rel_id)
+                self.edges[n.uri].append((rel_type, "to", other_uri, document_extract, weight))
+                self.edges[other_uri].append((rel_type, "from", n.uri, document_extract, weight))
+            if t is not None:
+                self.targets[n.uri] = t
+                self.visible[t.uri] = t_permitted is True and t_recent is True
+        merged_targets = [t for t in self.targets.values() if t.internalMergedSameAsHighToUri is not None]
+        if len(merged_targets) > 0: # Merged more than once
+            ultimate_targets = Resource.self_or_ultimate_target_node_map(merged_targets)
+            self.targets = {k: ultimate_targets.get(v.uri, v) for k, v in self.targets.items()}
+
+    def resolved(self, uri):
+        node = self.nodes[uri]
+        if node.internalMergedSameAsHighToUri is None:
+            return node
+        return self.targets.get(uri)
+
+    def is_visible(self, node):
+        visible = self.visible.get(node.uri)
+        if visible is None: # Target of a multi-step merge, so not checked in the query
+            visible = node.has_permitted_document_source(self.source_names) and (
+                        self.min_date is None or node.is_recent_enough(self.min_date))
+        return visible
+
+    def directional_relationships(self, node, override_from_uri=None):
+        '''
+            Same dicts as node.all_directional_relationships, built from the fetched relationships
+        '''
+        from_uri = override_from_uri or node.uri
+        labels = relationship_labels(node.__class__)
+        weight_filters = weight_filters_for(node, self.edges[node.uri])
+        found = []
+        for rel_type, direction, other_uri, document_extract, weight in self.edges[node.uri]:
+            candidates = labels.get((rel_type, direction))
+            if candidates is None:
+                continue
+            other_raw = self.nodes[other_uri]
+            other_node = self.resolved(other_uri)
+            if other_node is None or self.is_visible(other_node) is False:
+                continue
+            if isinstance(other_node, ActivityMixin) and other_node.internalMergedActivityWithSimilarRelationshipsToUri is not None:
+                continue
+            other_classes = set(x.__name__ for x in other_raw.__class__.__mro__)
+            for idx, label, class_name in candidates:
+                if class_name not in other_classes:
+                    continue
+                if label in weight_filters and weight_filters[label](weight) is False:
+                    continue
+                vals = {"from_uri": from_uri, "label":label, "direction":direction, "other_node":other_node}
+                if (isinstance(node, ActivityMixin) and isinstance(other_raw, Article)) or (
+                        isinstance(node, Article) and isinstance(other_raw, ActivityMixin)):
+                    vals["document_extract"] = document_extract
+                if (idx, vals) not in found:
+                    found.append((idx, vals))
+        return [vals for _, vals in sorted(found, key=lambda x: x[0])]
+
+
+RELATIONSHIP_LABELS = {}
+
+def relationship_labels(node_class):
+    '''
+        (relationship type, direction) -> [(definition order, label, other node class name)] for the relationships
+        all_directional_relationships would follow. Organization's internal_ relationships are shown without the prefix,
+        filtered by weight (see weight_filters_for).
+    '''
+    if node_class in RELATIONSHIP_LABELS:
+        return RELATIONSHIP_LABELS[node_class]
+    labels = defaultdict(list)
+    for idx, (label, rel) in enumerate(node_class.__all_relationships__):
+        if isinstance(rel, RelationshipTo):
+            direction = "to"
+        elif isinstance(rel, RelationshipFrom):
+            direction = "from"
+        else:
+            continue
+        raw_class = rel._raw_class if isinstance(rel._raw_class, str) else rel._raw_class.__name__
+        labels[(rel.definition["relation_type"], direction)].append((idx, label.removeprefix("internal_"), raw_class))
+    RELATIONSHIP_LABELS[node_class] = labels
+    return labels
+
+def weight_filters_for(node, edges):
+    '''
+        Organization shows the same industry clusters and locations as industries_for_org and
+        based_in_high_geo_names_locations_for_org, i.e. only those with a big enough share of the weight
+    '''
+    if not isinstance(node, Organization):
+        return {}
+    filters = {}
+    for label, min_proportion in [("industryClusterPrimary", INDUSTRY_CLUSTER_MIN_WEIGHT_PROPORTION),
+                                  ("basedInHighGeoNamesLocation", GEO_LOCATION_MIN_WEIGHT_PROPORTION)]:
+        total_weight = sum(weight or 0 for rel_type, direction, _, _, weight in edges if rel_type == label and direction == "to")
+        filters[label] = lambda weight, total_weight=total_weight, min_proportion=min_proportion: (
+                            weight is not None and weight > 1 and weight >= min_proportion * total_weight)
+    return filters
+
+
+class SubgraphBuilder:
+    '''
+        Accumulates node_data, edge_data, node_details and edge_details for graph_centered_on
+    '''
+
+    def __init__(self, root_node, neighbourhood, uris_to_ignore, combine_same_as_name_only, max_nodes):
+        self.neighbourhood = neighbourhood
+        self.uris_to_ignore = uris_to_ignore
+        self.combine_same_as_name_only = combine_same_as_name_only
+        self.max_nodes = max_nodes
+        self.nodes_found_so_far = set()
+        self.node_data = [ resource_to_node_data(root_node) ] # Nodes for graph
+        self.node_details = {root_node.uri:root_node.serialize_no_none()} # Node info to show on click
+        self.edge_data = [] # Edges for graph
+        self.edge_details = {} # Edge info to show on click
+
+    def too_many_nodes(self):
+        if len(self.node_data) > self.max_nodes:
+            logger.warning(f"got {len(self.node_data)} nodes - more than {self.max_nodes} - bailing")
+            return True
+        return False
+
+    def build_out_graph_entries(self, rel_data):
+        other_node = rel_data["other_node"]
+        other_node = keep_or_switch_node(other_node, self.nodes_found_so_far, self.combine_same_as_name_only)
+        logger.debug(f"From {rel_data['from_uri']} to {other_node.uri}")
+        if other_node.uri in self.uris_to_ignore:
+            logger.debug(f"Ignoring {other_node}")
+            return
+        # Add this relationship and node to the graph
+        next_edge = build_edge_vals(rel_data["direction"],rel_data["label"],rel_data["from_uri"],other_node.uri)
+        next_edge_id = next_edge["id"]
+        if next_edge_id in self.edge_details:
+            logger.debug(f"Already seen {next_edge_id}, ignoring")
+            return
+        self.edge_data.append(next_edge)
+        edge_detail = {"from_uri":rel_data["from_uri"],"to_uri":other_node.uri,"relationship":rel_data["label"]}
+        doc_extract = rel_data.get("document_extract")
+        if doc_extract is not None:
+            edge_detail["document_extract"] = doc_extract
+        self.edge_details[next_edge_id] = edge_detail
+        other_uri = other_node.uri
+        if other_uri in self.node_details:
+            logger.debug(f"{other_uri} already seen, not adding")
+            return
+        self.node_details[other_uri] = other_node.serialize_no_none()
+        self.node_data.append( resource_to_node_data(other_node))
+        # find more relationships
+        if not isinstance(other_node, TERMINAL_NODE_CLASSES):
+            for rel_data in self.neighbourhood.directional_relationships(other_node):
+                self.build_out_graph_entries(rel_data)
+                if self.too_many_nodes():
+                    return
 
 def keep_or_switch_node(current_node, nodes_found_so_far, combine_same_as_name_only):
     '''
@@ -122,44 +341,6 @@ def keep_or_switch_node(current_node, nodes_found_so_far, combine_same_as_name_o
     nodes_found_so_far.add(current_node)
     return current_node
 
-def build_out_graph_entries(rel_data, node_data, node_details, edge_data, edge_details, uris_to_ignore, 
-                            nodes_found_so_far, combine_same_as_name_only, source_names, min_date, max_nodes):
-    other_node = rel_data["other_node"]
-    other_node = keep_or_switch_node(other_node, nodes_found_so_far, combine_same_as_name_only)
-    logger.debug(f"From {rel_data['from_uri']} to {other_node.uri}")
-    if other_node.uri in uris_to_ignore:
-        logger.debug(f"Ignoring {other_node}")
-        return
-    if not isinstance(other_node, IndustryCluster) and other_node.internalDocId is None:
-        logger.debug(f"Not showing external {other_node}")
-    # Add this relationship and node to the graph
-    next_edge = build_edge_vals(rel_data["direction"],rel_data["label"],rel_data["from_uri"],other_node.uri)
-    next_edge_id = next_edge["id"]
-    if next_edge_id in edge_details:
-        logger.debug(f"Already seen {next_edge_id}, ignoring")
-        return
-    edge_data.append(next_edge)
-    edge_detail = {"from_uri":rel_data["from_uri"],"to_uri":other_node.uri,"relationship":rel_data["label"]}
-    doc_extract = rel_data.get("document_extract")
-    if doc_extract is not None:
-        edge_detail["document_extract"] = doc_extract
-    edge_details[next_edge_id] = edge_detail
-    other_uri = other_node.uri
-    if other_uri in node_details:
-        logger.debug(f"{other_uri} already seen, not adding")
-        return
-    node_details[other_uri] = other_node.serialize_no_none()
-    node_data.append( resource_to_node_data(other_node))
-    # find more relationships
-    if not isinstance(other_node, Organization) and not isinstance(other_node, IndustryCluster) and not isinstance(other_node, GeoNamesLocation) and not isinstance(other_node, Article):
-        for rel_data in other_node.all_directional_relationships(source_names=source_names,min_date=min_date):
-            build_out_graph_entries(rel_data, node_data, node_details, edge_data, edge_details, 
-                                    uris_to_ignore, nodes_found_so_far, combine_same_as_name_only, 
-                                    source_names, min_date, max_nodes)
-            if len(node_data) > max_nodes:
-                logger.warning(f"got {len(node_data)} nodes - more than {max_nodes} - bailing")
-                return None
-
 def build_edge_vals(direction, edge_label, source_node_id, target_node_id):
     if direction == "to":
         from_node_id = source_node_id
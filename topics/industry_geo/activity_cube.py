@@ -0,0 +1,252 @@
+'''
+    Array-backed index of org activities by industry and geo (country and/or admin1).
+
+    Built once per cache version by do_all_precalculations and stored as a single cache entry. Each worker
+    loads it into memory once per version, after which lookups are numpy slices rather than one
+    cache round trip per industry/geo cell.
+
+    Activities are bucketed by UTC day, so any whole-day date range within the period covered by the cube
+    can be answered with a binary search per cell.
+
+    Layout (CSR-style):
+        orgs are numbered in (-degree, internalDocId, uri) order and activities in (-datePublished, activity uri)
+        order, so any ascending array of indexes is already in display order.
+        cell_keys[i] is (industry_topic_id, country_code, admin1_code) with None for the unused dimensions
+        cell_org_ptr/cell_org_idx: orgs in each cell
+        cell_act_ptr/cell_act_idx: activities of the orgs in each cell
+        cell_bucket_ptr/cell_bucket_days/cell_bucket_ends: for each cell, the distinct days (newest first) that
+            have activities and the running total of activities up to and including that day
+        org_act_ptr/org_act_idx: activities for each org
+'''
+
+import logging
+import uuid
+import numpy as np
+from collections import defaultdict
+from datetime import datetime, timezone
+from syracuse.cache_util import get_versionable_cache, set_versionable_cache, default_version
+
+logger = logging.getLogger(__name__)
+
+ACTIVITY_CUBE_CACHE_KEY = "orgs_acts_cube"
+ACTIVITY_CUBE_ID_CACHE_KEY = "orgs_acts_cube_id"
+NO_INDUSTRY = np.iinfo(np.int64).min # topicIds can be negative
+LOADED_CUBES = {} # version -> cube, so each worker only unpickles the cube once per version
+
+
+def to_csr(lists):
+    ptr = np.zeros(len(lists) + 1, dtype=np.int64)
+    ptr[1:] = np.cumsum([len(x) for x in lists])
+    if ptr[-1] == 0:
+        return ptr, np.zeros(0, dtype=np.int64)
+    idx = np.concatenate([np.asarray(x, dtype=np.int64) for x in lists])
+    return ptr, idx
+
+
+def day_number(d):
+    if isinstance(d, datetime) and d.tzinfo is not None:
+        d = d.astimezone(timezone.utc)
+    return d.toordinal()
+
+
+def clean_cell_key(industry_topic_id, country_code, admin1_code):
+    if industry_topic_id == '':
+        industry_topic_id = None
+    if industry_topic_id is not None:
+        industry_topic_id = int(industry_topic_id)
+    if country_code == '':
+        country_code = None
+    if admin1_code == '':
+        admin1_code = None
+    return (industry_topic_id, country_code, admin1_code)
+
+
+class IndustryGeoActivityCube:
+
+    def __init__(self, groups, min_date, max_date, fill_blanks=True):
+        '''
+        groups: dict of (industry_topic_id, country_code, admin1_code) -> list of (o.uri, degree, o.internalDocId, articleData)
+                as returned by group_org_facts for min_date - max_date
+        fill_blanks: if False, querying a cell with no orgs raises ValueError rather than returning empty results
+        '''
+        self.cube_id = uuid.uuid4().hex
+        self.min_date = min_date
+        self.max_date = max_date
+        self.fill_blanks = fill_blanks
+
+        org_data = {}
+        for org_data_l in groups.values():
+            for uri, rel_count, doc_id, article_data in org_data_l:
+                org_data[uri] = (rel_count, doc_id, article_data)
+        self.org_uris = sorted(org_data.keys(), key=lambda x: (-org_data[x][0], org_data[x][1], x))
+        self.org_rel_counts = np.array([org_data[x][0] for x in self.org_uris], dtype=np.int64)
+        self.org_doc_ids = [org_data[x][1] for x in self.org_uris]
+        org_index = {uri: i for i, uri in enumerate(self.org_uris)}
+
+        acts = set()
+        for _, _, article_data in org_data.values():
+            acts.update(tuple(x) for x in article_data)
+        self.act_rows = sorted(acts, key=lambda x: (-(x[2].timestamp()), x[0]))
+        self.act_days = np.array([day_number(x[2]) for x in self.act_rows], dtype=np.int64) # non-increasing
+        act_index = {x: i for i, x in enumerate(self.act_rows)}
+
+        self.org_act_ptr, self.org_act_idx = to_csr(
+            [sorted({act_index[tuple(x)] for x in org_data[uri][2]}) for uri in self.org_uris])
+
+        self.cell_keys = sorted(groups.keys(), key=lambda k: tuple("" if x is None else str(x) for x in k))
+        self.cell_index = {k: i for i, k in enumerate(self.cell_keys)}
+        self.cell_industry = np.array([NO_INDUSTRY if k[0] is None else k[0] for k in self.cell_keys], dtype=np.int64)
+        self.cell_country = np.array(["" if k[1] is None else k[1] for k in self.cell_keys], dtype=str)
+        self.cell_admin1 = np.array(["" if k[2] is None else k[2] for k in self.cell_keys], dtype=str)
+
+        cell_orgs = [np.unique([org_index[x[0]] for x in groups[k]]) for k in self.cell_keys]
+        self.cell_org_ptr, self.cell_org_idx = to_csr(cell_orgs)
+        self.cell_act_ptr, self.cell_act_idx = to_csr(
+            [np.unique(self.org_act_idx[self.org_act_range(org_idxs)]) for org_idxs in cell_orgs])
+        bucket_days = []
+        bucket_ends = []
+        for idx in range(len(self.cell_keys)):
+            days = self.act_days[self.cell_act_idx[self.cell_act_ptr[idx]:self.cell_act_ptr[idx+1]]]
+            is_last_of_day = np.append(days[1:] != days[:-1], True) if len(days) > 0 else np.zeros(0, dtype=bool)
+            bucket_days.append(days[is_last_of_day])
+            bucket_ends.append(np.nonzero(is_last_of_day)[0] + 1)
+        self.cell_bucket_ptr, self.cell_bucket_days = to_csr(bucket_days)
+        _, self.cell_bucket_ends = to_csr(bucket_ends)
+        logger.info(f"Activity cube: {len(self.cell_keys)} cells, {len(self.org_uris)} orgs, {len(self.act_rows)} activities")
+
+    def org_act_range(self, org_idxs):
+        '''
+            Positions in org_act_idx of all the activities of org_idxs
+        '''
+        org_idxs = np.asarray(org_idxs, dtype=np.int64)
+        starts = self.org_act_ptr[org_idxs]
+        lengths = self.org_act_ptr[org_idxs + 1] - starts
+        ends = np.cumsum(lengths)
+        return np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) > 0 else 0)
+
+    def day_range(self, min_date, max_date):
+        '''
+            Raises ValueError for a range starting before the cube's coverage rather than returning truncated counts
+        '''
+        if day_number(min_date) < day_number(self.min_date):
+            raise ValueError(f"No cached stats from {min_date}, activity cube covers {self.min_date} - {self.max_date}")
+        return day_number(min_date), day_number(max_date)
+
+    def cell(self, industry_topic_id, country_code, admin1_code):
+        key = clean_cell_key(industry_topic_id, country_code, admin1_code)
+        idx = self.cell_index.get(key)
+        if idx is None and self.fill_blanks is False:
+            raise ValueError(f"No cached stats for {key}")
+        return idx
+
+    def in_window(self, act_idxs, min_day, max_day):
+        '''
+            act_idxs are ascending so their days are descending: the date range is a contiguous slice
+        '''
+        neg_days = -self.act_days[act_idxs]
+        start = np.searchsorted(neg_days, -max_day, side="left")
+        end = np.searchsorted(neg_days, -min_day, side="right")
+        return act_idxs[start:end]
+
+    def cell_window(self, idx, min_day, max_day):
+        '''
+            Start and end offsets within the cell's activities, from the running totals of the matching days
+        '''
+        neg_days = -self.cell_bucket_days[self.cell_bucket_ptr[idx]:self.cell_bucket_ptr[idx+1]]
+        ends = self.cell_bucket_ends[self.cell_bucket_ptr[idx]:self.cell_bucket_ptr[idx+1]]
+        first_bucket = np.searchsorted(neg_days, -max_day, side="left")
+        last_bucket = np.searchsorted(neg_days, -min_day, side="right")
+        start = ends[first_bucket - 1] if first_bucket > 0 else 0
+        end = ends[last_bucket - 1] if last_bucket > 0 else 0
+        return start, max(start, end)
+
+    def cell_activity_idxs(self, min_date, max_date, industry_topic_id, country_code, admin1_code):
+        min_day, max_day = self.day_range(min_date, max_date)
+        idx = self.cell(industry_topic_id, country_code, admin1_code)
+        if idx is None:
+            return np.zeros(0, dtype=np.int64)
+        start, end = self.cell_window(idx, min_day, max_day)
+        return self.cell_act_idx[self.cell_act_ptr[idx] + start:self.cell_act_ptr[idx] + end]
+
+    def activities(self, min_date, max_date, industry_topic_id, country_code, admin1_code):
+        '''
+            List of (activity_uri, article_uri, date_published) sorted newest first
+        '''
+        act_idxs = self.cell_activity_idxs(min_date, max_date, industry_topic_id, country_code, admin1_code)
+        return [self.act_rows[i] for i in act_idxs]
+
+    def activity_count(self, min_date, max_date, industry_topic_id, country_code, admin1_code):
+        min_day, max_day = self.day_range(min_date, max_date)
+        idx = self.cell(industry_topic_id, country_code, admin1_code)
+        if idx is None:
+            return 0
+        start, end = self.cell_window(idx, min_day, max_day)
+        return int(end - start)
+
+    def orgs(self, min_date, max_date, industry_topic_id, country_code, admin1_code):
+        '''
+            List of (o.uri, degree, o.internalDocId, articleData) sorted by degree, with articleData in the date range
+        '''
+        min_day, max_day = self.day_range(min_date, max_date)
+        idx = self.cell(industry_topic_id, country_code, admin1_code)
+        if idx is None:
+            return []
+        res = []
+        for org_idx in self.cell_org_idx[self.cell_org_ptr[idx]:self.cell_org_ptr[idx+1]]:
+            act_idxs = self.org_act_idx[self.org_act_ptr[org_idx]:self.org_act_ptr[org_idx+1]]
+            article_data = [list(self.act_rows[i]) for i in self.in_window(act_idxs, min_day, max_day)]
+            res.append( (self.org_uris[org_idx], int(self.org_rel_counts[org_idx]), self.org_doc_ids[org_idx], article_data) )
+        return res
+
+    def org_groups(self, min_date, max_date, exclude_org_uris=set()):
+        '''
+            Inverse of the constructor: dict of (industry_topic_id, country_code, admin1_code) -> list of
+            (o.uri, degree, o.internalDocId, articleData), for copying cells forward into a new cube
+        '''
+        min_day, max_day = self.day_range(min_date, max_date)
+        org_rows = {}
+        groups = defaultdict(list)
+        for idx, key in enumerate(self.cell_keys):
+            for org_idx in self.cell_org_idx[self.cell_org_ptr[idx]:self.cell_org_ptr[idx+1]]:
+                if self.org_uris[org_idx] in exclude_org_uris:
+                    continue
+                if org_idx not in org_rows:
+                    act_idxs = self.org_act_idx[self.org_act_ptr[org_idx]:self.org_act_ptr[org_idx+1]]
+                    org_rows[org_idx] = (self.org_uris[org_idx], int(self.org_rel_counts[org_idx]), self.org_doc_ids[org_idx],
+                                         [list(self.act_rows[i]) for i in self.in_window(act_idxs, min_day, max_day)])
+                groups[key].append(org_rows[org_idx])
+        return groups
+
+    def org_counts_by_geo(self, industry_topic_ids):
+        '''
+            Returns dict of (industry_topic_id, country_code, admin1_code) -> number of orgs
+            for every non-empty geo cell of the given industries
+        '''
+        industry_topic_ids = [int(x) for x in industry_topic_ids]
+        mask = np.isin(self.cell_industry, industry_topic_ids) & (self.cell_country != "")
+        cell_idxs = np.nonzero(mask)[0]
+        counts = np.diff(self.cell_org_ptr)[cell_idxs]
+        return {self.cell_keys[i]: int(cnt) for i, cnt in zip(cell_idxs, counts) if cnt > 0}
+
+
+def save_activity_cube(cube, cache_version):
+    set_versionable_cache(ACTIVITY_CUBE_CACHE_KEY, cube, cache_version)
+    set_versionable_cache(ACTIVITY_CUBE_ID_CACHE_KEY, cube.cube_id, cache_version)
+    LOADED_CUBES[cache_version] = cube
+
+
+def get_activity_cube(cache_version=None):
+    if cache_version is None:
+        cache_version = default_version()
+    cube_id = get_versionable_cache(ACTIVITY_CUBE_ID_CACHE_KEY, cache_version)
+    if cube_id is None:
+        raise ValueError(f"No activity cube for {cache_version}")
+    cube = LOADED_CUBES.get(cache_version)
+    if cube is not None and cube.cube_id == cube_id:
+        return cube
+    logger.info(f"Loading activity cube {cube_id} for {cache_version}")
+    cube = get_versionable_cache(ACTIVITY_CUBE_CACHE_KEY, cache_version)
+    if cube is None:
+        raise ValueError(f"No activity cube for {cache_version}")
+    LOADED_CUBES[cache_version] = cube
+    return cube
@@ -1,5 +1,5 @@
 from neomodel import db
-from topics.industry_geo.geoname_mappings import get_geo_data
+from topics.industry_geo.geoname_mappings import get_many_geo_data
 import logging
 logger = logging.getLogger(__name__)
 
@@ -17,10 +17,11 @@ def update_geonames_locations_with_country_admin1(version):
         if len(res) == 0:
             logger.info("No more entities found, quitting")
             break
+        geo_data = get_many_geo_data([objs[0].geoNamesId for objs in res], version)
         for objs in res:
             obj = objs[0]
             geonamesid = obj.geoNamesId
-            res = get_geo_data(geonamesid, version)
+            res = geo_data.get(geonamesid)
             if res is None:
                 raise ValueError(f"No cached geo data for {geonamesid}")
             else:        
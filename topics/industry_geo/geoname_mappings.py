@@ -5,7 +5,8 @@ from topics.industry_geo.region_hierarchies import (COUNTRIES_WITH_STATE_PROVINC
     US_REGIONS_TO_STATES_HIERARCHY, GLOBAL_REGION_TO_COUNTRY
 )
 from neomodel import db
-from syracuse.cache_util import set_versionable_cache, get_versionable_cache
+from syracuse.cache_util import (set_versionable_cache, get_versionable_cache, copy_versionable_cache,
+    get_many_versionable_cache, set_many_versionable_cache)
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +14,8 @@ COUNTRY_TO_ADMIN1_PREFIX = "country_to_admin1_"
 GEO_DATA_PREFIX = "geodata_"
 CC_ADMIN1_CODE_TO_ADMIN1_NAME_PREFIX = "cc_adm1code_to_adm1name_" # key = US-TX etc
 CC_ADMIN1_NAME_TO_ADMIN1_CODE_PREFIX = "cc_adm1name_to_adm1code_" #  key = US_Texas
+GEO_CACHE_PREFIXES = [COUNTRY_TO_ADMIN1_PREFIX, GEO_DATA_PREFIX, CC_ADMIN1_CODE_TO_ADMIN1_NAME_PREFIX,
+                      CC_ADMIN1_NAME_TO_ADMIN1_CODE_PREFIX]
 
 
 def get_geo_data(geonameid,version=None):
@@ -21,22 +24,54 @@ def get_geo_data(geonameid,version=None):
     ''' 
     return get_versionable_cache(f"{GEO_DATA_PREFIX}{geonameid}", version)
 
+def get_many_geo_data(geonameids, version=None):
+    '''
+        Returns dict of geonameid -> geo data (as for get_geo_data) for the geonameids that are cached
+    '''
+    res = get_many_versionable_cache([f"{GEO_DATA_PREFIX}{x}" for x in geonameids], version)
+    return {x: res[f"{GEO_DATA_PREFIX}{x}"] for x in geonameids if f"{GEO_DATA_PREFIX}{x}" in res}
+
 def admin1s_for_country(country_code, version=None):
     return get_versionable_cache(f"{COUNTRY_TO_ADMIN1_PREFIX}{country_code}", version)
 
+def admin1s_for_countries(country_codes, version=None):
+    '''
+        Returns dict of country_code -> admin1 list (or None if not cached)
+    '''
+    res = get_many_versionable_cache([f"{COUNTRY_TO_ADMIN1_PREFIX}{x}" for x in country_codes], version)
+    return {x: res.get(f"{COUNTRY_TO_ADMIN1_PREFIX}{x}") for x in country_codes}
+
 def get_available_geoname_ids():
     res, _ = db.cypher_query("MATCH (n: GeoNamesLocation) RETURN DISTINCT(n.geoNamesId)")
     flattened = [x for sublist in res for x in sublist]
     return set(flattened)
 
+def get_geoname_ids_without_country_admin1():
+    res, _ = db.cypher_query("""MATCH (n: Resource&GeoNamesLocation)
+                                WHERE n.countryCode IS NULL AND n.countryList IS NULL
+                                RETURN DISTINCT(n.geoNamesId)""")
+    return set([x[0] for x in res])
+
+def copy_country_mapping(from_version, to_version):
+    cnt = 0
+    for prefix in GEO_CACHE_PREFIXES:
+        cnt += copy_versionable_cache(prefix, from_version, to_version)
+    logger.info(f"Copied {cnt} geonames cache entries from {from_version} to {to_version}")
+    return cnt
+
 def prepare_country_mapping(version=None,
                             fpath="dump/relevant_geo.csv", 
-                            countries_for_admin1=COUNTRIES_WITH_STATE_PROVINCE):
+                            countries_for_admin1=COUNTRIES_WITH_STATE_PROVINCE,
+                            geoname_ids=None, batch_size=10_000):
+    '''
+        geoname_ids: only cache geo data for these geonames, otherwise for every GeoNamesLocation in the graph
+    '''
     logger.info("Started loading geonames")
-    existing_geonames = get_available_geoname_ids()
+    existing_geonames = get_available_geoname_ids() if geoname_ids is None else set(geoname_ids)
     cnt = 0
     geonameid_data = {}
     country_code_to_admin1 = defaultdict(set)
+    to_cache = {}
     with open(fpath,"r") as f:
         reader = csv.DictReader(f)
         for row in reader:
@@ -59,14 +94,18 @@ def prepare_country_mapping(version=None,
                     "admin1": admin1,
                     "country_list": cc_list,
                 }
-                set_versionable_cache(f"{GEO_DATA_PREFIX}{geo_id}",geonameid_data[geo_id], version)               
+                to_cache[f"{GEO_DATA_PREFIX}{geo_id}"] = geonameid_data[geo_id]
             if fc == 'ADM1' and cc in countries_for_admin1 and admin1 != '' and admin1 != '00': # The code '00' stands for 'we don't know the official code'. https://forum.geonames.org/gforum/posts/list/703.page
                 country_code_to_admin1[cc].add(admin1)
                 admin1_name = row['name']
-                set_versionable_cache( f"{CC_ADMIN1_CODE_TO_ADMIN1_NAME_PREFIX}{cc}-{admin1}", admin1_name, version)                
-                set_versionable_cache( f"{CC_ADMIN1_NAME_TO_ADMIN1_CODE_PREFIX}{cc}-{admin1_name}", admin1, version)
+                to_cache[f"{CC_ADMIN1_CODE_TO_ADMIN1_NAME_PREFIX}{cc}-{admin1}"] = admin1_name
+                to_cache[f"{CC_ADMIN1_NAME_TO_ADMIN1_CODE_PREFIX}{cc}-{admin1_name}"] = admin1
+            if len(to_cache) >= batch_size:
+                set_many_versionable_cache(to_cache, version)
+                to_cache = {}
     for k,vs in country_code_to_admin1.items():
-        set_versionable_cache(f"{COUNTRY_TO_ADMIN1_PREFIX}{k}",list(vs),version)
+        to_cache[f"{COUNTRY_TO_ADMIN1_PREFIX}{k}"] = list(vs)
+    set_many_versionable_cache(to_cache, version)
     logger.info(f"Processed: {cnt} records.")
     return geonameid_data, country_code_to_admin1
 
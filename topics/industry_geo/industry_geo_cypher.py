@@ -7,49 +7,59 @@ from topics.industry_geo.geoname_mappings import COUNTRIES_WITH_STATE_PROVINCE
 
 logger = logging.getLogger(__name__)
 
-def build_and_run_query(min_date, max_date, include_industry=True, include_geo=True, include_admin1=False):
-    query = build_query(min_date, max_date, include_industry, include_geo, include_admin1)
+def build_and_run_facts_query(min_date, max_date, org_uris=None):
+    query = build_facts_query(min_date, max_date, restrict_to_org_uris=org_uris is not None)
     logger.debug(query)
-    vals, _ = db.cypher_query(query)
+    vals, _ = db.cypher_query(query, {"org_uris": list(org_uris or [])})
     return vals
 
-def build_query(min_date, max_date, include_industry, include_geo, include_admin1):
-    if include_industry is False and include_geo is False:
-        raise ValueError(f"Must use industry or geo")
-    if include_geo is False and include_admin1 is True:
-        raise ValueError("If include_admin1 is set then also need to have include_geo set")
-    industry_section = build_industry_section() if include_industry else ""
-    geo_section = build_geo_section(include_admin1) if include_geo else ""
+def build_facts_query(min_date, max_date, restrict_to_org_uris=False):
+    '''
+        One row per unmerged org that has an industry or a location:
+        o.uri, degree, o.internalDocId, [industry topicIds], [[countryCode, admin1Code]], articleData
+        where each articleData is: act.uri, art.uri, art.datePublished
+        If restrict_to_org_uris then only the orgs in $org_uris
+    '''
+    org_uris_section = "AND o.uri IN $org_uris" if restrict_to_org_uris else ""
     query = f"""
         MATCH (o:Resource&Organization)
         WHERE o.internalMergedSameAsHighToUri IS NULL
-        {industry_section}
-        {geo_section}
+        {org_uris_section}
+        {build_industry_section()}
+        {build_geo_section()}
+        WITH o, ics, locs
+        WHERE SIZE(ics) > 0 OR SIZE(locs) > 0
         {build_article_section(min_date,max_date)}
-        {build_return_stmt(include_industry, include_geo, include_admin1)}
+        RETURN o.uri, coalesce(o.internalDegree, apoc.node.degree(o)), o.internalDocId,
+            [ic IN ics | ic.topicId], [loc IN locs | [loc.countryCode, loc.admin1Code]],
+            [x IN articles1 + articles2 WHERE x[0] IS NOT NULL]
     """
     return query
 
-def build_return_stmt(include_industry, include_geo, include_admin1):
-    to_return = []
-    withs = ["o", "articles1 + articles2 as allArticleData"]
-    unwinds = []
-    if include_industry:
-        to_return.append("ic.topicId")
-        withs.append("ics")
-        unwinds.append("unwind ics as ic")
-    if include_geo:
-        to_return.append("loc.countryCode")
-        withs.append("locs")
-        unwinds.append("unwind locs as loc")
-    if include_admin1:
-        to_return.append("loc.admin1Code")
-    assert len(to_return) > 0, f"{to_return} has to have at least one item to return"
-    with_stmt = "with " + ",".join(withs)
-    unwind_stmt = " ".join(unwinds)
-    return_stmt = f"RETURN {', '.join(to_return)} , collect([o.uri, apoc.node.degree(o), o.internalDocId, allArticleData])"
-    return f"{with_stmt} {unwind_stmt} {return_stmt}"
+def org_uris_touched_by_doc_ids(doc_ids):
+    '''
+        Orgs that are a documentSource of any of the articles in doc_ids.
+        Returns set of unmerged org uris, set of merged org uris
+    '''
+    query = """
+        MATCH (art:Resource&Article)<-[:documentSource]-(o:Resource&Organization)
+        WHERE art.internalDocId IN $doc_ids
+        RETURN DISTINCT o.uri, o.internalMergedSameAsHighToUri IS NULL
+    """
+    vals, _ = db.cypher_query(query, {"doc_ids": list(doc_ids)})
+    unmerged = {uri for uri, is_unmerged in vals if is_unmerged is True}
+    merged = {uri for uri, is_unmerged in vals if is_unmerged is False}
+    return unmerged, merged
 
+def merged_org_uris(org_uris):
+    query = """
+        MATCH (o:Resource&Organization)
+        WHERE o.uri IN $org_uris
+        AND o.internalMergedSameAsHighToUri IS NOT NULL
+        RETURN o.uri
+    """
+    vals, _ = db.cypher_query(query, {"org_uris": list(org_uris)})
+    return {x[0] for x in vals}
 
 def build_industry_section(return_as_collect=True):
     if return_as_collect:   
@@ -11,17 +11,25 @@ from .hierarchy_utils import filtered_hierarchy, hierarchy_widths
 from typing import List
 from syracuse.date_util import date_minus, min_and_max_date
 from topics.neo4j_utils import neo4j_date_converter
-from topics.industry_geo.geoname_mappings import COUNTRIES_WITH_STATE_PROVINCE, admin1s_for_country
+from topics.industry_geo.geoname_mappings import COUNTRIES_WITH_STATE_PROVINCE, admin1s_for_country, admin1s_for_countries
 from topics.industry_geo.region_hierarchies import COUNTRY_TO_GLOBAL_REGION
 import logging
 from datetime import date
-from syracuse.cache_util import set_versionable_cache, get_versionable_cache
-from topics.industry_geo.industry_geo_cypher import build_and_run_query
+from django.conf import settings
+from syracuse.cache_util import (get_versionable_cache, get_many_versionable_cache,
+    set_many_versionable_cache, cached_compute, refresh_in_background, SoftExpiringValue, unwrap_soft_expiring,
+    default_version)
+from topics.industry_geo.industry_geo_cypher import (build_and_run_facts_query, org_uris_touched_by_doc_ids,
+    merged_org_uris)
+from topics.industry_geo.activity_cube import IndustryGeoActivityCube, save_activity_cube, get_activity_cube
 from topics.organization_search_helpers import remove_same_as_name_onlies
 from topics.industry_geo import geo_to_country_admin1
 
 logger = logging.getLogger(__name__)
 
+ORGS_BY_INDUSTRY_TEXT_SOFT_TIMEOUT = 60*60*4 # Recompute in the background after 4 hours
+ORGS_BY_INDUSTRY_TEXT_TIMEOUT = 60*60*8
+
 def cached_activity_stats_last_updated_date():
     return get_versionable_cache("activity_stats_last_updated")
 
@@ -43,127 +51,113 @@ def org_uris_by_industry_id_and_or_geo_code(industry_topic_id,geo_code,return_or
     else:
         return orgs_with_rel_counts
 
-def get_org_activities_cache_key(min_date,max_date,industry_id,country,admin1):
-    name = f"orgs_acts_{min_date}_{max_date}_{industry_id}_{country}_{admin1}"
-    return name
-
 def get_org_activity_counts(min_date,max_date,industry,country_code,admin1, cache_version):
-    acts = get_org_activities(min_date,max_date,industry,country_code,admin1, cache_version)
-    return len(acts)
+    return get_activity_cube(cache_version).activity_count(min_date,max_date,industry,country_code,admin1)
 
 def get_org_activities(min_date,max_date,industry,country_code,admin1, cache_version):
-    cache_key = get_org_activities_cache_key(min_date,max_date,industry,country_code,admin1)
-    org_datas = get_versionable_cache(cache_key, cache_version)
-    if org_datas is None:
-        raise ValueError(f"No cached stats for {cache_version} {min_date} {max_date} {industry} {country_code} {admin1} (key {cache_key})")
-    acts = set()
-    for row in org_datas:
-        act_datas = row[-1]
-        for act_data in act_datas:
-            if act_data[0] is not None:
-                acts.add(tuple(act_data))
-    return sorted(acts, key=lambda x: ( -(x[2].timestamp()), x[0]))
+    return get_activity_cube(cache_version).activities(min_date,max_date,industry,country_code,admin1)
 
 def org_uris_by_industry_id_country_admin1(industry_cluster_topic_id, 
                                      country_code, admin1_code=None,min_date=None, max_date=None,
                                      cache_version=None):
-    if country_code == '':
-        country_code = None
-    if admin1_code == '':
-        admin1_code = None
-    if industry_cluster_topic_id == '':
-        industry_cluster_topic_id = None
     min_date, max_date = min_and_max_date({"min_date":min_date,"max_date":max_date})  # None max date will use latest cached data 
-    cache_key = get_org_activities_cache_key(min_date,max_date,industry_cluster_topic_id,country_code,admin1_code)
-    res = get_versionable_cache(cache_key,cache_version)
-    if res is None:
-        raise ValueError(f"No result for {cache_key}")
-    return res
+    return get_activity_cube(cache_version).orgs(min_date,max_date,industry_cluster_topic_id,country_code,admin1_code)
 
-def convert_and_cache_org_results(org_data_l, cache_version,cache_key):
-    '''
-    org_data_l is: o.uri, apoc.node.degree(o), o.internalDocId, articleData
-    and each articleData is: act.uri, art.uri, art.datePublished
-
-    1. Sort nodes by number of relationships
-    2. Convert neo4j datetimes to python for redis
-    '''
-    org_data = sorted(org_data_l, key=lambda v: (-v[1], v[2], v[0]))
-    converted = [
-        (uri,rel_count,doc_id, neo4j_date_converter(article_data))
-        for uri,rel_count,doc_id,article_data in org_data
+def load_org_industry_geo_facts(min_date, max_date, org_uris=None):
+    res = build_and_run_facts_query(min_date, max_date, org_uris)
+    return [
+        (uri, rel_count, doc_id, topic_ids, locs, neo4j_date_converter(article_data))
+        for uri, rel_count, doc_id, topic_ids, locs, article_data in res
     ]
-    set_versionable_cache(cache_key, converted, cache_version)
-    return converted
 
+def group_org_facts(facts, min_date, max_date):
+    '''
+    Returns dict of (industry_topic_id, country_code, admin1_code) -> list of (o.uri, degree, o.internalDocId, articleData),
+    with articleData restricted to min_date - max_date. Each org appears once per group.
+    '''
+    groups = defaultdict(list)
+    for uri, rel_count, doc_id, topic_ids, locs, article_data in facts:
+        org_row = (uri, rel_count, doc_id, [x for x in article_data if min_date <= x[2] <= max_date])
+        country_codes = {cc for cc, _ in locs if cc is not None}
+        admin1s = {(cc, adm1) for cc, adm1 in locs if cc in COUNTRIES_WITH_STATE_PROVINCE
+                                                        and adm1 is not None and adm1 != '00'}
+        keys = {(None, cc, None) for cc in country_codes} | {(None, cc, adm1) for cc, adm1 in admin1s}
+        for topic_id in topic_ids:
+            keys.add( (topic_id, None, None) )
+            keys.update( (topic_id, cc, None) for cc in country_codes )
+            keys.update( (topic_id, cc, adm1) for cc, adm1 in admin1s )
+        for key in keys:
+            groups[key].append(org_row)
+    return groups
 
 def do_all_precalculations(cache_version, max_date=date.today(), fill_blanks=True):
-    days_ago_90 = date_minus(max_date,90)
-    days_ago_30 = date_minus(max_date,30)
-    days_ago_7 = date_minus(max_date,7)
-    for min_date_tmp in days_ago_90, days_ago_30, days_ago_7:
-        min_date, max_date = min_and_max_date({"min_date":min_date_tmp,"max_date":max_date})
-        logger.info(f"Precalculating activities: {min_date} - {max_date}")
-        res = build_and_run_query(min_date, max_date, include_industry=True, include_geo=False)
-        for industry_topic_id, org_data_l in res:
-            cache_key = get_org_activities_cache_key(min_date,max_date,industry_topic_id,None,None)
-            _ = convert_and_cache_org_results(org_data_l, cache_version, cache_key)
-        logger.debug("Industry done")
-        res = build_and_run_query(min_date, max_date, include_industry=False, include_geo=True)
-        for country_code, org_data_l in res:
-            cache_key = get_org_activities_cache_key(min_date,max_date,None,country_code,None)
-            _ = convert_and_cache_org_results(org_data_l, cache_version, cache_key)
-        logger.debug("Country done")
-        res = build_and_run_query(min_date, max_date, include_industry=True, include_geo=True)
-        for industry_topic_id, country_code, org_data_l in res:
-            cache_key = get_org_activities_cache_key(min_date,max_date,industry_topic_id,country_code,None)
-            _ = convert_and_cache_org_results(org_data_l, cache_version, cache_key)
-        logger.debug("Industry & Country done")
-        res = build_and_run_query(min_date, max_date, include_industry=True, include_geo=True, include_admin1=True)
-        for industry_topic_id, country_code, admin1_code, org_data_l in res:
-            cache_key = get_org_activities_cache_key(min_date,max_date,industry_topic_id,country_code,admin1_code)
-            _ = convert_and_cache_org_results(org_data_l, cache_version, cache_key)
-        logger.debug("Industry, Country, Admin1 Done")
-        res = build_and_run_query(min_date, max_date, include_industry=False, include_geo=True, include_admin1=True)
-        cache_key = get_org_activities_cache_key(min_date,max_date,False,True,True)
-        for country_code, admin1_code, org_data_l in res:
-            cache_key = get_org_activities_cache_key(min_date,max_date,None,country_code,admin1_code)
-            _ = convert_and_cache_org_results(org_data_l, cache_version, cache_key)
-        logger.info("Existing industry/country/admin1 done")
-        if fill_blanks is True:
-            set_not_found_industry_geo_to_empty_list(min_date, max_date, cache_version)
-            logger.info("Set not found to [] done")
-
-def set_not_found_industry_geo_to_empty_list(min_date, max_date, cache_version):
-    industry_topic_ids = [None] + [x.topicId for x in IndustryCluster.all_leaf_nodes()]
-    country_codes = [None] + list(COUNTRY_TO_GLOBAL_REGION.keys())
-    for topic_id in industry_topic_ids:
-        for country_code in country_codes:
-            if topic_id is None and country_code is None:
-                continue # Not allowed
-            cache_key = get_org_activities_cache_key(min_date,max_date,topic_id,country_code,None)
-            if get_versionable_cache(cache_key, cache_version) is None:
-                set_versionable_cache(cache_key, [], cache_version)
-            if country_code in COUNTRIES_WITH_STATE_PROVINCE:
-                admin1_list = admin1s_for_country(country_code, cache_version)
-                for adm1 in admin1_list:
-                    cache_key = get_org_activities_cache_key(min_date,max_date,topic_id,country_code,adm1)
-                    if get_versionable_cache(cache_key,cache_version) is None:
-                       set_versionable_cache(cache_key, [], cache_version)
-
-
-def orgs_by_industry_text_and_geo(industry_text, country_code, admin1_code=None):
+    days_ago = max(90, settings.ACTIVITY_INDEX_DAYS)
+    min_date, max_date = min_and_max_date({"min_date":date_minus(max_date,days_ago),"max_date":max_date})
+    logger.info(f"Loading org industry/geo facts: {min_date} - {max_date}")
+    facts = load_org_industry_geo_facts(min_date, max_date)
+    logger.info(f"Loaded {len(facts)} orgs")
+    groups = group_org_facts(facts, min_date, max_date)
+    cube = IndustryGeoActivityCube(groups, min_date, max_date, fill_blanks=fill_blanks)
+    save_activity_cube(cube, cache_version)
+    logger.info("Activity cube saved")
+
+def do_incremental_precalculations(cache_version, doc_ids, previous_cache_version, max_date=date.today(), fill_blanks=True):
+    '''
+        Only reload the orgs touched by doc_ids, copying every other org's cells forward from the previous cube.
+        Raises ValueError if there is no previous cube to start from, or it doesn't cover this date range.
+    '''
+    previous_cube = get_activity_cube(previous_cache_version)
+    days_ago = max(90, settings.ACTIVITY_INDEX_DAYS)
+    min_date, max_date = min_and_max_date({"min_date":date_minus(max_date,days_ago),"max_date":max_date})
+    touched, merged = org_uris_touched_by_doc_ids(doc_ids)
+    merged = merged | merged_org_uris(previous_cube.org_uris)
+    logger.info(f"{len(doc_ids)} new docs touch {len(touched)} orgs, {len(merged)} orgs are now merged")
+    groups = previous_cube.org_groups(min_date, max_date, exclude_org_uris=touched | merged)
+    facts = load_org_industry_geo_facts(min_date, max_date, touched)
+    for key, org_rows in group_org_facts(facts, min_date, max_date).items():
+        groups[key].extend(org_rows)
+    cube = IndustryGeoActivityCube(groups, min_date, max_date, fill_blanks=fill_blanks)
+    save_activity_cube(cube, cache_version)
+    logger.info("Activity cube saved")
+
+
+def orgs_by_industry_text_and_geo_cache_key(industry_text, country_code, admin1_code=None):
     cache_key = f"orgs_ind_text_{country_code}"
     if admin1_code is not None:
         cache_key = f"{cache_key}_{admin1_code}"
-    cache_key = f"{cache_key}_{industry_text}"
-    res = get_versionable_cache(cache_key)
-    if res is not None:
-        return res
-    logger.debug(f"cache miss {cache_key}")
-    res = Organization.by_industry_text_and_geo(industry_text, country_code, admin1_code)
-    set_versionable_cache(cache_key, res, timeout=60*60*4) # 4 hour cache timeout
-    return res
+    return f"{cache_key}_{industry_text}"
+
+def orgs_by_industry_text_and_geo(industry_text, country_code, admin1_code=None):
+    cache_key = orgs_by_industry_text_and_geo_cache_key(industry_text, country_code, admin1_code)
+    return cached_compute(cache_key, lambda: Organization.by_industry_text_and_geo(industry_text, country_code, admin1_code),
+                          soft_timeout=ORGS_BY_INDUSTRY_TEXT_SOFT_TIMEOUT, timeout=ORGS_BY_INDUSTRY_TEXT_TIMEOUT)
+
+def orgs_by_industry_text_and_geos(industry_text, country_admin1s):
+    '''
+        Bulk version of orgs_by_industry_text_and_geo for a list of (country_code, admin1_code):
+        one MGET for everything cached, one pipeline to cache the misses.
+        Returns dict of (country_code, admin1_code) -> results
+    '''
+    cache_keys = {orgs_by_industry_text_and_geo_cache_key(industry_text, cc, adm1): (cc, adm1) for cc, adm1 in country_admin1s}
+    cached = get_many_versionable_cache(cache_keys.keys(), unwrap=False)
+    results = {}
+    to_cache = {}
+    for cache_key, (cc, adm1) in cache_keys.items():
+        fn = lambda cc=cc, adm1=adm1: Organization.by_industry_text_and_geo(industry_text, cc, adm1)
+        entry = cached.get(cache_key)
+        if entry is None:
+            logger.debug(f"cache miss {cache_key}")
+            results[(cc, adm1)] = fn()
+            to_cache[cache_key] = results[(cc, adm1)]
+            continue
+        if isinstance(entry, SoftExpiringValue) and entry.is_stale():
+            refresh_in_background(cache_key, fn, default_version(),
+                                  soft_timeout=ORGS_BY_INDUSTRY_TEXT_SOFT_TIMEOUT, timeout=ORGS_BY_INDUSTRY_TEXT_TIMEOUT)
+        results[(cc, adm1)] = unwrap_soft_expiring(entry)
+    if len(to_cache) > 0:
+        set_many_versionable_cache(to_cache, soft_timeout=ORGS_BY_INDUSTRY_TEXT_SOFT_TIMEOUT,
+                                   timeout=ORGS_BY_INDUSTRY_TEXT_TIMEOUT)
+    return results
 
 def org_geo_industry_cluster_query_by_words(search_text: str,counts_only):
     industry_clusters = IndustryCluster.by_representative_doc_words(search_text)
@@ -171,32 +165,34 @@ def org_geo_industry_cluster_query_by_words(search_text: str,counts_only):
 
 def org_geo_industry_by_clusters(industry_clusters, counts_only):    
     logger.info(f"org_geo_industry_by_clusters: Got {len(industry_clusters)} industry clusters")
-    country_results = {}
+    country_results = {ind.uri: {} for ind in industry_clusters}
     adm1_results = defaultdict(dict)
     relevant_countries = []
     relevant_admin1s = defaultdict(list)
-    for ind in industry_clusters:
-        logger.debug(f"org_geo_industry_by_clusters: working on {ind.topicId}")
-        ind_uri = ind.uri
-        country_results[ind_uri] = {}
-        for cc in COUNTRY_TO_GLOBAL_REGION.keys():
-            res = org_uris_by_industry_id_country_admin1(ind.topicId,cc)
-            if len(res) > 0:
-                relevant_countries.append(cc)
-                if counts_only:
-                    res = len(res)
-                country_results[ind_uri][cc] = res
-                if cc in COUNTRIES_WITH_STATE_PROVINCE:
-                    admin1_list = admin1s_for_country(cc)
-                    assert admin1_list is not None, f"No admin1 found for {cc}"
-                    adm1_results[ind_uri][cc] = {}
-                    for adm1 in admin1_list:
-                        res = org_uris_by_industry_id_country_admin1(ind.topicId,cc,adm1)
-                        if len(res) > 0:
-                            if counts_only:
-                                res = len(res)
-                            adm1_results[ind_uri][cc][adm1] = res
-                            relevant_admin1s[cc].append(adm1)
+    cube = get_activity_cube()
+    min_date, max_date = min_and_max_date({})
+    topic_id_to_uri = {ind.topicId: ind.uri for ind in industry_clusters}
+    counts = cube.org_counts_by_geo(topic_id_to_uri.keys())
+    admin1s_by_country = admin1s_for_countries({cc for _, cc, adm1 in counts.keys()
+                                                if adm1 is not None and cc in COUNTRIES_WITH_STATE_PROVINCE})
+    for (topic_id, cc, adm1), cnt in sorted(counts.items(), key=lambda x: (x[0][1], x[0][2] or "")):
+        if cc not in COUNTRY_TO_GLOBAL_REGION:
+            continue
+        ind_uri = topic_id_to_uri[topic_id]
+        res = cnt if counts_only else cube.orgs(min_date,max_date,topic_id,cc,adm1)
+        if adm1 is None:
+            relevant_countries.append(cc)
+            country_results[ind_uri][cc] = res
+            if cc in COUNTRIES_WITH_STATE_PROVINCE:
+                adm1_results[ind_uri].setdefault(cc, {})
+            continue
+        if cc not in COUNTRIES_WITH_STATE_PROVINCE:
+            continue
+        assert admin1s_by_country[cc] is not None, f"No admin1 found for {cc}"
+        if adm1 not in admin1s_by_country[cc]:
+            continue
+        adm1_results[ind_uri].setdefault(cc, {})[adm1] = res
+        relevant_admin1s[cc].append(adm1)
     return industry_clusters, relevant_countries, relevant_admin1s, country_results, adm1_results
 
 def org_geo_industry_text_by_words(search_str: str,counts_only=False):
@@ -204,24 +200,29 @@ def org_geo_industry_text_by_words(search_str: str,counts_only=False):
     adm1_results = defaultdict(dict)
     relevant_countries = []
     relevant_admin1s = defaultdict(list)
+    by_country = orgs_by_industry_text_and_geos(search_str, [(cc, None) for cc in COUNTRY_TO_GLOBAL_REGION.keys()])
     for cc in COUNTRY_TO_GLOBAL_REGION.keys():
-        res = orgs_by_industry_text_and_geo(search_str,cc)
+        res = by_country[(cc, None)]
         if len(res) > 0:
             relevant_countries.append(cc)
             if counts_only:
                 res = len(res)
             country_results[cc] = res
-            if cc in COUNTRIES_WITH_STATE_PROVINCE:
-                admin1_list = admin1s_for_country(cc)
-                assert admin1_list is not None, f"No admin1 found for {cc}"
-                adm1_results[cc] = {}
-                for adm1 in admin1_list:
-                    res = orgs_by_industry_text_and_geo(search_str,cc,adm1)
-                    if len(res) > 0:
-                        if counts_only:
-                            res = len(res)
-                        adm1_results[cc][adm1] = res
-                        relevant_admin1s[cc].append(adm1)
+    countries_with_admin1 = [cc for cc in relevant_countries if cc in COUNTRIES_WITH_STATE_PROVINCE]
+    admin1s_by_country = admin1s_for_countries(countries_with_admin1)
+    for cc, admin1_list in admin1s_by_country.items():
+        assert admin1_list is not None, f"No admin1 found for {cc}"
+    by_admin1 = orgs_by_industry_text_and_geos(search_str, [(cc, adm1) for cc in countries_with_admin1
+                                                                      for adm1 in admin1s_by_country[cc]])
+    for cc in countries_with_admin1:
+        adm1_results[cc] = {}
+        for adm1 in admin1s_by_country[cc]:
+            res = by_admin1[(cc, adm1)]
+            if len(res) > 0:
+                if counts_only:
+                    res = len(res)
+                adm1_results[cc][adm1] = res
+                relevant_admin1s[cc].append(adm1)
     return relevant_countries, relevant_admin1s, country_results, adm1_results
 
         
@@ -6,7 +6,8 @@ from typing import Union, Tuple
 from collections import Counter
 from topics.activity_helpers import (get_activities_by_industry_geo_and_date_range,
                                      get_activities_by_org_uris_and_date_range,
-                                     industry_sector_update_to_api_results)
+                                     industry_sector_update_to_api_results,
+                                     ActivityArticleResults, activity_row_uri)
 import logging 
 logger = logging.getLogger(__name__)
 
@@ -139,9 +140,9 @@ def activities_by_industry_text_and_or_geo_typesense(industry_text: str, geo_cod
         for geo_code in geo_codes:
             logger.info(f"Adding by industry for topic_id {industry_id} in {geo_code}")
             activities= get_activities_by_industry_geo_and_date_range(industry_id, geo_code, min_date, max_date) # Already all cached
-            for act in activities:
-                if act['activity_uri'] not in seen_uris:
-                    seen_uris.add(act['activity_uri'])
+            for act in activities.rows:
+                if activity_row_uri(act) not in seen_uris:
+                    seen_uris.add(activity_row_uri(act))
                     all_activities.append(act)
 
     logger.info(f"Got industry activities: {len(all_activities)}")
@@ -151,10 +152,9 @@ def activities_by_industry_text_and_or_geo_typesense(industry_text: str, geo_cod
     org_acts = get_activities_by_org_uris_and_date_range(relevant_org_uris,min_date, max_date)
 
     logger.info("Got org_acts activities)")
-    for act in org_acts:
-        if act['activity_uri'] not in seen_uris:
-            seen_uris.add(act['activity_uri'])
+    for act in org_acts.rows:
+        if activity_row_uri(act) not in seen_uris:
+            seen_uris.add(activity_row_uri(act))
             all_activities.append(act)
     logger.info("combined all activities")
-    sorted_activities = sorted(all_activities, key=lambda x: x["date_published"], reverse=True)
-    return sorted_activities
+    return ActivityArticleResults(all_activities)
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from syracuse.cache_util import get_cache_metrics, reset_cache_metrics
+
+import logging
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Show cache hits, misses, bytes read and deserialize time per key family'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sort_by',
+            default='bytes',
+            help='Metric to sort by, e.g. bytes, misses, hit_rate, avg_deserialize_ms'
+        )
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='Clear the metrics after showing them'
+        )
+
+    def handle(self, *args, **options):
+        metrics = get_cache_metrics()
+        sort_by = options['sort_by']
+        rows = sorted(metrics.items(), key=lambda x: x[1].get(sort_by) or 0, reverse=True)
+        self.stdout.write(f"{'family':<40} {'hits':>10} {'local':>10} {'misses':>10} {'hit_rate':>8} "
+                          f"{'MB read':>10} {'avg KB':>10} {'avg ms':>8} {'sets':>10}")
+        for family, counts in rows:
+            self.stdout.write(f"{family:<40} {counts['hits']:>10} {counts['local_hits']:>10} {counts['misses']:>10} "
+                              f"{fmt(counts['hit_rate'], 1):>8} {counts['bytes'] / 1_000_000:>10.1f} "
+                              f"{fmt(counts['avg_bytes'], 1 / 1000):>10} {fmt(counts['avg_deserialize_ms'], 1):>8} "
+                              f"{counts['sets']:>10}")
+        if options['reset'] is True:
+            reset_cache_metrics()
+            logger.info(self.style.SUCCESS("Cache metrics reset"))
+
+
+def fmt(val, multiplier):
+    return "-" if val is None else f"{val * multiplier:.2f}"
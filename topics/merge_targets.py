@@ -0,0 +1,106 @@
+from neomodel import db
+import uuid
+from syracuse.cache_util import get_versionable_cache, set_versionable_cache, default_version
+
+import logging
+logger = logging.getLogger(__name__)
+
+MERGE_TARGETS_CACHE_KEY = "merge_targets"
+MERGE_TARGETS_ID_CACHE_KEY = "merge_targets_id"
+LOADED_MERGE_TARGETS = {} # version -> MergeTargets, so each worker only unpickles the map once per version
+
+
+class MergeTargets:
+    '''
+        uri -> (uri it was merged into, ultimate target uri) for every node with internalMergedSameAsHighToUri,
+        so that resolving a uri doesn't need a query per merge hop.
+        Ultimate target is None if the chain ends at a node that doesn't exist.
+    '''
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.targets_id = uuid.uuid4().hex
+
+    def resolve(self, uri):
+        target = self.targets.get(uri)
+        return uri if target is None else target[1]
+
+    def resolve_merged_node(self, uri, merged_into):
+        '''
+            Ultimate target of a node that is merged into merged_into, or False if the map pre-dates that merge
+        '''
+        target = self.targets.get(uri)
+        if target is None or target[0] != merged_into:
+            return False
+        return target[1]
+
+
+def build_merge_targets():
+    '''
+        Union-find over the merge pointers, with path compression
+    '''
+    query = """MATCH (n: Resource) WHERE n.internalMergedSameAsHighToUri IS NOT NULL
+               OPTIONAL MATCH (t: Resource {uri: n.internalMergedSameAsHighToUri})
+               RETURN n.uri, n.internalMergedSameAsHighToUri, t IS NOT NULL"""
+    vals, _ = db.cypher_query(query)
+    parent = {uri: merged_into for uri, merged_into, _ in vals}
+    missing = set(merged_into for _, merged_into, target_exists in vals if target_exists is False)
+    ultimate = {}
+    for uri in parent.keys():
+        find_ultimate_target(uri, parent, missing, ultimate)
+    logger.info(f"Built merge targets for {len(parent)} merged nodes")
+    return MergeTargets({uri: (merged_into, ultimate[uri]) for uri, merged_into in parent.items()})
+
+def find_ultimate_target(uri, parent, missing, ultimate):
+    path = []
+    seen = set()
+    node = uri
+    while node in parent and node not in ultimate and node not in seen:
+        seen.add(node)
+        path.append(node)
+        node = parent[node]
+    if node in ultimate:
+        root = ultimate[node]
+    elif node in missing:
+        root = None
+    else:
+        root = node # Includes breaking out of a (corrupt) merge cycle
+    for x in path:
+        ultimate[x] = root
+    return root
+
+def save_merge_targets(merge_targets, cache_version):
+    set_versionable_cache(MERGE_TARGETS_CACHE_KEY, merge_targets, cache_version)
+    set_versionable_cache(MERGE_TARGETS_ID_CACHE_KEY, merge_targets.targets_id, cache_version)
+    LOADED_MERGE_TARGETS[cache_version] = merge_targets
+
+def get_merge_targets(cache_version=None):
+    '''
+        Returns None if there is no map for this version yet, in which case callers follow the merge pointers themselves
+    '''
+    if cache_version is None:
+        cache_version = default_version()
+    targets_id = get_versionable_cache(MERGE_TARGETS_ID_CACHE_KEY, cache_version)
+    if targets_id is None:
+        return None
+    merge_targets = LOADED_MERGE_TARGETS.get(cache_version)
+    if merge_targets is not None and merge_targets.targets_id == targets_id:
+        return merge_targets
+    logger.info(f"Loading merge targets {targets_id} for {cache_version}")
+    merge_targets = get_versionable_cache(MERGE_TARGETS_CACHE_KEY, cache_version)
+    if merge_targets is not None:
+        LOADED_MERGE_TARGETS[cache_version] = merge_targets
+    return merge_targets
+
+def resolve_many(uris, cache_version=None):
+    '''
+        Returns dict of uri -> ultimate merge target uri (the uri itself if it wasn't merged, None if the target doesn't exist).
+        Only looks at the map, which post-processing updates whenever it merges nodes (see update_merge_targets)
+    '''
+    merge_targets = get_merge_targets(cache_version)
+    if merge_targets is None:
+        return {uri: uri for uri in uris}
+    return {uri: merge_targets.resolve(uri) for uri in uris}
+
+def resolve_uri(uri, cache_version=None):
+    return resolve_many([uri], cache_version)[uri]
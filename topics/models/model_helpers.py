@@ -10,9 +10,9 @@ def similar_organizations(organization,limit=0.94,uris_only=False):
             if uris_only is True:
                 by_ind_cluster[x].update([x[0] for x in org_uris_and_conn_counts])
             else:
-                for org_uri, _ in org_uris_and_conn_counts:
-                    org = Organization.self_or_ultimate_target_node(org_uri)
-                    if org.uri != organization.uri:
+                targets = Organization.self_or_ultimate_target_node_map_by_uri([org_uri for org_uri, _ in org_uris_and_conn_counts])
+                for org in targets.values():
+                    if org is not None and org.uri != organization.uri:
                         by_ind_cluster[x].add(org)
         # by industry texts
         by_ind_text = set()
@@ -22,9 +22,9 @@ def similar_organizations(organization,limit=0.94,uris_only=False):
                 if uris_only is True:
                     by_ind_text.update([x[0] for x in org_uris_and_conn_counts])
                 else:
-                    for org_uri in org_uris_and_conn_counts:
-                        org = Organization.self_or_ultimate_target_node(org_uri)
-                        if org.uri != organization.uri and not any([org in x for x in by_ind_cluster.values()]):
+                    targets = Organization.self_or_ultimate_target_node_map_by_uri(list(org_uris_and_conn_counts))
+                    for org in targets.values():
+                        if org is not None and org.uri != organization.uri and not any([org in x for x in by_ind_cluster.values()]):
                             by_ind_text.add(org)
         for x in organization.sameAsHigh:
             if x.industry is None:
@@ -34,9 +34,9 @@ def similar_organizations(organization,limit=0.94,uris_only=False):
                 if uris_only is True:
                     by_ind_text.update([x[0] for x in org_uris_and_conn_counts])
                 else:
-                    for org_uri, _ in org_uris_and_conn_counts:
-                        org = Organization.self_or_ultimate_target_node(org_uri)
-                        if org.uri != organization.uri and not any([org in x for x in by_ind_cluster.values()]):
+                    targets = Organization.self_or_ultimate_target_node_map_by_uri([org_uri for org_uri, _ in org_uris_and_conn_counts])
+                    for org in targets.values():
+                        if org is not None and org.uri != organization.uri and not any([org in x for x in by_ind_cluster.values()]):
                             by_ind_text.add(org)
         return {"industry_cluster": dict(by_ind_cluster),
                  "industry_text": by_ind_text}
@@ -10,7 +10,8 @@ import cleanco
 from django.conf import settings
 from topics.util import geo_to_country_admin1
 from integration.vector_search_utils import do_vector_search
-from syracuse.cache_util import get_versionable_cache, set_versionable_cache
+from syracuse.cache_util import get_versionable_cache, set_versionable_cache, cached_compute
+from topics.merge_targets import get_merge_targets, resolve_many
 from syracuse.string_util import deduplicate_and_sort_by_frequency
 from topics.industry_geo.industry_geo_cypher import industries_for_org, based_in_high_geo_names_locations_for_org
 from topics.industry_geo.region_hierarchies import COUNTRIES_WITH_STATE_PROVINCE
@@ -50,6 +51,14 @@ def print_friendly(vals, limit = 2):
         val = f"{val} and {extras} more"
     return val
 
+def geo_names_as_str(geos):
+    names = []
+    for x in geos:
+        if x.name is None:
+            continue
+        names.extend(x.name)
+    return print_friendly(names)
+
 def regions_from_geonames(geos, countries_with_admin1=COUNTRIES_WITH_STATE_PROVINCE):
     regions = set()
     for geo in geos:
@@ -61,6 +70,68 @@ def regions_from_geonames(geos, countries_with_admin1=COUNTRIES_WITH_STATE_PROVI
                 regions.add( f"{country_code}-{admin1}")
     return regions
 
+# Embedding vectors that pages never display, but that make up most of the bytes of Organization and IndustryCluster nodes
+BULKY_PROPERTIES = ["industry_embedding", "top_industry_names_embedding_json",
+                    "representative_doc_embedding", "representative_doc_embedding_json"]
+
+def summary_columns(var):
+    '''
+        Cypher return columns for node var without BULKY_PROPERTIES, for inflate_summary. Query params need $bulky_properties
+    '''
+    return f"elementId({var}), labels({var}), apoc.map.removeKeys(properties({var}), $bulky_properties)"
+
+class SummaryNode(dict):
+    '''
+        Looks enough like a neo4j driver Node for neomodel to inflate it
+    '''
+    def __init__(self, element_id, labels, properties):
+        super().__init__(properties)
+        self.element_id = element_id
+        self.labels = frozenset(labels)
+        self._properties = properties
+
+NODE_CLASSES_BY_LABELS = {} # frozenset of labels -> Resource subclass, see node_class_for_labels
+
+def node_class_for_labels(labels):
+    '''
+        The Resource subclass whose labels are exactly these, i.e. the class neomodel inflates such a node to. None if there isn't one.
+        Classes for multiple labels are added at runtime (models_extras), so an unknown set of labels re-reads the subclasses.
+    '''
+    key = frozenset(labels)
+    if key not in NODE_CLASSES_BY_LABELS:
+        to_visit = [Resource]
+        while len(to_visit) > 0:
+            cls = to_visit.pop()
+            NODE_CLASSES_BY_LABELS.setdefault(frozenset(cls.inherited_labels()), cls)
+            to_visit.extend(cls.__subclasses__())
+    return NODE_CLASSES_BY_LABELS.get(key)
+
+def inflate_summary(element_id, labels, properties):
+    '''
+        Node without its BULKY_PROPERTIES. Relationships can be traversed as normal, but it can't be saved.
+    '''
+    if element_id is None:
+        return None
+    cls = node_class_for_labels(labels)
+    if cls is None:
+        raise ValueError(f"No node class defined for {labels}")
+    node = cls.inflate(SummaryNode(element_id, labels, properties))
+    node._is_summary = True # Underscore so that neomodel doesn't treat it as a property to save
+    return node
+
+def summary_cypher_query(query, params=None, nodes_per_row=1, resolve_objects=False):
+    '''
+        Runs a query whose rows start with nodes_per_row lots of summary_columns.
+        Returns rows with each lot inflated into a node, followed by any other columns.
+    '''
+    vals, _ = db.cypher_query(query, {**(params or {}), "bulky_properties": BULKY_PROPERTIES},
+                              resolve_objects=resolve_objects)
+    res = []
+    for row in vals:
+        nodes = [inflate_summary(*row[idx * 3: idx * 3 + 3]) for idx in range(nodes_per_row)]
+        res.append(nodes + list(row[nodes_per_row * 3:]))
+    return res
+
 class WeightedRel(StructuredRel):
     weight = IntegerProperty(default=1)
 
@@ -76,6 +147,7 @@ class Resource(StructuredNode):
     internalId = IntegerProperty() # Unique ID for this entity, in case people need a unique Integer rather than URI (string)
     sameAsHigh = Relationship('Resource','sameAsHigh', model=WeightedRel)
     internalMergedSameAsHighToUri = StringProperty()
+    internalDegree = IntegerProperty(index=True) # Set in post-processing, see integration.rdf_post_processor.update_node_degrees
 
     @property
     def basedInHighGeoNamesLocation(self):
@@ -87,6 +159,8 @@ class Resource(StructuredNode):
 
     @property
     def connection_count(self):
+        if self.internalDegree is not None:
+            return self.internalDegree
         query = f"MATCH (n: Resource {{uri:'{self.uri}'}}) RETURN apoc.node.degree(n)"
         res, _ = db.cypher_query(query)
         return res[0][0]
@@ -207,6 +281,8 @@ class Resource(StructuredNode):
 
     @property
     def oldestDatePublished(self):
+        if "oldestDatePublished" in self.preloaded:
+            return self.preloaded["oldestDatePublished"]
         return self.oldestDocumentSource.datePublished
 
     @property
@@ -230,25 +306,117 @@ class Resource(StructuredNode):
             return None
         elif r.internalMergedSameAsHighToUri is None:
             return r
-        else:
+        merge_targets = get_merge_targets()
+        target_uri = False if merge_targets is None else merge_targets.resolve_merged_node(r.uri, r.internalMergedSameAsHighToUri)
+        if target_uri is None:
+            return None
+        elif target_uri is False: # No map yet or map pre-dates this merge, so follow the pointers
             return Resource.self_or_ultimate_target_node(r.internalMergedSameAsHighToUri)
+        target = Resource.nodes.get_or_none(uri=target_uri)
+        if target is None or target.internalMergedSameAsHighToUri is None:
+            return target
+        return Resource.self_or_ultimate_target_node(target)
 
     @staticmethod
     def self_or_ultimate_target_node_set(uris_or_objects: List):
-        items = [Resource.self_or_ultimate_target_node(x) for x  in uris_or_objects]
+        '''
+            Distinct ultimate targets of uris_or_objects, resolved together rather than with queries per item
+        '''
+        nodes = []
+        uris = []
+        items = []
+        for x in uris_or_objects:
+            if isinstance(x, str):
+                uris.append(x)
+            elif isinstance(x, Resource):
+                nodes.append(x)
+            elif x is None:
+                items.append(None)
+            else:
+                raise ValueError(f"Don't know how to handle {x}")
+        targets = Resource.self_or_ultimate_target_node_map(nodes)
+        items.extend(targets.get(x.uri) for x in nodes)
+        if len(uris) > 0:
+            items.extend(Resource.self_or_ultimate_target_node_map_by_uri(uris).values())
         return list(set(items))
 
+    @staticmethod
+    def self_or_ultimate_target_node_map(nodes: List) -> dict:
+        '''
+            Bulk version of self_or_ultimate_target_node: one query for all the merge targets, plus one per extra hop
+            for merges the merge target map doesn't know about yet.
+            Returns dict of uri -> ultimate target node (or None if the target doesn't exist)
+        '''
+        by_uri = {x.uri: x for x in nodes if x is not None}
+        merge_targets = get_merge_targets()
+        targets = {}
+        for uri, node in by_uri.items():
+            if node.internalMergedSameAsHighToUri is not None and merge_targets is not None:
+                targets[uri] = merge_targets.resolve_merged_node(uri, node.internalMergedSameAsHighToUri)
+        attempted = set(by_uri.keys())
+        to_fetch = {x for x in targets.values() if x is not False}
+        to_fetch.update(x.internalMergedSameAsHighToUri for uri, x in by_uri.items() if targets.get(uri, False) is False)
+        to_fetch = to_fetch - attempted - {None}
+        while len(to_fetch) > 0:
+            attempted.update(to_fetch)
+            vals = summary_cypher_query(f"MATCH (n: Resource) WHERE n.uri IN $uris RETURN {summary_columns('n')}",
+                                        {"uris": list(to_fetch)})
+            fetched = [row[0] for row in vals]
+            by_uri.update({x.uri: x for x in fetched})
+            to_fetch = {x.internalMergedSameAsHighToUri for x in fetched} - attempted - {None}
+        res = {}
+        for uri, node in list(by_uri.items()):
+            target_uri = targets.get(uri, False)
+            if target_uri is not False:
+                node = None if target_uri is None else by_uri.get(target_uri)
+            seen = set()
+            while node is not None and node.internalMergedSameAsHighToUri is not None and node.uri not in seen:
+                seen.add(node.uri)
+                node = by_uri.get(node.internalMergedSameAsHighToUri)
+            res[uri] = node
+        return res
+
+    @staticmethod
+    def summary_by_uri(uri):
+        '''
+            Read-only equivalent of nodes.get_or_none(uri=uri) that leaves out BULKY_PROPERTIES
+        '''
+        vals = summary_cypher_query(f"MATCH (n: Resource {{uri: $uri}}) RETURN {summary_columns('n')}", {"uri": uri})
+        return vals[0][0] if len(vals) > 0 else None
+
+    @staticmethod
+    def self_or_ultimate_target_node_map_by_uri(uris: List) -> dict:
+        '''
+            As self_or_ultimate_target_node_map but starting from uris
+        '''
+        vals = summary_cypher_query(f"MATCH (n: Resource) WHERE n.uri IN $uris RETURN {summary_columns('n')}",
+                                    {"uris": list(set(uris))})
+        targets = Resource.self_or_ultimate_target_node_map([row[0] for row in vals])
+        return {uri: targets.get(uri) for uri in uris}
+
     @property
     def sourceDocumentURL(self):
         return uri_from_related(self.documentURL)
 
     @property
     def sourceName(self):
+        if "sourceName" in self.preloaded:
+            return self.preloaded["sourceName"]
         docs = self.documentSource
         if docs is None or len(docs) == 0:
             return ''
         return self.documentSource[0].sourceOrganization
 
+    @property
+    def preloaded(self):
+        return self.__dict__.get("_preloaded", {})
+
+    def preload(self, **vals):
+        '''
+            Set values for properties that would otherwise need a query each, from a query that has already fetched them
+        '''
+        self._preloaded = {**self.preloaded, **vals}
+
     def ensure_connection(self):
         if self.element_id_property is not None and db.database_version is None:
             # Sometimes seeing "_new_traversal() attempted on unsaved node" even though node is saved
@@ -267,6 +435,11 @@ class Resource(StructuredNode):
     def shortest_name(self):
         return shortest(self.name)
 
+    def save(self, *args, **kwargs):
+        if getattr(self, "_is_summary", False) is True:
+            raise ValueError(f"{self.uri} was loaded without {BULKY_PROPERTIES} so saving it would lose them")
+        return super().save(*args, **kwargs)
+
     def __hash__(self):
         return hash(self.uri)
 
@@ -275,10 +448,8 @@ class Resource(StructuredNode):
     
     def __lt__(self, other):
         # highest degree first, then name
-        self_degree, _ = db.cypher_query(f"MATCH (n: Resource) WHERE n.uri = '{self.uri}' RETURN apoc.node.degree(n)")
-        other_degree, _ = db.cypher_query(f"MATCH (n: Resource) WHERE n.uri = '{other.uri}' RETURN apoc.node.degree(n)")
-        self_degree = self_degree[0][0]
-        other_degree = other_degree[0][0]
+        self_degree = self.connection_count
+        other_degree = other.connection_count
         if self_degree > other_degree:
             return True
         elif other_degree > self_degree:
@@ -581,8 +752,12 @@ class Article(Resource):
     def best_name(self):
         return self.headline
 
+    prefetched_document_url = None # set when url has been loaded in bulk, e.g. in activity_articles_to_api_results
+
     @property
     def documentURL(self):
+        if self.prefetched_document_url is not None:
+            return self.prefetched_document_url
         return self.url[0].uri
 
     def serialize(self):
@@ -633,9 +808,9 @@ class IndustryCluster(Resource):
         res = get_versionable_cache(cache_key)
         if res is not None:
             return res
-        res = []
-        for x in self.orgsPrimary:
-            res.append(Organization.self_or_ultimate_target_node(x))
+        orgs = list(self.orgsPrimary)
+        targets = Organization.self_or_ultimate_target_node_map(orgs)
+        res = [targets.get(x.uri) for x in orgs]
         set_versionable_cache(cache_key, res)
         return res
 
@@ -840,12 +1015,7 @@ class ActivityMixin:
         names = get_versionable_cache(cache_key)
         if names is not None:
             return names
-        names = []
-        for x in self.whereHighGeoNamesLocation:
-            if x.name is None:
-                continue
-            names.extend(x.name)
-        name = print_friendly(names)
+        name = geo_names_as_str(self.whereHighGeoNamesLocation)
         set_versionable_cache(cache_key,name)
         return name
 
@@ -975,6 +1145,7 @@ class Organization(Resource):
     providedBy = RelationshipFrom('PartnershipActivity','providedBy', model=WeightedRel)
     basedInHighRaw = ArrayProperty(StringProperty())
     basedInHighClean = ArrayProperty(StringProperty())
+    internalSameAsNameOnlyUris = ArrayProperty(StringProperty()) # See integration.rdf_post_processor.update_same_as_name_only_neighbours
     productOrganization = RelationshipTo('ProductActivity','productActivity', model=WeightedRel)
     aboutUs = RelationshipTo('AboutUs','hasAboutUs', model=WeightedRel)
     analystRating = RelationshipTo('AnalystRatingActivity', 'hasAnalystRating', model=WeightedRel)
@@ -1145,29 +1316,29 @@ class Organization(Resource):
     @staticmethod
     def by_industry_text(name,limit=0.87):
         cache_key = f"org_by_industry_text_{name}_{limit}"
-        res = get_versionable_cache(cache_key)
-        if res is not None:
-            return res
+        return list(cached_compute(cache_key, lambda: Organization.by_industry_text_uncached(name, limit)))
+
+    @staticmethod
+    def by_industry_text_uncached(name, limit):
         query = f''' CALL db.index.vector.queryNodes('organization_industries_vec', 500, $query_embedding)
         YIELD node, score
         WITH node, score
         WHERE score >= {limit}
-        RETURN node.uri, apoc.node.degree(node)
+        RETURN node.uri, coalesce(node.internalDegree, apoc.node.degree(node))
         ORDER BY score DESCENDING
         '''
         vals = do_vector_search(name, query)
-        res = set()
-        for val in vals:
-            res.add( Organization.self_or_ultimate_target_node(val[0]).uri)
-        set_versionable_cache(cache_key, res)
-        return list(res)
+        targets = resolve_many([val[0] for val in vals])
+        return set(x for x in targets.values() if x is not None)
 
     @staticmethod
     def by_industry_text_and_geo(name,country_code,admin1_code=None,limit=0.85):
         cache_key = f"org_by_industry_text_geo_{name}_{country_code}_{admin1_code}_{limit}"
-        res = get_versionable_cache(cache_key)
-        if res is not None:
-            return res
+        return list(cached_compute(cache_key, lambda: Organization.by_industry_text_and_geo_uncached(
+                                                            name, country_code, admin1_code, limit)))
+
+    @staticmethod
+    def by_industry_text_and_geo_uncached(name, country_code, admin1_code, limit):
         query = f'''CALL db.index.vector.queryNodes('organization_industries_vec', 500, $query_embedding) 
                     YIELD node, score
                     WITH node, score
@@ -1178,11 +1349,9 @@ class Organization(Resource):
                     '''
         if admin1_code is not None:
             query = f"{query} AND r.admin1Code = '{admin1_code}'"
-        query = f"{query} RETURN node.uri, apoc.node.degree(node) ORDER BY score DESCENDING"
+        query = f"{query} RETURN node.uri, coalesce(node.internalDegree, apoc.node.degree(node)) ORDER BY score DESCENDING"
         vals = do_vector_search(name, query)
-        res = [tuple(row) for row in vals]
-        set_versionable_cache(cache_key, res)
-        return list(res)
+        return [tuple(row) for row in vals]
     
     def industry_names_from_merged_nodes(self, industry_names):
         if self.industry:
@@ -41,16 +41,19 @@ def random_org_list(limit=10):
             WITH n, rand() as r
             WHERE r < 0.01
             WITH n LIMIT {limit * 10}
-            RETURN n, apoc.node.degree(n) as relationship_count
+            RETURN {summary_columns('n')}, coalesce(n.internalDegree, apoc.node.degree(n)) as relationship_count
             ORDER BY relationship_count DESC"""
-    vals, _ = db.cypher_query(query, resolve_objects=True)
+    vals = summary_cypher_query(query)
     cleaned = remove_same_as_name_onlies(vals)
     cleaned = cleaned[:limit]
     set_versionable_cache(cache_key, cleaned)
     return cleaned
     
 def get_same_as_name_onlies(org, version=None):
-    try:
+    neighbour_uris = getattr(org, "internalSameAsNameOnlyUris", None)
+    if neighbour_uris is not None:
+        return get_same_as_name_only_neighbours(org.uri, neighbour_uris, version)
+    try: # Not post-processed yet, so look up each of its names
         clean_names = (org.internalCleanName or []) + (org.internalCleanShortName or [])
         if len(clean_names) == 0:
             logger.debug("Nothing to search for")
@@ -66,6 +69,20 @@ def get_same_as_name_onlies(org, version=None):
         logger.debug(f"{ae} : not looking for any same names")
         return []
     
+def get_same_as_name_only_neighbours(uri: str, neighbour_uris: List[str], version=None) -> List:
+    cache_key = f"sano_neighbours_{uri}"
+    res = get_versionable_cache(cache_key, version)
+    if res is not None:
+        return res
+    if len(neighbour_uris) == 0:
+        return []
+    query = f"""MATCH (n: Resource&Organization) WHERE n.uri IN $uris
+                RETURN {summary_columns('n')}, coalesce(n.internalDegree, apoc.node.degree(n)) AS relationship_count
+                ORDER BY relationship_count DESCENDING"""
+    res = [row[0] for row in summary_cypher_query(query, {"uris": neighbour_uris})]
+    set_versionable_cache(cache_key, res, version)
+    return res
+
 def get_by_internal_clean_name(clean_name: str, version=None) -> Dict:
     logger.debug(f"get_by_internal_clean_name {clean_name}")
     cache_key = f"sano_{clean_name}" # sano = same_as_name_only
@@ -98,19 +115,17 @@ def do_search_by_clean_name(clean_name, index_name):
         raise ValueError(f"Don't know how to handle index {index_name}")
     query = f"""CALL db.index.fulltext.queryNodes($index_name, $clean_name_no_punct) YIELD node, score
             WHERE $clean_name IN node.{attribute}
-            RETURN node"""   
+            RETURN {summary_columns('node')}"""
     logger.debug(query)
     clean_name_no_punct = clean_punct(clean_name)
-    vals, _ = db.cypher_query(query,params={"clean_name":clean_name,
-                                            "index_name":index_name,
-                                            "clean_name_no_punct":clean_name_no_punct}, resolve_objects=True)
-    merged_node_uris = set()
-    for row in vals:
-        merged_node = Resource.self_or_ultimate_target_node(row[0])
-        merged_node_uris.add(merged_node.uri)
+    vals = summary_cypher_query(query,params={"clean_name":clean_name,
+                                              "index_name":index_name,
+                                              "clean_name_no_punct":clean_name_no_punct})
+    targets = Resource.self_or_ultimate_target_node_map([row[0] for row in vals])
+    merged_node_uris = set(x.uri for x in targets.values() if x is not None)
     query2 = f"""MATCH (n: Resource) WHERE n.uri IN {list(merged_node_uris)}
-                RETURN n, apoc.node.degree(n)"""
-    vals, _ = db.cypher_query(query2,resolve_objects=True)
+                RETURN {summary_columns('n')}, coalesce(n.internalDegree, apoc.node.degree(n))"""
+    vals = summary_cypher_query(query2)
     return vals
 
 def search_by_name(name, request) -> list:
@@ -130,9 +145,9 @@ def search_by_name_neo4j(name) -> list:
         WHERE "Organization" IN LABELS(n)
         AND SIZE(LABELS(n)) = 2
         AND n.internalMergedSameAsHighToUri IS NULL
-        RETURN n, apoc.node.degree(n) AS relationship_count
+        RETURN {summary_columns('n')}, coalesce(n.internalDegree, apoc.node.degree(n)) AS relationship_count
         ORDER BY relationship_count DESCENDING;'''
-    vals, _ = db.cypher_query(query,resolve_objects=True)
+    vals = summary_cypher_query(query)
     return vals # List of items and number of relationships
 
 def search_by_name_typesense(name) -> list:
@@ -141,9 +156,9 @@ def search_by_name_typesense(name) -> list:
     ids = [x['document']['uri'] for x in ts_vals]
     query = f'''MATCH (n: Resource) WHERE n.uri IN {ids}
                 AND n.internalMergedSameAsHighToUri IS NULL
-                RETURN n, apoc.node.degree(n) as relationship_count
+                RETURN {summary_columns('n')}, coalesce(n.internalDegree, apoc.node.degree(n)) as relationship_count
                 ORDER BY relationship_count DESCENDING;'''
-    vals, _ = db.cypher_query(query, resolve_objects=True)
+    vals = summary_cypher_query(query)
     return vals # List of items and number of relationships
 
 def remove_same_as_name_onlies(reference_org_list):
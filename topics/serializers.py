@@ -4,7 +4,7 @@ from topics.graph_utils import graph_centered_on
 from topics.converters import CustomSerializer
 from topics.timeline_utils import get_timeline_data
 from topics.industry_geo.region_hierarchies import COUNTRY_CODE_TO_NAME
-from topics.models import IndustryCluster, Article, Organization
+from topics.models import IndustryCluster, Article, Organization, summary_columns, summary_cypher_query
 from topics.family_tree_helpers import org_family_tree
 from topics.constants import BEGINNING_OF_TIME, ALL_TIME_MAGIC_NUMBER
 from typing import Union, List
@@ -14,11 +14,15 @@ from topics.industry_geo.org_source_attribution import get_source_orgs_articles_
 from topics.industry_geo import country_admin1_full_name 
 from topics.industry_geo.orgs_by_industry_geo import org_uris_by_industry_id_and_or_geo_code
 from topics.util import elements_from_uri
-from syracuse.cache_util import get_versionable_cache, set_versionable_cache
+from syracuse.cache_util import register_key_family, digest_cache_key, cached_compute
 
 import logging
 logger = logging.getLogger(__name__)
 
+FAMILY_TREE_KEYS = register_key_family("familytree", "FamilyTreeSerializer output")
+GRAPH_KEYS = register_key_family("graph", "OrganizationGraphSerializer output")
+TIMELINE_KEYS = register_key_family("timeline", "OrganizationTimelineSerializer output")
+
 
 class OrganizationWithCountsSerializer(serializers.ModelSerializer):
 
@@ -100,12 +104,13 @@ class FamilyTreeSerializer(serializers.BaseSerializer):
         clean_rels = only_valid_relationships(rels)
         source_names = source_names_from_str(self.context.get("source_str")) 
         min_doc_date = date_from_str_with_default(self.context.get("min_date_str"))
-        source_names_as_list = ",".join(sorted(source_names))
-        cache_key=f"familytree_{organization_uri}_{combine_same_as_name_only}_{clean_rels}_{min_doc_date}_{source_names_as_list}"
-        res = get_versionable_cache(cache_key)
-        if res is not None:
-            logger.debug(f"Cache hit {cache_key}: {res}")
-            return res
+        cache_key = digest_cache_key(FAMILY_TREE_KEYS, organization_uri, combine_same_as_name_only, clean_rels,
+                                     min_doc_date, set(source_names))
+        return cached_compute(cache_key, lambda: self.family_tree_data(instance, combine_same_as_name_only, clean_rels,
+                                                                       source_names, min_doc_date))
+
+    def family_tree_data(self, instance, combine_same_as_name_only, clean_rels, source_names, min_doc_date):
+        organization_uri = instance.uri
         parents, parents_children, org_children = org_family_tree(organization_uri, 
                                                                   combine_same_as_name_only=combine_same_as_name_only,
                                                                   relationships=clean_rels,
@@ -150,8 +155,6 @@ class FamilyTreeSerializer(serializers.BaseSerializer):
             "document_sources": create_source_pretty_print_data(self.context.get("source_str")),
             "min_doc_date": create_min_date_pretty_print_data(self.context.get("min_date_str")),
         }
-        
-        set_versionable_cache(cache_key, res)
         return res
 
 
@@ -276,11 +279,12 @@ class OrganizationGraphSerializer(serializers.BaseSerializer):
         source_names = ",".join(sorted(source_names_as_list))
         combine_same_as_name_only = self.context.get("combine_same_as_name_only")
         max_nodes = self.context["max_nodes"]
-        cache_key=f"graph_{instance.uri}_{combine_same_as_name_only}_{min_doc_date}_{max_nodes}_{source_names}"
-        res = get_versionable_cache(cache_key)
-        if res is not None:
-            logger.debug(f"Cache hit {cache_key}: {res}")
-            return res
+        cache_key = digest_cache_key(GRAPH_KEYS, instance.uri, combine_same_as_name_only, min_doc_date, max_nodes,
+                                     set(source_names_as_list))
+        return cached_compute(cache_key, lambda: self.graph_data(instance, source_names, min_doc_date,
+                                                                 combine_same_as_name_only, max_nodes))
+
+    def graph_data(self, instance, source_names, min_doc_date, combine_same_as_name_only, max_nodes):
         graph_data = graph_centered_on(instance,source_names=source_names,
                                        min_date=min_doc_date,
                                        combine_same_as_name_only=combine_same_as_name_only,
@@ -308,7 +312,6 @@ class OrganizationGraphSerializer(serializers.BaseSerializer):
                 nodes_by_type[node_type] = []
             nodes_by_type[node_type].append(node_row['id'])
         data["nodes_by_type"] = nodes_by_type
-        set_versionable_cache(cache_key, data)
         return data
 
 
@@ -356,11 +359,12 @@ class OrganizationTimelineSerializer(serializers.BaseSerializer):
         source_names_list = source_names_from_str(self.context.get("source_str"))
         min_doc_date = date_from_str_with_default(self.context.get("min_date_str"))
         source_names= ",".join(sorted(source_names_list))
-        cache_key=f"timeline_{instance.uri}_{combine_same_as_name_only}_{min_doc_date}_{source_names}"
-        res = get_versionable_cache(cache_key)
-        if res is not None:
-            logger.debug(f"Cache hit {cache_key}: {res}")
-            return res
+        cache_key = digest_cache_key(TIMELINE_KEYS, instance.uri, combine_same_as_name_only, min_doc_date,
+                                     set(source_names_list))
+        return cached_compute(cache_key, lambda: self.timeline_data(instance, combine_same_as_name_only, source_names,
+                                                                    min_doc_date))
+
+    def timeline_data(self, instance, combine_same_as_name_only, source_names, min_doc_date):
         groups, items, item_display_details, org_display_details = get_timeline_data(instance, combine_same_as_name_only, 
                                                                                      source_names, min_doc_date)
         resp = {"groups": groups, "items":items,
@@ -371,7 +375,6 @@ class OrganizationTimelineSerializer(serializers.BaseSerializer):
             "document_sources": create_source_pretty_print_data(self.context.get("source_str")),
             "min_doc_date": create_min_date_pretty_print_data(self.context.get("min_date_str")),
             }
-        set_versionable_cache(cache_key,resp)
         return resp
 
 class CountryRegionSerializer(serializers.Serializer):
@@ -503,9 +506,8 @@ class OrgsByIndustryGeoSerializer(serializers.BaseSerializer):
         
 def orgs_by_connection_count(org_uris):
     org_data = []
-    for uri in org_uris:
-        logger.debug(uri)
-        o = Organization.get_by_uri(uri)
+    vals = summary_cypher_query(f"MATCH (n: Resource) WHERE n.uri IN $uris RETURN {summary_columns('n')}", {"uris": list(org_uris)})
+    for o, in vals:
         org_vals = {"uri":o.uri,"name":o.best_name,
                     "connection_count":o.connection_count}
         org_vals["splitted_uri"] = elements_from_uri(o.uri)
@@ -1,12 +1,15 @@
 from django.test import TestCase
+from django.conf import settings
 from collections import OrderedDict
 from topics.models import *
-from topics.activity_helpers import activity_articles_to_api_results, activities_by_source
+from topics.activity_helpers import (activity_articles_to_api_results, activity_articles_to_api_results_by_idx,
+    activities_by_source, ActivityArticleResults)
 from topics.family_tree_helpers import get_parent_orgs, get_child_orgs
 import os
 from neomodel import db
-from datetime import date, datetime
+from datetime import date, datetime, timezone
 import time
+import threading
 from django.contrib.auth import get_user_model
 from topics.serializers import *
 from topics.activity_helpers import get_activities_by_country_and_date_range
@@ -15,7 +18,9 @@ from integration.tests import make_node, clean_db
 import json
 import re
 from topics.serializers import only_valid_relationships, FamilyTreeSerializer
-from topics.industry_geo.orgs_by_industry_geo import build_region_hierarchy, prepare_headers
+from topics.graph_utils import Neighbourhood, GRAPH_MAX_HOPS
+from topics.industry_geo.orgs_by_industry_geo import build_region_hierarchy, prepare_headers, group_org_facts
+from topics.industry_geo.activity_cube import IndustryGeoActivityCube
 from topics.industry_geo.hierarchy_utils import filtered_hierarchy, hierarchy_widths
 from topics.cache_helpers import refresh_geo_data
 from topics.industry_geo import geo_codes_for_region, geo_parent_children
@@ -23,8 +28,13 @@ from topics.industry_geo.orgs_by_industry_geo import org_uris_by_industry_id_and
 from topics.industry_geo.org_source_attribution import get_source_orgs_articles_for, get_source_orgs_for_ind_cluster_or_geo_code
 import pickle
 from topics.organization_search_helpers import search_organizations_by_name
-from syracuse.cache_util import nuke_cache, get_active_version, count_keys, get_inactive_version
-from syracuse.date_util import min_and_max_date
+from syracuse.cache_util import (nuke_cache, get_active_version, count_keys, get_inactive_version, set_active_version,
+    set_versionable_cache, get_versionable_cache, LocalCache, get_many_versionable_cache, set_many_versionable_cache,
+    register_key_family, digest_cache_key, delete_key_family, purge_pending_version, PURGE_PENDING_KEY, cached_compute,
+    LOCAL_CACHE, key_family, get_cache_metrics, reset_cache_metrics, using_version, copy_versionable_cache,
+    on_active_version_message)
+from django.core.cache import cache
+from syracuse.date_util import min_and_max_date, min_and_max_date_based_on_days_ago
 import copy
 from rest_framework import status
 from topics.industry_geo.industry_geo_cypher import INDUSTRY_CLUSTER_MIN_WEIGHT_PROPORTION, GEO_LOCATION_MIN_WEIGHT_PROPORTION
@@ -374,6 +384,36 @@ class TestDynamicClasses(TestCase):
         unpickled = pickle.loads(res)
         assert obj == unpickled
 
+    def test_loads_summary_without_embeddings(self):
+        ts = time.time()
+        uri = f"https://example.org/foo/summary/{ts}"
+        other_uri = f"https://example.org/foo/summary_other/{ts}"
+        embedding = json.dumps([[0.1] * 768])
+        query = f"""CREATE (n: Resource&Organization {{uri:'{uri}', name:['Summary Org'], industry_embedding: {[0.1] * 768},
+                        top_industry_names_embedding_json: '{embedding}'}})-[:buyer]->(: Resource&CorporateFinanceActivity {{uri:'{other_uri}'}})"""
+        db.cypher_query(query)
+        full = Resource.nodes.get_or_none(uri=uri)
+        assert full.top_industry_names_embedding_json is not None
+        summary = Resource.summary_by_uri(uri)
+        assert isinstance(summary, Organization)
+        assert summary == full
+        assert summary.name == ['Summary Org']
+        assert summary.top_industry_names_embedding_json is None
+        assert [x.uri for x in summary.buyer] == [other_uri]
+        with self.assertRaises(ValueError):
+            summary.save()
+        assert "_is_summary" not in summary.__properties__
+        full.save()
+        vals, _ = db.cypher_query("MATCH (n: Resource {uri: $uri}) RETURN keys(n)", {"uri": uri})
+        assert "is_summary" not in vals[0][0] and "_is_summary" not in vals[0][0], f"Got {vals[0][0]}"
+        assert pickle.loads(pickle.dumps(summary)) == summary
+        assert Resource.summary_by_uri(f"{uri}_missing") is None
+
+    def test_finds_node_class_for_labels(self):
+        assert node_class_for_labels(["Resource", "Organization"]) is Organization
+        assert node_class_for_labels(["CorporateFinanceActivity", "Resource"]) is CorporateFinanceActivity
+        assert node_class_for_labels(["Resource", "NoSuchLabel"]) is None
+
 class TestSerializers(TestCase):
 
     def test_cleans_relationship_string1(self):
@@ -555,6 +595,44 @@ class TestIgnoreLowRelativeWeightIndustryCluster(TestCase):
         high_weight_based_in_uris = [x.uri for x in org.industryClusterPrimary]
         assert set(high_weight_based_in_uris) == set(high_weight_matches)
 
+    def test_graph_neighbourhood_matches_all_directional_relationships(self):
+        org = Resource.get_by_uri('https://1145.am/db/2349/Johnson_Johnson')
+        expected = org.all_directional_relationships(source_names=Article.all_sources(), min_date=None)
+        neighbourhood = Neighbourhood([org.uri], Article.all_sources(), None)
+        actual = neighbourhood.directional_relationships(org)
+        as_tuples = lambda rels: set((x["label"], x["direction"], x["other_node"].uri) for x in rels)
+        assert len(actual) > 0
+        assert as_tuples(actual) == as_tuples(expected)
+
+
+class TestGraphNeighbourhood(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        clean_db()
+        nuke_cache()
+        chain = [f"q{x}" for x in range(1, GRAPH_MAX_HOPS + 2)]
+        nodes = [make_node(1, "a"), make_node(2, "p1", "Person"), make_node(3, "p1t", "Person"),
+                 make_node(4, "px", "Person")] + [make_node(10 + idx, x, "Person") for idx, x in enumerate(chain)]
+        chain_rels = ", ".join(f"({x})-[:foo]->({y})" for x, y in zip(["a"] + chain, chain))
+        query = f"""CREATE {", ".join(nodes)},
+            (a)-[:foo]->(p1), (p1t)-[:foo]->(px), {chain_rels}
+            SET p1.internalMergedSameAsHighToUri = p1t.uri"""
+        db.cypher_query(query)
+
+    def test_expands_merge_targets_that_no_path_reached(self):
+        neighbourhood = Neighbourhood(["https://1145.am/db/1/a"], Article.all_sources(), None)
+        assert neighbourhood.resolved("https://1145.am/db/2/p1").uri == "https://1145.am/db/3/p1t"
+        assert "https://1145.am/db/4/px" in neighbourhood.nodes
+        assert ("foo", "to", "https://1145.am/db/4/px") in [x[:3] for x in neighbourhood.edges["https://1145.am/db/3/p1t"]]
+
+    def test_stops_at_max_hops(self):
+        neighbourhood = Neighbourhood(["https://1145.am/db/1/a"], Article.all_sources(), None)
+        last_reachable = f"https://1145.am/db/{10 + GRAPH_MAX_HOPS - 1}/q{GRAPH_MAX_HOPS}"
+        one_too_far = f"https://1145.am/db/{10 + GRAPH_MAX_HOPS}/q{GRAPH_MAX_HOPS + 1}"
+        assert last_reachable in neighbourhood.nodes
+        assert one_too_far not in neighbourhood.nodes
+
 
 class TestIgnoreLowRelativeWeightGeoLocations(TestCase):
 
@@ -691,6 +769,68 @@ class TestActivityHelpers(TestCase):
         val = res[0]['actors']['organization'].pop()
         assert val.uri == 'https://1145.am/db/2707859/McIlhenny_Company'
 
+    def test_bulk_hydration_matches_node_by_node(self):
+        activity_uri = "https://1145.am/db/5304143/Launch-Tabasco_Brand_Salsa_Picante"
+        article_uri = "https://1145.am/db/5304143/wwwprnewswirecom_news-releases_tabasco-brand-launches-new-mexican-style-hot-sauce-for-foodservice-302395079html"
+        act = Resource.get_by_uri(activity_uri)
+        art = Resource.get_by_uri(article_uri)
+        res = activity_articles_to_api_results([(activity_uri, article_uri, date.fromisoformat("2025-03-06"))])
+        assert len(res) == 1
+        row = res[0]
+        assert row["document_extract"] == act.documentSource.relationship(art).documentExtract
+        assert row["document_url"] == "https://www.prnewswire.com/news-releases/tabasco-brand-launches-new-mexican-style-hot-sauce-for-foodservice-302395079.html"
+        assert row["archive_org_page_url"] == art.archiveOrgPageURL
+        assert row["activity_location_as_string"] == act.whereHighGeoName_as_str
+        expected_actors = {k: set(v) for k,v in act.all_actors.items() if len(v) > 0}
+        assert row["actors"] == expected_actors
+
+    def test_lazy_results_only_hydrate_requested_rows(self):
+        activity_uri = "https://1145.am/db/5304143/Launch-Tabasco_Brand_Salsa_Picante"
+        article_uri = "https://1145.am/db/5304143/wwwprnewswirecom_news-releases_tabasco-brand-launches-new-mexican-style-hot-sauce-for-foodservice-302395079html"
+        rows = [(activity_uri, article_uri, datetime(2025,3,6,20,16))] + [
+                    (f"https://example.org/activity_{x}", article_uri, datetime(2025,1,x+1)) for x in range(10)]
+        res = ActivityArticleResults(rows)
+        assert len(res) == 1 # The example.org activities don't exist
+        with patch("topics.activity_helpers.activity_articles_to_api_results_by_idx",
+                   wraps=activity_articles_to_api_results_by_idx) as mock_hydrate:
+            page = res[:1]
+            assert mock_hydrate.call_count == 1
+            assert len(mock_hydrate.call_args[0][0]) == 1
+        assert page[0]['activity_uri'] == activity_uri
+        filtered = res.unique_and_allowed_activity_types(["ProductActivity"])
+        assert len(filtered) == 1
+
+    def test_skips_missing_rows_without_shifting_dates(self):
+        activity_uri = "https://1145.am/db/5304143/Launch-Tabasco_Brand_Salsa_Picante"
+        article_uri = "https://1145.am/db/5304143/wwwprnewswirecom_news-releases_tabasco-brand-launches-new-mexican-style-hot-sauce-for-foodservice-302395079html"
+        rows = [("https://example.org/no_such_activity", article_uri, datetime(2025,3,7)),
+                (activity_uri, article_uri, datetime(2025,3,6))]
+        res = activity_articles_to_api_results(rows)
+        assert len(res) == 1
+        assert res[0]["activity_uri"] == activity_uri
+        assert res[0]["date_published"] == datetime(2025,3,6)
+        lazy = ActivityArticleResults(rows)
+        page = lazy[:2]
+        assert len(page) == 1
+        assert page[0]["date_published"] == datetime(2025,3,6)
+
+    def test_leaves_out_deleted_activities(self):
+        ts = time.time()
+        article_uri = f"https://example.org/deleted_test/article/{ts}"
+        activity_uris = [f"https://example.org/deleted_test/activity/{x}/{ts}" for x in range(3)]
+        db.cypher_query("""CREATE (:Resource&Article {uri: $article_uri})
+                           WITH 1 AS x UNWIND $activity_uris AS uri CREATE (:Resource&CorporateFinanceActivity {uri: uri})""",
+                        {"article_uri": article_uri, "activity_uris": activity_uris})
+        rows = [(uri, article_uri, datetime(2025,3,10-x)) for x, uri in enumerate(activity_uris)]
+        db.cypher_query("MATCH (n: Resource {uri: $uri}) DETACH DELETE n", {"uri": activity_uris[0]})
+        res = ActivityArticleResults(rows)
+        assert len(res) == 2
+        assert [x[0] for x in res.rows] == activity_uris[1:]
+        db.cypher_query("MATCH (n: Resource {uri: $uri}) DETACH DELETE n", {"uri": activity_uris[2]}) # After building the results
+        assert res[1] is None
+        assert res.unique_and_allowed_activity_types(["CorporateFinanceActivity"]).rows == res.rows[:1]
+        db.cypher_query("MATCH (n: Resource) WHERE n.uri IN $uris DETACH DELETE n", {"uris": [article_uri, activity_uris[1]]})
+
     def test_handles_quote_in_source_name(self):
         source_name = """Hawai'i "Public] (Radio"""
         acts = activities_by_source(source_name, date(2025,3,1), date(2025,3,10))
@@ -763,6 +903,206 @@ class TestVersionableCache(TestCase):
                 d["activity_locations"] = len(d["activity_locations"])
         return norm
 
+    def test_serves_active_version_from_local_cache_until_version_changes(self):
+        nuke_cache()
+        v1 = get_active_version()
+        v2 = get_inactive_version()
+        redis_key = set_versionable_cache("local_tier_test", ["foo"])
+        set_versionable_cache("local_tier_test", ["bar"], v2)
+        cache.delete(redis_key)
+        self.assertEqual(get_versionable_cache("local_tier_test"), ["foo"]) # Served from memory
+        self.assertEqual(get_versionable_cache("local_tier_test", v2), ["bar"]) # Inactive version always from Redis
+        set_active_version(v2)
+        self.assertEqual(get_versionable_cache("local_tier_test"), ["bar"])
+        set_active_version(v1)
+        self.assertIsNone(get_versionable_cache("local_tier_test"))
+
+    def test_get_and_set_many_use_version_prefix(self):
+        nuke_cache()
+        v1 = get_active_version()
+        v2 = get_inactive_version()
+        long_key = "x" * 300 # Needs cache_friendly hashing
+        set_many_versionable_cache({"many_a": 1, "many_b": [2], long_key: 3}, v2, timeouts={"many_b": 60})
+        self.assertEqual(get_versionable_cache(long_key, v2), 3)
+        self.assertEqual(get_many_versionable_cache(["many_a", "many_b", long_key, "many_c"], v2),
+                         {"many_a": 1, "many_b": [2], long_key: 3})
+        self.assertEqual(get_many_versionable_cache(["many_a", "many_b"], v1), {})
+        self.assertEqual(count_keys(f"*{v2}_many_*"), 2)
+
+    def test_digest_cache_keys_are_canonical_and_deletable_by_family(self):
+        family = register_key_family("test_family")
+        other_family = register_key_family("test_family_other")
+        uris = [f"https://1145.am/db/{x}/foo" for x in range(100)]
+        key1 = digest_cache_key(family, set(uris), date(2025,1,1), None, limit=10)
+        key2 = digest_cache_key(family, set(reversed(uris)), date(2025,1,1), None, limit=10)
+        self.assertEqual(key1, key2)
+        self.assertTrue(key1.startswith("test_family:"))
+        self.assertLess(len(key1), 50)
+        self.assertNotEqual(key1, digest_cache_key(family, set(uris), date(2025,1,2), None, limit=10))
+        self.assertNotEqual(key1, digest_cache_key(family, uris, date(2025,1,1), None, limit=10)) # list is not a set
+        with self.assertRaises(AssertionError):
+            digest_cache_key("not_registered", uris)
+        nuke_cache()
+        set_versionable_cache(key1, "foo")
+        set_versionable_cache(digest_cache_key(other_family, 1), "bar")
+        delete_key_family(family)
+        self.assertIsNone(get_versionable_cache(key1))
+        self.assertEqual(get_versionable_cache(digest_cache_key(other_family, 1)), "bar")
+
+    def test_purges_previous_version_in_resumable_batches(self):
+        nuke_cache()
+        v1 = get_active_version()
+        v2 = get_inactive_version()
+        set_many_versionable_cache({f"purge_test_{x}": x for x in range(25)}, v1)
+        set_many_versionable_cache({f"purge_test_{x}": x for x in range(25)}, v2)
+        thread = set_active_version(v2, background_purge=True)
+        self.assertTrue(thread.daemon) # Mustn't keep import_ttl from exiting
+        thread.join()
+        self.assertEqual(count_keys(f"*{v1}_purge_test_*"), 0)
+        self.assertEqual(count_keys(f"*{v2}_purge_test_*"), 25)
+        self.assertIsNone(cache.get(PURGE_PENDING_KEY))
+
+        set_many_versionable_cache({f"purge_test_{x}": x for x in range(25)}, v1)
+        cache.set(PURGE_PENDING_KEY, {"version": v1, "cursor": 0, "deleted": 0}) # e.g. left by a killed process
+        self.assertEqual(purge_pending_version(batch_size=5), 25)
+        self.assertEqual(count_keys(f"*{v1}_purge_test_*"), 0)
+
+        cache.set(PURGE_PENDING_KEY, {"version": v2, "cursor": 0, "deleted": 0})
+        self.assertEqual(purge_pending_version(), 0) # Never purges the active version
+        self.assertEqual(count_keys(f"*{v2}_purge_test_*"), 25)
+
+    def test_cached_compute_only_computes_once_for_concurrent_misses(self):
+        nuke_cache()
+        calls = []
+        def slow_fn():
+            calls.append(1)
+            time.sleep(0.5)
+            return {"foo": "bar"}
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cached_compute("single_flight_test", slow_fn)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"foo": "bar"}] * 5)
+        self.assertEqual(cached_compute("single_flight_test", slow_fn), {"foo": "bar"})
+        self.assertEqual(len(calls), 1)
+
+    def test_cached_compute_serves_stale_value_while_refreshing(self):
+        nuke_cache()
+        set_versionable_cache("swr_test", "old", soft_timeout=-1, timeout=60) # Already stale
+        self.assertEqual(get_versionable_cache("swr_test"), "old")
+        self.assertEqual(cached_compute("swr_test", lambda: "new", soft_timeout=60, timeout=120), "old")
+        for _ in range(50):
+            if get_versionable_cache("swr_test") == "new":
+                break
+            time.sleep(0.1)
+        self.assertEqual(get_versionable_cache("swr_test"), "new")
+        self.assertEqual(cached_compute("swr_test", lambda: "newer", soft_timeout=60, timeout=120), "new") # Fresh again
+
+    def test_copies_keys_to_other_version_with_their_ttls(self):
+        nuke_cache()
+        v1 = get_active_version()
+        v2 = get_inactive_version()
+        set_versionable_cache("copy_test_forever", "a", v1)
+        set_versionable_cache("copy_test_bounded", "b", v1, soft_timeout=30, timeout=60)
+        set_versionable_cache("copy_test_expiring", "c", v1, timeout=1)
+        time.sleep(1.1)
+        self.assertEqual(copy_versionable_cache("copy_test_", v1, v2), 2)
+        self.assertEqual(get_versionable_cache("copy_test_forever", v2), "a")
+        self.assertEqual(get_versionable_cache("copy_test_bounded", v2), "b")
+        self.assertIsNone(get_versionable_cache("copy_test_expiring", v2))
+        self.assertIsNone(cache.ttl(f"{v2}_copy_test_forever"))
+        self.assertTrue(0 < cache.ttl(f"{v2}_copy_test_bounded") <= 60)
+
+    def test_records_cache_metrics_per_key_family(self):
+        nuke_cache()
+        reset_cache_metrics()
+        self.assertEqual(key_family("sano_foo bar"), "sano_")
+        self.assertEqual(key_family("orgs_acts_cube_id"), "orgs_acts_cube")
+        self.assertEqual(key_family("https://1145.am/db/1/foo_related_articles"), "*_related_articles")
+        self.assertEqual(key_family("Organization_activity_mixin_https://1145.am/db/1/foo"), "*_activity_mixin_")
+        self.assertEqual(key_family(digest_cache_key(register_key_family("metrics_test"), 1)), "metrics_test")
+        self.assertEqual(key_family("something_unknown"), "other")
+        set_versionable_cache("sano_foo", ["x" * 1000])
+        self.assertEqual(get_versionable_cache("sano_foo"), ["x" * 1000]) # From local tier
+        LOCAL_CACHE.clear()
+        self.assertEqual(get_versionable_cache("sano_foo"), ["x" * 1000]) # From Redis
+        self.assertIsNone(get_versionable_cache("sano_bar"))
+        metrics = get_cache_metrics()["sano_"]
+        self.assertEqual(metrics["sets"], 1)
+        self.assertEqual(metrics["local_hits"], 1)
+        self.assertEqual(metrics["hits"], 1)
+        self.assertEqual(metrics["misses"], 1)
+        self.assertGreater(metrics["bytes"], 1000)
+        self.assertAlmostEqual(metrics["hit_rate"], 2 / 3)
+        reset_cache_metrics()
+        self.assertEqual(get_cache_metrics(), {})
+
+    def test_days_ago_is_limited_to_indexed_days(self):
+        nuke_cache()
+        set_versionable_cache("activity_stats_last_updated", date(2025,8,16))
+        min_date, max_date = min_and_max_date_based_on_days_ago(100000)
+        self.assertEqual((max_date - min_date).days, settings.ACTIVITY_INDEX_DAYS)
+        min_date, max_date = min_and_max_date_based_on_days_ago(-5)
+        self.assertEqual((max_date - min_date).days, 90)
+
+    def test_using_version_sets_default_version_for_thread(self):
+        nuke_cache()
+        inactive = get_inactive_version()
+        with using_version(inactive):
+            set_versionable_cache("warm_test", "warmed")
+            self.assertEqual(get_versionable_cache("warm_test"), "warmed")
+            self.assertEqual(cached_compute("warm_test2", lambda: "computed"), "computed")
+        self.assertIsNone(get_versionable_cache("warm_test"))
+        self.assertEqual(get_versionable_cache("warm_test2", inactive), "computed")
+        set_active_version(inactive)
+        self.assertEqual(get_versionable_cache("warm_test"), "warmed")
+
+    def test_local_cache_evicts_least_recently_used_and_expired(self):
+        local_cache = LocalCache(max_items=2, ttl=60)
+        local_cache.set("a", 1)
+        local_cache.set("b", 2)
+        self.assertEqual(local_cache.get("a"), 1)
+        local_cache.set("c", 3)
+        self.assertIsNone(local_cache.get("b"))
+        self.assertEqual(local_cache.get("a"), 1)
+        local_cache.set("d", 4, ttl=-1)
+        self.assertIsNone(local_cache.get("d"))
+
+    def test_local_cache_is_bounded_by_size_and_returns_copies(self):
+        local_cache = LocalCache(max_items=100, ttl=60, max_bytes=3000, max_value_bytes=2000)
+        local_cache.set("a", ["x" * 1000])
+        local_cache.set("b", ["y" * 1000])
+        local_cache.set("c", ["z" * 1000])
+        self.assertIsNone(local_cache.get("a"))
+        self.assertEqual(local_cache.get("b"), ["y" * 1000])
+        self.assertLessEqual(local_cache.total_bytes, 3000)
+        local_cache.set("b", ["y" * 5000]) # Too big, so the old value goes too
+        self.assertIsNone(local_cache.get("b"))
+        local_cache.get("c").append("changed")
+        self.assertEqual(local_cache.get("c"), ["z" * 1000])
+        local_cache.set("d", "shared")
+        self.assertIs(local_cache.get("d"), local_cache.get("d"))
+
+    def test_drops_local_keys_written_or_deleted_by_other_processes(self):
+        nuke_cache()
+        version = get_active_version()
+        set_versionable_cache("sano_foo", "foo")
+        family = register_key_family("invalidation_test")
+        key = digest_cache_key(family, 1)
+        set_versionable_cache(key, "bar")
+        cache.set(f"{version}_sano_foo", "changed elsewhere")
+        cache.set(f"{version}_{key}", "changed elsewhere")
+        self.assertEqual(get_versionable_cache("sano_foo"), "foo") # Still in local tier
+        on_active_version_message({"data": json.dumps({"sender": "elsewhere:1", "keys": [f"{version}_sano_foo"], "prefix": None})})
+        self.assertEqual(get_versionable_cache("sano_foo"), "changed elsewhere")
+        self.assertEqual(get_versionable_cache(key), "bar")
+        on_active_version_message({"data": json.dumps({"sender": "elsewhere:1", "keys": [], "prefix": f"{version}_{family}:"}).encode()})
+        self.assertEqual(get_versionable_cache(key), "changed elsewhere")
+
     def test_updates_active_cache_version_and_clears_previous_version_keys(self):
         clean_db()
         nuke_cache()
@@ -811,6 +1151,95 @@ class TestVersionableCache(TestCase):
         acts_ny2 = get_activities_by_country_and_date_range("US-NY",min_date,max_date)
         self.assertEqual( len(acts_ny2), 1)
 
+class TestGroupOrgFacts(TestCase):
+
+    def test_groups_by_industry_geo_and_date_window(self):
+        max_date = datetime(2025,3,31,23,59,59,tzinfo=timezone.utc)
+        recent = datetime(2025,3,30,tzinfo=timezone.utc)
+        older = datetime(2025,2,15,tzinfo=timezone.utc)
+        facts = [
+            ("https://example.org/org1", 10, 1, [23], [["US","NY"],["US","NY"],["GB","ENG"]],
+                [["https://example.org/act1","https://example.org/art1",recent],
+                 ["https://example.org/act2","https://example.org/art2",older]]),
+            ("https://example.org/org2", 5, 2, [], [["US","00"]], []),
+        ]
+        groups = group_org_facts(facts, datetime(2025,3,24,tzinfo=timezone.utc), max_date)
+        self.assertEqual(set(groups.keys()), {
+            (23, None, None), (23, "US", None), (23, "GB", None), (23, "US", "NY"),
+            (None, "US", None), (None, "GB", None), (None, "US", "NY"),
+        })
+        self.assertEqual(len(groups[(None, "US", None)]), 2) # Each org only once even if it has 2 US locations
+        org1_row = groups[(23, "US", "NY")][0]
+        self.assertEqual(org1_row[3], [["https://example.org/act1","https://example.org/art1",recent]])
+        groups = group_org_facts(facts, datetime(2025,1,1,tzinfo=timezone.utc), max_date)
+        self.assertEqual(len(groups[(23, None, None)][0][3]), 2)
+
+    def test_activity_cube_slices_by_cell_and_window(self):
+        max_date = datetime(2025,3,31,23,59,59,tzinfo=timezone.utc)
+        window_90 = (datetime(2025,1,1,tzinfo=timezone.utc), max_date)
+        window_7 = (datetime(2025,3,24,tzinfo=timezone.utc), max_date)
+        act1 = ("https://example.org/act1","https://example.org/art1",datetime(2025,3,30,tzinfo=timezone.utc))
+        act2 = ("https://example.org/act2","https://example.org/art2",datetime(2025,2,15,tzinfo=timezone.utc))
+        act3 = ("https://example.org/act3","https://example.org/art3",datetime(2025,3,29,tzinfo=timezone.utc))
+        facts = [
+            ("https://example.org/org1", 10, 1, [23], [["US","NY"]], [list(act1), list(act2)]),
+            ("https://example.org/org2", 20, 2, [23], [["GB","ENG"]], [list(act3)]),
+        ]
+        groups = group_org_facts(facts, *window_90)
+        cube = IndustryGeoActivityCube(groups, *window_90, fill_blanks=False)
+        self.assertEqual(cube.activities(*window_90, 23, None, None), [act1, act3, act2])
+        self.assertEqual(cube.activities(*window_7, "23", None, None), [act1, act3])
+        self.assertEqual(cube.activity_count(*window_90, None, "US", "NY"), 2)
+        self.assertEqual([x[0] for x in cube.orgs(*window_7, 23, None, None)],
+                         ["https://example.org/org2","https://example.org/org1"]) # Sorted by degree
+        self.assertEqual(cube.org_counts_by_geo([23]), {(23,"US",None):1, (23,"US","NY"):1, (23,"GB",None):1})
+        with self.assertRaises(ValueError):
+            cube.activities(*window_7, None, "FR", None) # fill_blanks is False
+
+    def test_activity_cube_handles_arbitrary_date_ranges(self):
+        max_date = datetime(2025,3,31,23,59,59,tzinfo=timezone.utc)
+        acts = [(f"https://example.org/act{x}",f"https://example.org/art{x}",datetime(2025,3,x,12,tzinfo=timezone.utc))
+                for x in range(1,32)]
+        facts = [("https://example.org/org1", 10, 1, [23], [["US","NY"]], [list(x) for x in acts])]
+        cube = IndustryGeoActivityCube(group_org_facts(facts, datetime(2025,1,1,tzinfo=timezone.utc), max_date),
+                                       datetime(2025,1,1,tzinfo=timezone.utc), max_date)
+        fourteen_days_ago = datetime(2025,3,18,tzinfo=timezone.utc)
+        self.assertEqual(cube.activity_count(fourteen_days_ago, max_date, 23, "US", None), 14)
+        self.assertEqual(cube.activities(fourteen_days_ago, max_date, 23, "US", None), list(reversed(acts[17:])))
+        self.assertEqual(cube.activity_count(datetime(2025,3,5,tzinfo=timezone.utc),
+                                             datetime(2025,3,5,23,59,59,tzinfo=timezone.utc), 23, None, None), 1)
+        self.assertEqual(cube.activity_count(datetime(2025,1,1,tzinfo=timezone.utc), max_date, None, "US", "NY"), 31)
+        with self.assertRaises(ValueError):
+            cube.activity_count(datetime(2024,12,31,tzinfo=timezone.utc), max_date, None, "US", "NY") # Before the cube's coverage
+        self.assertEqual(cube.activity_count(datetime(2025,4,1,tzinfo=timezone.utc),
+                                             datetime(2025,4,30,tzinfo=timezone.utc), 23, None, None), 0)
+
+    def test_activity_cube_copies_untouched_orgs_forward(self):
+        max_date = datetime(2025,3,31,23,59,59,tzinfo=timezone.utc)
+        min_date = datetime(2025,1,1,tzinfo=timezone.utc)
+        act1 = ("https://example.org/act1","https://example.org/art1",datetime(2025,3,30,tzinfo=timezone.utc))
+        act2 = ("https://example.org/act2","https://example.org/art2",datetime(2024,12,15,tzinfo=timezone.utc))
+        act3 = ("https://example.org/act3","https://example.org/art3",datetime(2025,3,29,tzinfo=timezone.utc))
+        facts = [
+            ("https://example.org/org1", 10, 1, [23], [["US","NY"]], [list(act1), list(act2)]),
+            ("https://example.org/org2", 20, 2, [23], [["GB","ENG"]], [list(act3)]),
+        ]
+        cube = IndustryGeoActivityCube(group_org_facts(facts, datetime(2024,12,1,tzinfo=timezone.utc), max_date),
+                                       datetime(2024,12,1,tzinfo=timezone.utc), max_date)
+        groups = cube.org_groups(min_date, max_date, exclude_org_uris={"https://example.org/org2"})
+        self.assertEqual(set(groups.keys()), {(23, None, None), (23, "US", None), (23, "US", "NY"),
+                                              (None, "US", None), (None, "US", "NY")})
+        self.assertEqual(groups[(23, None, None)], [("https://example.org/org1", 10, 1, [list(act1)])]) # act2 is too old
+        updated_org2 = [("https://example.org/org2", 25, 2, [23], [["FR", None]], [list(act3)])]
+        for key, org_rows in group_org_facts(updated_org2, min_date, max_date).items():
+            groups[key].extend(org_rows)
+        new_cube = IndustryGeoActivityCube(groups, min_date, max_date)
+        self.assertEqual(new_cube.activities(min_date, max_date, 23, None, None), [act1, act3])
+        self.assertEqual(new_cube.activities(min_date, max_date, None, "GB", None), [])
+        self.assertEqual(new_cube.activities(min_date, max_date, None, "FR", None), [act3])
+        self.assertEqual(new_cube.activities(min_date, max_date, 23, "US", "NY"),
+                         cube.activities(min_date, max_date, 23, "US", "NY"))
+
 class TestDisentanglingMergedCells(TestCase):
 
     def test_unmerges_self_and_subsequent_nodes(self):
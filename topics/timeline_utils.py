@@ -1,70 +1,52 @@
-from topics.models import Article
+from neomodel import db
+from topics.models import Article, CorporateFinanceActivity, LocationActivity, PartnershipActivity, RoleActivity
 from .organization_search_helpers import get_same_as_name_onlies
 
+# (relationship type, is outgoing from the org) -> (activity type, activity class), in the order that activity types
+# are shown, which decides the activity type for an activity that has more than one relationship with the org
+TIMELINE_RELATIONSHIPS = {
+    ("vendor", False): ("vendor", CorporateFinanceActivity),
+    ("investor", True): ("investor", CorporateFinanceActivity),
+    ("participant", True): ("participant", CorporateFinanceActivity),
+    ("protagonist", True): ("protagonist", CorporateFinanceActivity),
+    ("buyer", True): ("buyer", CorporateFinanceActivity),
+    ("locationAdded", True): ("location_added", LocationActivity),
+    ("locationRemoved", True): ("location_removed", LocationActivity),
+    ("hasRole", True): ("role_activity", RoleActivity),
+    ("target", False): ("target", CorporateFinanceActivity),
+    ("partnership", True): ("partnership", PartnershipActivity),
+    ("awarded", True): ("awarded", PartnershipActivity),
+    ("providedBy", False): ("provided_by", PartnershipActivity),
+}
+
+TIMELINE_QUERY = """
+    MATCH (o: Resource) WHERE o.uri IN $org_uris
+    CALL {
+        WITH o
+        MATCH (o)-[r]-(act: Resource)
+        WHERE type(r) IN $rel_types
+        RETURN type(r) AS rel_type, startNode(r) = o AS is_outgoing, act
+        UNION
+        WITH o
+        MATCH (o)-[:hasRole]->(: Resource&Role)<-[:role]-(act: Resource&RoleActivity)
+        RETURN "hasRole" AS rel_type, true AS is_outgoing, act
+    }
+    WITH DISTINCT rel_type, is_outgoing, act
+    MATCH (act)-[:documentSource]->(art: Article)
+    WITH rel_type, is_outgoing, act, collect(art) AS arts
+    WHERE act.sourceOrganization IN $source_names OR any(art IN arts WHERE art.sourceOrganization IN $source_names)
+    RETURN rel_type, is_outgoing, act, head(arts).sourceOrganization, apoc.coll.min([art IN arts | art.datePublished])
+"""
+
+
 def get_timeline_data(org,combine_same_as_name_only, 
                       source_names = Article.core_sources(),
                       min_date = None):
-    org_display = []
-    org_nodes = []
-    activities = []
- 
-    display_data = org.serialize()
-    org_display.append(display_data)
-    org_nodes.append(org)
-    vendor = []
-    participant = []
-    protagonist = []
-    buyer = []
-    investor = []
-    role_activity = []
-    location_added = []
-    location_removed = []
-    target = []
-    partnership = []
-    awarded = []
-    provided_by = []
-
-    vendor.extend(allowable_entities(org.vendor,source_names))
-    participant.extend(allowable_entities(org.participant,source_names))
-    protagonist.extend(allowable_entities(org.protagonist,source_names))
-    buyer.extend(allowable_entities(org.buyer,source_names))
-    investor.extend(allowable_entities(org.investor,source_names))
-    location_added.extend(allowable_entities(org.locationAdded,source_names))
-    location_removed.extend(allowable_entities(org.locationRemoved,source_names))
-    role_activity.extend(org.get_role_activities(source_names)) # it's a tuple
-    target.extend(allowable_entities(org.target,source_names))
-    partnership.extend(allowable_entities(org.partnership, source_names))
-    awarded.extend(allowable_entities(org.awarded, source_names))
-    provided_by.extend(allowable_entities(org.providedBy, source_names))
-
+    org_display = [org.serialize()]
+    org_uris = [org.uri]
     if combine_same_as_name_only is True:
-        for x in get_same_as_name_onlies(org):
-            vendor.extend(allowable_entities(x.vendor,source_names))
-            participant.extend(allowable_entities(x.participant,source_names))
-            buyer.extend(allowable_entities(x.buyer,source_names))
-            investor.extend(allowable_entities(x.investor,source_names))
-            location_added.extend(allowable_entities(x.locationAdded,source_names))
-            location_removed.extend(allowable_entities(x.locationRemoved,source_names))
-            role_activity.extend(x.get_role_activities(source_names))
-            target.extend(allowable_entities(x.target,source_names))
-            partnership.extend(allowable_entities(x.partnership, source_names))
-            awarded.extend(allowable_entities(x.awarded, source_names))
-            provided_by.extend(allowable_entities(x.providedBy, source_names))
-            
-    activities.append(
-        {"vendor": set(vendor),
-        "investor": set(investor),
-        "participant": set(participant),
-        "protagonist": set(protagonist),
-        "buyer": set(buyer),
-        "location_added": set(location_added),
-        "location_removed": set(location_removed),
-        "role_activity": set(role_activity),
-        "target": set(target),
-        "partnership": set(partnership),
-        "awarded": set(awarded),
-        "provided_by": set(provided_by)
-        })
+        org_uris.extend(x.uri for x in get_same_as_name_onlies(org))
+    activities = [get_timeline_activities(org_uris, source_names)]
 
     groups = []
     org_display_details = {}
@@ -97,11 +79,7 @@ def get_timeline_data(org,combine_same_as_name_only,
 
     for idx,activity in enumerate(activities):
         for activity_type,vs in activity.items():
-            for v in vs:
-                if isinstance(v, tuple):
-                    current_item = v[1]
-                else:
-                    current_item = v
+            for current_item in vs:
                 if current_item.uri in seen_uris:
                     continue
                 item_start = current_item.oldestDatePublished
@@ -120,8 +98,24 @@ def get_timeline_data(org,combine_same_as_name_only,
     return groups, items, item_display_details, org_display_details
 
 
-def allowable_entities(related_entities, source_names):
-    return [x for x in related_entities if x.has_permitted_document_source(source_names)]
+def get_timeline_activities(org_uris, source_names):
+    '''
+        Activity type -> set of activities for any of org_uris, only including activities with an article from source_names.
+        Each activity has its sourceName and oldestDatePublished preloaded, so serializing it doesn't need any more queries.
+    '''
+    rel_types = [rel_type for rel_type, _ in TIMELINE_RELATIONSHIPS.keys() if rel_type != "hasRole"]
+    vals, _ = db.cypher_query(TIMELINE_QUERY, {"org_uris": org_uris, "rel_types": rel_types,
+                                               "source_names": list(source_names)}, resolve_objects=True)
+    activities = {activity_type: set() for activity_type, _ in TIMELINE_RELATIONSHIPS.values()}
+    for rel_type, is_outgoing, act, source_name, oldest_date_published in vals:
+        activity_type, klass = TIMELINE_RELATIONSHIPS.get((rel_type, is_outgoing), (None, None))
+        if activity_type is None or not isinstance(act, klass):
+            continue
+        if oldest_date_published is None:
+            continue
+        act.preload(sourceName=source_name, oldestDatePublished=oldest_date_published.to_native())
+        activities[activity_type].add(act)
+    return activities
 
 
 def labelize(activity,activity_type,subgroup):
@@ -52,6 +52,13 @@ def camel_case_to_snake_case(text):
     text = re.sub(r'\s+','_', text)
     return text.lower()
 
+def is_allowed_activity_type(activity_class, activity_types_to_keep=[]):
+    if len(activity_types_to_keep) == 0: # keep all activities
+        return True
+    return any( [ re.match(
+                    x.lower(),activity_class.lower())
+                    for x in activity_types_to_keep ] )
+
 def filter_unique_records_and_allowed_activity_types(activities, activity_types_to_keep=[]):
     activities_to_keep = []
     seen_uris = set()
@@ -60,12 +67,7 @@ def filter_unique_records_and_allowed_activity_types(activities, activity_types_
         assert uri is not None, f"Couldn't find URI for {act}"
         if uri in seen_uris:
             continue
-        if len(activity_types_to_keep) == 0: # keep all activities
+        if is_allowed_activity_type(act["activity_class"], activity_types_to_keep):
             activities_to_keep.append(act)
-        elif any( [ re.match(
-                        x.lower(),act["activity_class"].lower()) 
-                        for x in activity_types_to_keep ] ):
-                activities_to_keep.append(act)
         seen_uris.add(uri)
     return activities_to_keep
-
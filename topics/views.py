@@ -16,7 +16,7 @@ from topics.serializers import (OrganizationGraphSerializer, OrganizationWithCou
 from rest_framework import status, viewsets
 from topics.industry_geo.orgs_by_industry_geo import cached_activity_stats_last_updated_date
 from urllib.parse import urlencode
-from syracuse.settings import MOTD
+from syracuse.settings import MOTD, ACTIVITY_INDEX_DAYS
 from integration.models import DataImport
 from topics.faq import FAQ
 from itertools import islice
@@ -111,7 +111,7 @@ class ShowResource(APIView):
         if doc_id is not None:
             uri = f"{uri}/{doc_id}"
         uri = f"{uri}/{kwargs['name']}"
-        r = Resource.nodes.get(uri=uri)
+        r = Resource.summary_by_uri(uri)
         if r is None:
             raise ValueError(f"Couldn't find Resource with uri {uri}")
         if isinstance(r, Organization):
@@ -207,7 +207,7 @@ class OrganizationTimeline(APIView):
         uri = f"https://{kwargs['domain']}/{kwargs['path']}/{kwargs['doc_id']}/{kwargs['name']}"
         request_state, combine_same_as_name_only = prepare_request_state(request)
         request_state["hide_link"]="organization_timeline"
-        o = Resource.nodes.get(uri=uri)
+        o = Resource.summary_by_uri(uri)
         source_str = request_state["qs_params"].get("sources","_all")
         min_date_str = request_state["qs_params"].get("min_date","")
         org_serializer = OrganizationTimelineSerializer(o, context={"combine_same_as_name_only":combine_same_as_name_only,
@@ -231,7 +231,7 @@ class OrganizationByUri(APIView):
 
     def get(self, request, **kwargs):
         uri = f"https://{kwargs['domain']}/{kwargs['path']}/{kwargs['doc_id']}/{kwargs['name']}"
-        o = Resource.nodes.get(uri=uri)
+        o = Resource.summary_by_uri(uri)
         request_state, combine_same_as_name_only = prepare_request_state(request)
         request_state["hide_link"]="organization_linkages"
         source_str = request_state["qs_params"].get("sources","_all")
@@ -463,9 +463,9 @@ class OrgActivitiesView(APIView):
         request_state["hide_link"]="organization_activities"
         org_uri = f"https://{kwargs['domain']}/{kwargs['path']}/{kwargs['doc_id']}/{kwargs['name']}"
         org = Organization.self_or_ultimate_target_node(org_uri)
-        days_ago = request.query_params.get("days_ago",None)
-        if days_ago:
-            days_ago = int(days_ago)
+        days_ago = int(request.query_params.get("days_ago") or "0")
+        if days_ago < 1 or days_ago > ACTIVITY_INDEX_DAYS:
+            days_ago = None
         matching_activity_orgs, days_ago, min_date, max_date = get_activities_by_org_with_fixed_or_expanding_date_range([org.uri],days_ago,
                                                                                                                combine_same_as_name_only=combine_same_as_name_only,
                                                                                                                limit=100)
@@ -8,7 +8,7 @@ from syracuse.date_util import min_and_max_date
 from trackeditems.date_helpers import days_ago
 from django.template.loader import render_to_string
 from topics.models import Organization
-from syracuse.cache_util import get_versionable_cache, set_versionable_cache
+from syracuse.cache_util import get_versionable_cache, cached_compute
 from topics.industry_geo.orgs_by_industry_geo import org_geo_industry_text_by_words
 import logging
 logger = logging.getLogger(__name__)
@@ -29,13 +29,8 @@ def prepare_recent_changes_email_notification_by_max_date(user, max_date, num_da
 
 def recents_by_user_min_max_date(user, min_date, max_date):
     cache_key = f"recents_{user.id}_{min_date}_{max_date}"
-    res = get_versionable_cache(cache_key)
-    if res is not None:
-        return res
-    tracked_items = TrackedItem.trackable_by_user(user)
-    matching_activity_orgs, serialized_data = tracked_items_between(tracked_items, min_date, max_date)
-    set_versionable_cache(cache_key, (matching_activity_orgs, tracked_items), timeout=60*60 )
-    return matching_activity_orgs, serialized_data
+    fn = lambda: tracked_items_between(TrackedItem.trackable_by_user(user), min_date, max_date)
+    return cached_compute(cache_key, fn, soft_timeout=60*60, timeout=60*60*2)
 
 def tracked_items_between(tracked_items, min_date, max_date):
     org_uris = []